@@ -6,19 +6,38 @@ Main listener for DHCP-webhooks.
 
 import sys
 import logging
-from flask import Flask, request
-from flask_restx import Api, Resource
-from .utils.webhook_functions import parse_dhcp_log
-from .utils.connection_functions import main
+from .utils.startup_functions import configure_logging, check_environment, preload_shared_state
+
+# pylint: disable=wrong-import-position
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout,
-                level=logging.INFO,
-                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-                )
+configure_logging()
+
+# Fail fast, before the heavy imports below.
+MISSING_ENV = check_environment()
+if MISSING_ENV:
+    logger.error("var(s) %s not found in the environment. Fatal Error.", ", ".join(MISSING_ENV))
+    sys.exit(1)
+
+from flask import Flask, Response, request
+from flask_restx import Api, Resource
+from .utils.webhook_functions import parse_dhcp_log, parse_log_stream
+from .utils.connection_functions import main, IMAGE_MANIFEST
+from .utils.job_functions import JobQueue
+from .utils.scheduler_functions import CONNECT_SCHEDULER
+from .utils.async_connection_functions import AsyncEngine, PROVISION_ENGINE
+from .utils.exceptions import JobQueueFull, ConnectSchedulerFull
+from .utils.tftp_functions import EMBEDDED_TFTP, TFTP_EMBEDDED
+from .utils.upgrade_functions import UPGRADE_SCHEDULER
+from .utils.convergence_functions import CONVERGENCE_VERIFIER
+from .utils.metrics_functions import render_metrics
+from .utils.trace_functions import chrome_trace
 
 app = Flask(__name__)
 api = Api(app)
+jobs = JobQueue(target=main,
+                scheduler=CONNECT_SCHEDULER,
+                engine=AsyncEngine() if PROVISION_ENGINE == "async" else None)
 
 @api.route('/webhook')
 class WebhookHandler(Resource):
@@ -30,12 +49,141 @@ class WebhookHandler(Resource):
         -X POST
         """
 
-        data = parse_dhcp_log(str(request.get_data()))
+        lease = parse_dhcp_log(request.get_data())
 
-        if data is None:
+        if lease is None:
             return None, 200
 
-        return main(data)
+        try:
+            job = jobs.submit(lease.as_dict())
+        except (JobQueueFull, ConnectSchedulerFull) as exc:
+            logger.error(exc)
+            return {"message": exc.message}, 503
+
+        return job, 202
+
+@api.route('/webhook/batch')
+class BatchWebhookHandler(Resource):
+    """
+    Handler for newline-delimited logs (raw or NDJSON), many leases per request.
+    """
+    def post(self) -> None:
+        """
+        -X POST
+        """
+
+        results = []
+        queued = 0
+
+        for number, lease, status in parse_log_stream(request.stream):
+            if lease is None:
+                results.append({"line": number, "status": status})
+                continue
+
+            try:
+                job = jobs.submit(lease.as_dict())
+            except (JobQueueFull, ConnectSchedulerFull) as exc:
+                results.append({"line": number, "status": "rejected", "message": exc.message})
+                continue
+
+            queued += 1
+            results.append({"line": number, "mac": lease.mac, "ip": lease.ip, **job})
+
+        logger.info("Batch webhook - %s line(s), %s job(s) queued", len(results), queued)
+
+        return {"lines": len(results), "queued": queued, "results": results}, 202
+
+@api.route('/jobs')
+class JobsHandler(Resource):
+    """
+    Handler for provisioning job overview.
+    """
+    def get(self) -> None:
+        """
+        -X GET
+        """
+
+        stats = jobs.stats()
+        stats["os_upgrades"] = UPGRADE_SCHEDULER.stats()
+        stats["os_manifest"] = IMAGE_MANIFEST.stats()
+        stats["convergence"] = CONVERGENCE_VERIFIER.stats()
+        if TFTP_EMBEDDED:
+            stats["tftp"] = EMBEDDED_TFTP.stats()
+
+        return {**stats, "jobs": jobs.store.recent()}, 200
+
+@api.route('/jobs/<string:job_id>')
+class JobHandler(Resource):
+    """
+    Handler for a single provisioning job.
+    """
+    def get(self, job_id: str) -> None:
+        """
+        -X GET
+        """
+
+        job = jobs.get(job_id)
+
+        if job is None:
+            return {"message": f"No job with id '{job_id}'"}, 404
+
+        return job, 200
+
+@api.route('/jobs/<string:job_id>/trace')
+class JobTraceHandler(Resource):
+    """
+    Handler for the span timeline (and profile) of a single job.
+    """
+    def get(self, job_id: str) -> None:
+        """
+        -X GET [?format=chrome]
+        """
+
+        trace = jobs.get_trace(job_id)
+
+        if trace is None:
+            return {"message": f"No trace for job '{job_id}'"}, 404
+
+        if request.args.get("format") == "chrome":
+            return chrome_trace(trace), 200
+
+        return trace, 200
+
+@api.route('/profile')
+class ProfileHandler(Resource):
+    """
+    Handler for the cProfile toggle.
+    """
+    def get(self) -> None:
+        """
+        -X GET
+        """
+
+        return {"jobs": jobs.store.profiling_armed()}, 200
+
+    def post(self) -> None:
+        """
+        -X POST {"jobs": N} - profile the next N jobs, 0 turns it off.
+        """
+
+        try:
+            count = int((request.get_json(silent=True) or {})["jobs"])
+        except (KeyError, TypeError, ValueError):
+            return {"message": "Expected {\"jobs\": <count>}"}, 400
+
+        jobs.store.arm_profiling(count)
+
+        return {"jobs": jobs.store.profiling_armed()}, 200
+
+@app.route('/metrics')
+def metrics() -> Response:
+    """
+    Prometheus scrape endpoint (plain text, outside the REST API).
+    """
+
+    body, content_type = render_metrics()
+
+    return Response(body, content_type=content_type)
 
 # @api.route('/initial')
 # class WebhookHandler(Resource):
@@ -54,6 +202,9 @@ class WebhookHandler(Resource):
 
 #         return api_main(data)
 
+# With gunicorn preload_app this runs once in the master - workers share the preloaded state.
+preload_shared_state()
+
 if __name__ == '__main__':
 
     app.run(host="0.0.0.0", port=5001)
@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+
+"""
+Device Connection Logic on AsyncScrapli - many devices provisioned from one event loop.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+from textfsm import TextFSMError
+from scrapli import AsyncScrapli
+from scrapli.exceptions import ScrapliConnectionError, ScrapliAuthenticationFailed, \
+                                ScrapliTimeout, ScrapliConnectionNotOpened
+from .exceptions import DeviceNotFound, TwoPasswordPromps, BadDefaultCredentials, UnsupportedOS, ImageVerifyTimeout, ConfigCopyFailed, UpgradeQueueTimeout
+from .device_detection_functions import DeviceDetection, LoginStateMachine
+from .job_functions import Job
+from .scheduler_functions import CONNECT_SCHEDULER, CONNECT_DEADLINE
+from .upgrade_functions import UPGRADE_SCHEDULER
+from .metrics_functions import SSH_COMMAND_SECONDS, record_outcome
+from .trace_functions import span, activate, deactivate
+from .connection_functions import DEVICE_PLATFORM, SYSTEM_FIELDS, INTERFACE_FIELDS, ConnectorBase, answer_login_prompt, finalize_device, \
+                                    begin_run, connect_failed, fail_device, lease_device, lookup_device, plan_upgrade, upgrade_request, upgrade_started, upgrade_downloaded, \
+                                    address_in_use, render_config, start_copy
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    PROVISION_ENGINE = os.environ["PROVISION_ENGINE"]
+except KeyError:
+    PROVISION_ENGINE = "sync"
+
+try:
+    ASYNC_CONCURRENCY = int(os.environ["ASYNC_CONCURRENCY"])
+except KeyError:
+    ASYNC_CONCURRENCY = 100
+
+async def async_manual_connect_on_open(cls):
+    """
+    Async variant of manual_connect_on_open.
+    """
+
+    login = LoginStateMachine(DEVICE_PLATFORM, cls.comms_prompt_pattern)
+
+    async def expect():
+        while not answer_login_prompt(cls, login, await cls.channel.read()):
+            pass
+
+    try:
+        await asyncio.wait_for(expect(), timeout=login.deadline)
+    except asyncio.TimeoutError as exc:
+        raise ScrapliTimeout(f"{cls.host} - No CLI prompt within {login.deadline}s of first-boot login") from exc
+
+def _answer_login_prompts(platform_on_open):
+    """
+    Wraps the platform on_open - asyncssh authenticates at the SSH layer, so a
+    first-boot 'Enter new password:' only shows up in the shell and never raises
+    TwoPasswordPromps. Answers such prompts before the platform on_open runs.
+    """
+
+    async def on_open(cls):
+        await async_manual_connect_on_open(cls)
+        if platform_on_open is not None:
+            await platform_on_open(cls)
+
+    return on_open
+
+class AsyncDeviceConnector(ConnectorBase):
+    """
+    SSH Device Connection-functions (asyncssh transport). Use 'await AsyncDeviceConnector.create()'.
+    """
+
+    def __init__(self, host: str, user: str = None, password: str = None) -> None:
+        """
+        Constructor - no I/O, see create().
+        """
+        super().__init__(host, user=user, password=password)
+
+        self.handed_off = False
+
+    @classmethod
+    async def create(cls, host: str, user: str = None, password: str = None) -> "AsyncDeviceConnector":
+        """
+        Connects, detects OS and serial.
+        """
+
+        self = cls(host, user=user, password=password)
+
+        try:
+            self.device = self._create_device_object()
+            await self._open_connection(self.device)
+
+        # If auth fails, verify that the device does not just want 'Enter new password:' prompt.
+        except TwoPasswordPromps as logon_error:
+            logger.error(logon_error)
+            self.device = self._create_device_object(on_open=async_manual_connect_on_open, auth_bypass=True)
+            await self._open_connection(self.device)
+
+        try:
+            self.device_os = await DeviceDetection(conn=self.device).get_device_os_async()
+        except UnsupportedOS as exc:
+            raise UnsupportedOS(host=self.host) from exc
+
+        try:
+            self.serial = (await self.get_device_sn())[0]["serial"]
+        except TextFSMError as exc:
+            raise ScrapliConnectionError from exc
+
+        return self
+
+    def _create_device_object(self, on_open = None, auth_bypass: bool = False) -> object:
+        """
+        """
+
+        device = AsyncScrapli(**self._device_args(on_open=on_open, auth_bypass=auth_bypass), transport="asyncssh")
+        if on_open is None:
+            device.on_open = _answer_login_prompts(device.on_open)
+
+        return device
+
+    async def _open_connection(self, connection, max_retries=5, backoff_delay=2):
+        """
+        Awaits the connect scheduler until the device accepts TCP/22, then opens the session.
+        """
+
+        with span("wait_for_ssh", "wait"):
+            if not await CONNECT_SCHEDULER.wait_async(self.host, timeout=CONNECT_DEADLINE):
+                raise ScrapliConnectionError(f"{self.host} - TCP/22 not reachable within {CONNECT_DEADLINE}s")
+
+        attempt = 0
+        while True:
+            try:
+                with span("open", "ssh", attempt=attempt):
+                    return await connection.open()
+            except (ScrapliConnectionError, ScrapliAuthenticationFailed) as e:
+                delay = self._open_failed(e, attempt, max_retries, backoff_delay)
+                with span("connect_backoff", "sleep", delay=round(delay, 1)):
+                    await asyncio.sleep(delay)
+            attempt += 1
+
+    async def close(self) -> None:
+        """
+        Closes session, if open.
+        """
+
+        if self.device is not None and self.device.isalive():
+            await self.device.close()
+
+    async def _send_command(self, command: str, parse: bool = False, cache: bool = True, fields: tuple = None):
+        """
+        Sends command - see DeviceConnector._send_command.
+        """
+
+        key = (command, parse, fields)
+        result = self._cached(key, cache)
+        if result is None:
+            with SSH_COMMAND_SECONDS.labels(command).time(), span(command, "ssh"):
+                result = self._command_result(key, (await self.device.send_command(command)).result, cache)
+
+        return result
+
+    async def reload_device(self):
+        """
+        Reloads device.
+        """
+
+        self._reloading()
+        try:
+            with span("reload", "ssh"):
+                await self.device.send_interactive(self.device_os["reload_command"])
+        except ScrapliTimeout:
+            logger.info("%s - Device reloaded!", self.serial)
+
+    async def get_device_sn(self) -> list:
+        """
+        Parse device SN from device.
+        """
+
+        return await self._send_command(self.device_os["system_command"], parse=True, fields=SYSTEM_FIELDS)
+
+    async def get_device_version(self) -> str:
+        """
+        Gets device OS version, waiting out a running image verification.
+        """
+
+        result = await self._image_watcher().wait_async(lambda: self._send_command(self.device_os["images_command"], cache=False))
+
+        return self._os_version(result)
+
+    async def download_os_primary(self, os_image: str, peer: str = None) -> None:
+        """
+        Downloads OS as primary device OS - see DeviceConnector.download_os_primary.
+        """
+
+        server, os_image, dialog = self._download_dialog(os_image, peer)
+        with span("download_os", "ssh", image=os_image, server=server):
+            await self.device.send_interactive(dialog, timeout_ops=1200)
+
+        logger.info("%s - New OS downloaded successfully.", self.serial)
+
+    async def get_interfaces_number(self) -> list:
+        """
+        Returns list of all physical interfaces available on the device.
+        """
+
+        return await self._send_command(self.device_os["interfaces_command"], parse=True, fields=INTERFACE_FIELDS)
+
+    async def copy_config(self, serial: str, data_store: str, device_ip: str=None, hostname: str = None, on_done=None) -> None:
+        """
+        Copies the created config over TFTP, then hands the device to the
+        convergence verifier - see DeviceConnector.copy_config.
+        """
+
+        if device_ip is None:
+            device_ip = self.host
+
+        command, read_args = self._copy_command(data_store, device_ip)
+        with span("copy_config", "ssh", data_store=data_store):
+            response = await self.device.send_and_read(command, **read_args)
+
+        loop = asyncio.get_running_loop()
+        self._hand_off(response, serial, device_ip, hostname, lambda: asyncio.run_coroutine_threadsafe(self.device.close(), loop), on_done)
+        self.handed_off = True
+
+async def async_os_handler(conn, netbox, serial: str, job: Job = None):
+    """
+    Handling of OS verification and upgrade - see connection_functions.os_handler.
+    """
+
+    product_raw = (await conn.get_device_sn())[0]["product"]
+    result, desired_os = await asyncio.to_thread(plan_upgrade, netbox, serial, product_raw, await conn.get_device_version(), job)
+    if desired_os is None:
+        return result
+
+    try:
+        request = await asyncio.to_thread(upgrade_request, netbox, serial, conn.host, desired_os, job)
+        slot = await UPGRADE_SCHEDULER.wait_async(**request)
+    except UpgradeQueueTimeout as exc:
+        return await asyncio.to_thread(fail_device, netbox, serial, exc)
+    await asyncio.to_thread(upgrade_started, job, slot)
+
+    try:
+        await conn.download_os_primary(desired_os["image"], peer=slot.peer)
+        downloaded_os = await conn.get_device_version()
+    except BaseException:
+        await asyncio.to_thread(UPGRADE_SCHEDULER.finish, serial, False)
+        raise
+
+    if not await asyncio.to_thread(upgrade_downloaded, netbox, serial, desired_os, downloaded_os):
+        return False
+
+    await conn.reload_device()
+    record_outcome("upgraded")
+    return True
+
+async def async_main(device, job=None):
+    """
+    Ties it all together - same flow as connection_functions.main(), the blocking
+    steps (NetBox, job store, rendering) run in worker threads.
+    """
+
+    job, nb = begin_run(device, job)
+    conn = serial = None
+    trace_token = activate(job.trace)
+
+    try:
+        await asyncio.to_thread(job.update_phase, "connecting")
+        try:
+            expected_device = await asyncio.to_thread(lease_device, nb, device.get("mac"))
+            conn = await AsyncDeviceConnector.create(host=device["ip"])
+        except (DeviceNotFound, BadDefaultCredentials, ScrapliConnectionError, UnsupportedOS) as exc:
+            return connect_failed(exc)
+
+        serial = conn.serial
+        nb_device = await asyncio.to_thread(lookup_device, nb, job, serial, expected_device)
+        if nb_device is None:
+            return None
+
+        await asyncio.to_thread(job.update_phase, "os_check")
+        upgrade = await async_os_handler(conn=conn, netbox=nb, serial=serial, job=job)
+        if upgrade is not None:
+            return upgrade
+
+        await asyncio.to_thread(job.update_phase, "interfaces")
+        interfaces = await conn.get_interfaces_number()
+
+        if await asyncio.to_thread(address_in_use, job, serial, nb_device.primary_ip):
+            return None
+
+        await asyncio.to_thread(render_config, nb, job, serial, nb_device, conn.device_os["os_slug"], interfaces)
+
+        device_ip = await asyncio.to_thread(start_copy, nb, job, serial, nb_device)
+        await conn.copy_config(serial=serial, device_ip=device_ip, data_store="startup-config",
+                               hostname=nb_device.name, on_done=finalize_device(nb, job, serial))
+        await asyncio.to_thread(job.converge)
+        return True
+
+    except ConfigCopyFailed as exc:
+        return await asyncio.to_thread(fail_device, nb, serial, exc)
+
+    except (ScrapliConnectionNotOpened, ScrapliTimeout) as exc:
+        logger.error("%s - %s Connection to device was terminated before completion.", serial, device["ip"])
+        return await asyncio.to_thread(fail_device, nb, serial, "timeout" if isinstance(exc, ScrapliTimeout) else "connection_lost")
+
+    except ImageVerifyTimeout as exc:
+        logger.error(exc)
+        return await asyncio.to_thread(fail_device, nb, serial, "timeout")
+
+    finally:
+        if conn is not None:
+            job.details["command_cache"] = conn.commands.stats()
+            # After copy_config the session belongs to the convergence verifier.
+            if not conn.handed_off:
+                try:
+                    await conn.close()
+                except (ScrapliConnectionNotOpened, OSError):
+                    pass
+        await asyncio.to_thread(nb.flush)
+        deactivate(trace_token)
+
+class AsyncEngine:
+    """
+    Event loop in a background thread running async_main() for many devices at once,
+    bounded by a concurrency semaphore.
+    """
+
+    def __init__(self, target=async_main, concurrency: int = ASYNC_CONCURRENCY) -> None:
+        """
+        Constructor - loop thread is started on first submit (after gunicorn fork).
+        """
+
+        self.target = target
+        self.concurrency = concurrency
+        self.loop = None
+        self._semaphore = None
+        self._pending = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def _start(self) -> None:
+        """
+        Starts event loop thread, if not running.
+        """
+
+        with self._lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            threading.Thread(target=self.loop.run_forever, name="async-engine", daemon=True).start()
+
+    async def _run(self, device: dict, job: Job):
+        """
+        Runs target once a concurrency slot is free.
+        """
+
+        async with self._semaphore:
+            with self._lock:
+                self._pending -= 1
+                self._running += 1
+            try:
+                return await self.target(device, job=job)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    def submit(self, device: dict, job: Job = None):
+        """
+        Schedules provisioning of device, returns concurrent.futures.Future.
+        """
+
+        self._start()
+
+        with self._lock:
+            self._pending += 1
+
+        return asyncio.run_coroutine_threadsafe(self._run(device, job), self.loop)
+
+    def stats(self) -> dict:
+        """
+        Returns running and waiting provisioning runs.
+        """
+
+        return {"concurrency": self.concurrency,
+                "running": self._running,
+                "pending": self._pending}
+
+async def run_many(devices: list, concurrency: int = ASYNC_CONCURRENCY) -> list:
+    """
+    Provisions devices concurrently (at most concurrency at a time). Returns results in order.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(device):
+        async with semaphore:
+            return await async_main(device)
+
+    return await asyncio.gather(*(run_one(device) for device in devices), return_exceptions=True)
+
+if __name__ == "__main__":
+
+    pass
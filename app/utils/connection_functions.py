@@ -6,47 +6,48 @@ Device Connection Logic.
 
 import os
 import re
-import sys
+import select
 import logging
 import time
+import random
 import ipaddress
-import socket
-from contextlib import closing
-from subprocess import check_output, CalledProcessError
-from jinja2 import Template
-from ntc_templates.parse import parse_output
 from textfsm import TextFSMError
 from scrapli import Scrapli
 from scrapli.driver import GenericDriver
 from scrapli.exceptions import ScrapliConnectionError, ScrapliAuthenticationFailed, \
                                 ScrapliTimeout, ScrapliConnectionNotOpened
-from .netbox_functions import NetboxConnector
-from .os_download_functions import SFTPConnector
-from .exceptions import DeviceNotFound, TwoPasswordPromps, BadDefaultCredentials, UnsupportedOS
-from .device_detection_functions import DeviceDetection
+from .netbox_functions import NetboxConnector, NB_MAC_FILTER
+from .parser_functions import TEMPLATE_CACHE
+from .tftp_functions import publish_config, retract_config
+from .os_download_functions import ImageVerifyWatcher
+from .exceptions import DeviceNotFound, TwoPasswordPromps, BadDefaultCredentials, UnsupportedOS, ImageVerifyTimeout, ConfigCopyFailed, UpgradeQueueTimeout
+from .device_detection_functions import DeviceDetection, LoginStateMachine
+from .job_functions import Job
+from .scheduler_functions import CONNECT_SCHEDULER, CONNECT_DEADLINE
+from .probe_functions import PROBER
+from .convergence_functions import CONVERGENCE_VERIFIER, ConvergenceCheck
+from .upgrade_functions import UPGRADE_SCHEDULER, UPGRADE_IMAGE_SIZE, UPGRADE_PEER_USER, UPGRADE_PEER_PASSWORD, UPGRADE_PEER_IMAGE_PATH
+from .manifest_functions import ImageManifest, manifest_source, OS_MANIFEST
+from .metrics_functions import SSH_COMMAND_SECONDS, record_outcome
+from .trace_functions import span, activate, deactivate
 
 # pylint: disable=line-too-long
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout,
-                level=logging.INFO,
-                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-                )
 
-# Turns of Scrapli-logging.
-logging.getLogger('scrapli').propagate = False
+# Required - checked once at startup (startup_functions.check_environment), not at import.
+TFTP_SERVER = os.environ.get("TFTP_SERVER")
+NB_API_TOKEN = os.environ.get("NB_API_TOKEN")
+# FGT_USER = os.environ["FGT_USER"]
+# FGT_PASS = os.environ["FGT_PASS"]
 
 try:
-    TFTP_SERVER = os.environ["TFTP_SERVER"]
-    NB_API_TOKEN = os.environ["NB_API_TOKEN"]
-    # SFTP_SERVER = os.environ["SFTP_SERVER"]
-    # SFTP_USER = os.environ["SFTP_USER"]
-    # SFTP_PASSWORD = os.environ["SFTP_PASSWORD"]
-    # FGT_USER = os.environ["FGT_USER"]
-    # FGT_PASS = os.environ["FGT_PASS"]
-except KeyError as error:
-    logger.error("var %s was not found in the environment. Fatal Error.", error)
-    sys.exit(1)
+    SFTP_SERVER = os.environ["SFTP_SERVER"]
+    SFTP_USER = os.environ["SFTP_USER"]
+    SFTP_PASSWORD = os.environ["SFTP_PASSWORD"]
+except KeyError:
+    logger.warning("$SFTP_SERVER/$SFTP_USER/$SFTP_PASSWORD not set. OS upgrades will not be possible.")
+    SFTP_SERVER = SFTP_USER = SFTP_PASSWORD = None
 
 try:
     NETBOX = os.environ["NETBOX_HOST"]
@@ -54,6 +55,22 @@ except KeyError:
     logger.warning("$NETBOX_HOST was not set. Using default 'netbox:8080' as host")
     NETBOX = "netbox:8080"
 
+try:
+    COPY_TIMEOUT = int(os.environ["COPY_TIMEOUT"])
+except KeyError:
+    COPY_TIMEOUT = 300
+
+# Scrapli platform (and DeviceDetection os_slug) used for first contact with a device.
+DEVICE_PLATFORM = "aruba_aoscx"
+
+# TextFSM columns provisioning uses from 'show system' / 'show interface' - parsed rows are projected to them.
+SYSTEM_FIELDS = ("serial", "product")
+INTERFACE_FIELDS = ("interface", "if_type")
+
+IMAGE_MANIFEST = ImageManifest(manifest_source(OS_MANIFEST,
+                                                netbox=(NETBOX, NB_API_TOKEN),
+                                                sftp=(SFTP_SERVER, SFTP_USER, SFTP_PASSWORD)))
+
 MY_DEVICE = {
     # "auth_username": os.environ["username"],
     # "auth_password": os.environ["password"],
@@ -67,57 +84,342 @@ def icmp_test(ip_address: str) -> bool:
     Verifies if IP Address responds to ICMP
     """
 
-    try:
-        check_output(["ping", "-c", "3", ip_address])
-        return True
-    except CalledProcessError:
-        return False
+    return PROBER.probe(ip_address, port=None)["icmp"]
 
 def ssh_test(ip_address: str) -> bool:
     """
     Verifies if IP Address accepts TCP/22
     """
 
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-        sock.settimeout(5)
-        test_ssh = sock.connect_ex((ip_address, 22))
-        if test_ssh != 0:
-            test_status = False
-        elif test_ssh == 0:
-            test_status = True
+    return PROBER.probe(ip_address, icmp=False)["tcp"]
+
+def confirm_hostname(ip_address: str, hostname: str = None) -> bool:
+    """
+    Logs in to ip_address and verifies it reports hostname (the new config is active).
+    """
+
+    device = Scrapli(host=ip_address,
+                     auth_username=MY_DEVICE["auth_username"],
+                     auth_password=MY_DEVICE["auth_password"],
+                     auth_strict_key=MY_DEVICE["auth_strict_key"],
+                     timeout_socket=10,
+                     timeout_ops=30,
+                     platform=DEVICE_PLATFORM)
+    device.open()
+
+    try:
+        if hostname is None:
+            return True
+        output = device.send_command(DeviceDetection.get_os_by_slug(DEVICE_PLATFORM)["hostname_command"]).result
+    finally:
+        device.close()
+
+    return re.search(rf"(^|\s){re.escape(hostname)}(\s|$)", output) is not None
+
+def peer_image_matches(ip_address: str, image_hash: str) -> bool:
+    """
+    Logs in to a chain-loading peer (peer account) and verifies its image has image_hash.
+    """
+
+    device_os = DeviceDetection.get_os_by_slug(DEVICE_PLATFORM)
+    device = Scrapli(host=ip_address,
+                     auth_username=UPGRADE_PEER_USER,
+                     auth_password=UPGRADE_PEER_PASSWORD,
+                     auth_strict_key=MY_DEVICE["auth_strict_key"],
+                     timeout_socket=10,
+                     timeout_ops=30,
+                     platform=DEVICE_PLATFORM)
+
+    try:
+        device.open()
+        output = device.send_command(device_os["images_command"]).result
+    except (ScrapliAuthenticationFailed, ScrapliConnectionError, ScrapliTimeout) as exc:
+        logger.debug("%s - Peer image check failed: %s", ip_address, exc)
+        return False
+    finally:
+        if device.isalive():
+            device.close()
+
+    match = re.search(device_os["os_regex"], output)
+    return match is not None and match.group(1).lower() == image_hash
+
+def finalize_device(netbox, job: Job, serial: str):
+    """
+    Returns the convergence callback finishing serial in NetBox - active on success,
+    failed otherwise, provisioning tags cleared either way - and then the job. A
+    converged device upgraded here becomes a chain-loading peer on its configured IP.
+    """
 
-    return test_status
+    def on_done(success: bool, details: dict) -> None:
+        record_outcome("success" if success else "not_converged")
+        job.details["convergence"] = details
+        try:
+            if success:
+                retract_config(f"{serial}.conf")
+                UPGRADE_SCHEDULER.register_peer(serial, details["device_ip"])
+            netbox.update_device_status(serial=serial, status="active" if success else "failed")
+            netbox.update_device_tag(serial=serial, tags=[])
+            netbox.flush()
+        finally:
+            job.finish(result=success, error=None if success else f"{serial} - Did not converge on {details['device_ip']}")
+
+    return on_done
+
+def answer_login_prompt(cls, login: LoginStateMachine, output) -> bool:
+    """
+    Feeds channel output to login and answers the login/password prompt it shows.
+    Returns True once the CLI prompt is reached.
+    """
+
+    prompt = login.feed(output)
+    if prompt == "logged_in":
+        return True
+    if prompt is not None:
+        logger.debug("%s - Login prompt '%s' seen", cls.host, prompt)
+        cls.channel.write(login.answer(prompt, cls.auth_username, cls.auth_password))
+        cls.channel.send_return()
+
+    return False
 
 def manual_connect_on_open(cls):
     """
     Function to interact with device when normal authentication doesn't work.
     If a device (ArubaCX for example) asks for a new password on login, this is run.
+    Answers each login/password prompt as soon as it is read from the channel.
     """
-    time.sleep(5)
-    cls.channel.write(cls.auth_username)
-    cls.channel.send_return()
-    time.sleep(10)
-    cls.channel.write(cls.auth_password)
-    cls.channel.send_return()
-    time.sleep(10)
-    cls.channel.write(cls.auth_password)
-    cls.channel.send_return()
 
-class DeviceConnector:
+    login = LoginStateMachine(DEVICE_PLATFORM, cls.comms_prompt_pattern)
+    deadline = time.monotonic() + login.deadline
+
+    # timeout_transport=0 leaves the channel read unbounded - wait on the pty for at
+    # most the time left, so a switch going quiet mid-login can not pin the thread.
+    while (remaining := deadline - time.monotonic()) > 0:
+        readable, _, _ = select.select([cls.transport.session.fd], [], [], remaining)
+        if readable and answer_login_prompt(cls, login, cls.channel.read()):
+            return
+
+    raise ScrapliTimeout(f"{cls.host} - No CLI prompt within {login.deadline}s of first-boot login")
+
+class CommandCache:
     """
-    SSH Device Connection-functions.
+    Per-session cache of command output - raw text and parsed structures.
     """
 
-    def __init__(self, host: str, device_type: str, user: str = None, password: str = None) -> None:
+    def __init__(self) -> None:
         """
-        Constructor for the class. Connection is made available.
+        Constructor.
+        """
+
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        """
+        Returns cached value for key, None on miss.
+        """
+
+        if key in self._entries:
+            self.hits += 1
+            return self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, value) -> None:
+        """
+        Stores value for key.
+        """
+
+        self._entries[key] = value
+
+    def invalidate(self) -> None:
+        """
+        Drops everything - called after state-changing operations.
+        """
+
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns hits/misses.
+        """
+
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+class ConnectorBase:
+    """
+    What DeviceConnector and AsyncDeviceConnector share - everything but the I/O
+    on the session, which each does with its own (blocking / asyncio) Scrapli driver.
+    """
+
+    def __init__(self, host: str, user: str = None, password: str = None) -> None:
         """
+        Constructor - no I/O.
+        """
+
         self.host = host
+        self.user = user
+        self.password = password
+        self.commands = CommandCache()
+        self.device = None
+        self.device_os = None
+        self.serial = None
 
         if user is None and password is None:
             self.user = MY_DEVICE["auth_username"]
             self.password = MY_DEVICE["auth_password"]
 
+    def _device_args(self, on_open = None, auth_bypass: bool = False) -> dict:
+        """
+        Scrapli driver arguments for the device.
+        """
+
+        return {"host": self.host,
+                "auth_username": self.user,
+                "auth_password": self.password,
+                "auth_strict_key": MY_DEVICE["auth_strict_key"],
+                "timeout_transport": 0,
+                "timeout_ops": 60,
+                "platform": DEVICE_PLATFORM,
+                "on_open": on_open,
+                "auth_bypass": auth_bypass}
+
+    def _open_failed(self, error: Exception, attempt: int, max_retries: int, backoff_delay: float) -> float:
+        """
+        Returns seconds to back off before the next open attempt (exponential, with
+        jitter). Raises what the failed open ends with instead - TwoPasswordPromps or
+        BadDefaultCredentials for a failed login, error once max_retries are used up.
+        """
+
+        if isinstance(error, ScrapliAuthenticationFailed):
+            if str(error) == "password prompt seen more than once, assuming auth failed":
+                raise TwoPasswordPromps(str(self.host)) from error
+            raise BadDefaultCredentials(str(self.host)) from error
+
+        if attempt == max_retries:
+            logger.error("Max retries reached. Giving up.")
+            raise error
+
+        delay = random.uniform(backoff_delay, backoff_delay * 2 ** (attempt + 1))
+        logger.info("%s - Retrying %s more time(s) in %.1fs...", self.host, max_retries - attempt, delay)
+        logger.debug(error)
+
+        return delay
+
+    def _cached(self, key: tuple, cache: bool):
+        """
+        Returns memoized output for key (command, parse, fields), None on a miss or
+        if cache is False.
+        """
+
+        return self.commands.get(key) if cache else None
+
+    def _command_result(self, key: tuple, output: str, cache: bool):
+        """
+        Returns output of key's command - TextFSM-parsed if asked for - memoized
+        unless cache is False.
+        """
+
+        command, parse, fields = key
+        if parse:
+            with span(command, "textfsm"):
+                output = TEMPLATE_CACHE.parse(self.device_os["os_slug"], command, output, fields=fields)
+
+        if cache:
+            self.commands.put(key, output)
+
+        return output
+
+    def _image_watcher(self) -> ImageVerifyWatcher:
+        """
+        Returns a watcher for the image verification running on the device.
+        """
+
+        return ImageVerifyWatcher(self.serial, self.device_os["verify_os_regex"])
+
+    def _os_version(self, output: str) -> str:
+        """
+        Returns OS version (SHA-256) from the images command output.
+        """
+
+        return re.search(self.device_os["os_regex"], output).group(1)
+
+    def _reloading(self) -> None:
+        """
+        Called before the reload command is sent.
+        """
+
+        logger.info("%s - Device will reload..", self.serial)
+        self.commands.invalidate()
+
+    def _download_dialog(self, os_image: str, peer: str = None) -> tuple:
+        """
+        Returns (server, image, interactive dialog) for downloading os_image as
+        primary OS - from the SFTP server, or os_image as served by peer.
+        """
+
+        server, user, password = SFTP_SERVER, SFTP_USER, SFTP_PASSWORD
+        if peer is not None:
+            server, user, password, os_image = peer, UPGRADE_PEER_USER, UPGRADE_PEER_PASSWORD, UPGRADE_PEER_IMAGE_PATH
+
+        logger.info("%s - New OS '%s' will be downloaded from %s.", self.serial, os_image, server)
+        self.commands.invalidate()
+
+        # FIXME Not dynamic
+        return server, os_image, [(f"copy sftp://{user}@{server}/{os_image} primary", "Continue (y/n)? "),
+                                  ("y", "Are you sure you want to continue connecting (yes/no/[fingerprint])? "),
+                                  ("yes", f"{user}@{server}'s password: "),
+                                  (password, "", True)]
+
+    def _copy_command(self, data_store: str, device_ip: str) -> tuple:
+        """
+        Returns (command, send_and_read arguments) for the TFTP copy of the
+        created config into data_store.
+        """
+
+        logger.info("%s - Device will have its %s loaded (connected via %s, device configured IP will be %s)", self.serial, data_store, self.host, device_ip)
+        self.commands.invalidate()
+
+        command = self.device_os['copy_config_command'].format(tftp_server=TFTP_SERVER,
+                                                               serial=self.serial,
+                                                               data_store=data_store)
+
+        return command, {"expected_outputs": [self.device_os["tftp_success_command"], *self.device_os["tftp_error_outputs"]],
+                         "failed_when_contains": self.device_os["tftp_error_outputs"],
+                         "read_duration": COPY_TIMEOUT,
+                         "timeout_ops": COPY_TIMEOUT + 10}
+
+    def _hand_off(self, response, serial: str, device_ip: str, hostname: str, close, on_done) -> None:
+        """
+        Raises ConfigCopyFailed unless the copy output (response) reports success,
+        then hands the device to the convergence verifier - it closes the session
+        with close().
+        """
+
+        if response.failed or self.device_os["tftp_success_command"] not in response.result:
+            raise ConfigCopyFailed(self.host, response.result)
+
+        CONVERGENCE_VERIFIER.verify(ConvergenceCheck(serial=serial,
+                                                     host=self.host,
+                                                     device_ip=device_ip,
+                                                     hostname=hostname,
+                                                     session_alive=self.device.isalive,
+                                                     close=close,
+                                                     confirm=confirm_hostname,
+                                                     on_done=on_done or (lambda success, details: None)))
+
+class DeviceConnector(ConnectorBase):
+    """
+    SSH Device Connection-functions.
+    """
+
+    def __init__(self, host: str, device_type: str, user: str = None, password: str = None) -> None:
+        """
+        Constructor for the class. Connection is made available.
+        """
+        super().__init__(host, user=user, password=password)
+
         try:
             if device_type == "FGT":
                 self.device = self._create_forti_object()
@@ -128,8 +430,8 @@ class DeviceConnector:
         # If auth fails, verify that the device does not just want 'Enter new password:' prompt.
         except TwoPasswordPromps as logon_error:
             logger.error(logon_error)
-            self.device_on_open = self._create_device_object(on_open=manual_connect_on_open, auth_bypass=True)
-            self._open_connection(self.device_on_open)
+            self.device = self._create_device_object(on_open=manual_connect_on_open, auth_bypass=True)
+            self._open_connection(self.device)
 
         try:
             self.device_os = self._detect_os()
@@ -145,16 +447,7 @@ class DeviceConnector:
         """
         """
 
-        return Scrapli(host=self.host,
-                        auth_username=self.user,
-                        auth_password=self.password,
-                        auth_strict_key=MY_DEVICE["auth_strict_key"],
-                        timeout_transport=0,
-                        timeout_ops=60,
-                        platform = "aruba_aoscx",
-                        on_open=on_open,
-                        auth_bypass=auth_bypass
-        )
+        return Scrapli(**self._device_args(on_open=on_open, auth_bypass=auth_bypass))
 
     def _create_forti_object(self) -> object:
         """
@@ -169,27 +462,27 @@ class DeviceConnector:
                         comms_prompt_pattern=r"^[a-zA-Z0-9.\-@():]{1,48}\s?[#>$]\s*$"
         )
 
-    def _open_connection(self, connection, max_retries=20, backoff_delay=20):
+    def _open_connection(self, connection, max_retries=5, backoff_delay=2):
         """
-        Recursive function to help establish connection if device is not responsive
-        right away.
+        Waits (via the connect scheduler) until the device accepts TCP/22, then opens
+        the session. The few retries cover sshd accepting before it is ready to log in.
         """
 
-        try:
-            return connection.open()
-        except ScrapliConnectionError as e:
-            if max_retries > 0:
-                time.sleep(backoff_delay)
-                logger.info("%s - Retrying %s more time(s)...", connection.host, max_retries)
-                logger.debug(e)
-                return self._open_connection(connection, max_retries - 1, backoff_delay)
-            logger.error("Max retries reached. Giving up.")
-            return None
-        except ScrapliAuthenticationFailed as auth_error:
-            if str(auth_error) == "password prompt seen more than once, assuming auth failed":
-                raise TwoPasswordPromps(str(self.host)) from auth_error
+        with span("wait_for_ssh", "wait"):
+            reachable = CONNECT_SCHEDULER.wait(self.host, timeout=CONNECT_DEADLINE)
+        if not reachable:
+            raise ScrapliConnectionError(f"{self.host} - TCP/22 not reachable within {CONNECT_DEADLINE}s")
 
-            raise BadDefaultCredentials(str(self.host)) from auth_error
+        for attempt in range(max_retries + 1):
+            try:
+                with span("open", "ssh", attempt=attempt):
+                    return connection.open()
+            except (ScrapliConnectionError, ScrapliAuthenticationFailed) as e:
+                delay = self._open_failed(e, attempt, max_retries, backoff_delay)
+                with span("connect_backoff", "sleep", delay=round(delay, 1)):
+                    time.sleep(delay)
+
+        return None
 
     def _detect_os(self):
         """
@@ -198,25 +491,31 @@ class DeviceConnector:
         detect_os = DeviceDetection(conn=self.device)
         return detect_os.get_device_os()
 
-    @staticmethod
-    def _parse_tftp_output(output: str, success: str="Copying configuration: [Success]") -> bool:
+    def _send_command(self, command: str, parse: bool = False, cache: bool = True, fields: tuple = None):
         """
-        Parses output of copy tftp-command.
+        Sends command, returning its output (TextFSM-parsed if parse, projected to
+        fields if given). Output is memoized for the session unless cache is False.
         """
 
-        if success in output:
-            return True
-        return False
+        key = (command, parse, fields)
+        cached = self._cached(key, cache)
+        if cached is not None:
+            return cached
+
+        with SSH_COMMAND_SECONDS.labels(command).time(), span(command, "ssh"):
+            output = self.device.send_command(command).result
+
+        return self._command_result(key, output, cache)
 
     def reload_device(self):
         """
         Reloads device.
         """
 
-        logger.info("%s - Device will reload..", self.serial)
-
+        self._reloading()
         try:
-            self.device.send_interactive(self.device_os["reload_command"])
+            with span("reload", "ssh"):
+                self.device.send_interactive(self.device_os["reload_command"])
         except ScrapliTimeout:
             logger.info("%s - Device reloaded!", self.serial)
 
@@ -225,39 +524,27 @@ class DeviceConnector:
         Parse device SN from device.
         """
 
-        result = self.device.send_command(self.device_os["system_command"]).result
-
-        return parse_output(platform=self.device_os["os_slug"], command=self.device_os["system_command"], data=result)
+        return self._send_command(self.device_os["system_command"], parse=True, fields=SYSTEM_FIELDS)
 
     def get_device_version(self) -> str:
         """
-        Gets device OS version.
+        Gets device OS version, waiting out a running image verification.
         """
 
-        result = self.device.send_command(self.device_os["images_command"]).result
+        # Changes while an image is being verified - never cached.
+        result = self._image_watcher().wait(lambda: self._send_command(self.device_os["images_command"], cache=False))
 
-        verify_os = re.search(self.device_os["verify_os_regex"], result)
-        if verify_os:
-            logger.info("%s - Verifying OS - %s", self.serial, verify_os.group(1))
-            time.sleep(30)
-            return self.get_device_version()
+        return self._os_version(result)
 
-        return re.search(self.device_os["os_regex"], result).group(1)
-
-    def download_os_primary(self, os_image: str) -> None:
+    def download_os_primary(self, os_image: str, peer: str = None) -> None:
         """
-        Downloads OS as primary device OS.
+        Downloads OS as primary device OS - from the SFTP server, or chain-loaded
+        from peer (an already upgraded device at the same site).
         """
 
-        logger.info("%s - New OS '%s' will be downloaded.", self.serial, os_image)
-
-        # FIXME Not dynamic
-        self.device.send_interactive([
-            (f"copy sftp://{SFTP_USER}@{SFTP_SERVER}/{os_image} primary", "Continue (y/n)? "),
-            ("y", "Are you sure you want to continue connecting (yes/no/[fingerprint])? "),
-            ("yes", f"{SFTP_USER}@{SFTP_SERVER}'s password: "),
-            (SFTP_PASSWORD, "", True)
-        ], timeout_ops=1200)
+        server, os_image, dialog = self._download_dialog(os_image, peer)
+        with span("download_os", "ssh", image=os_image, server=server):
+            self.device.send_interactive(dialog, timeout_ops=1200)
 
         logger.info("%s - New OS downloaded successfully.", self.serial)
 
@@ -266,39 +553,26 @@ class DeviceConnector:
         Returns list of all physical interfaces available on the device.
         """
 
-        result = self.device.send_command(self.device_os["interfaces_command"]).result
-
-        return parse_output(platform=self.device_os["os_slug"], command=self.device_os["interfaces_command"], data=result)
+        return self._send_command(self.device_os["interfaces_command"], parse=True, fields=INTERFACE_FIELDS)
 
-    def copy_config(self, serial: str, data_store: str, device_ip: str=None):
+    def copy_config(self, serial: str, data_store: str, device_ip: str=None, hostname: str = None, on_done=None) -> None:
         """
-        Copy created config to device via TFTP.
+        Copies the created config over TFTP, reading the output until the device
+        reports success or an error (ConfigCopyFailed, also if neither shows within
+        COPY_TIMEOUT). Then hands the device to the convergence verifier -
+        on_done(success, details) is called once it answers on device_ip (with
+        hostname), or did not within CONVERGE_DEADLINE. The verifier owns (and
+        closes) the session from here.
         """
 
         if device_ip is None:
             device_ip = self.host
 
-        result = None
-        logger.info("%s - Device will have its %s loaded (connected via %s, device configured IP will be %s)", self.serial, data_store, self.host, device_ip)
+        command, read_args = self._copy_command(data_store, device_ip)
+        with span("copy_config", "ssh", data_store=data_store):
+            response = self.device.send_and_read(command, **read_args)
 
-        try:
-            result = self.device.send_command(self.device_os['copy_config_command'].format(tftp_server=TFTP_SERVER,
-                                                                                            serial=self.serial,
-                                                                                            data_store=data_store),
-                                            timeout_ops=300).result
-        except ScrapliTimeout:
-            ssh_test_result = ssh_test(device_ip)
-            icmp_test_result = icmp_test(device_ip)
-            if ssh_test_result is True and icmp_test_result is True:
-                logger.info("%s - Configuration for device successfully updated", serial)
-            else:
-                logger.info("%s - SSH Test: %s - ICMP Test: %s", serial, ssh_test_result, icmp_test_result)
-                logger.error("%s - Configuration for device failed", serial)
-        if result is not None:
-            if self._parse_tftp_output(result):
-                logger.info("%s - Configuration for device successfully updated", serial)
-            else:
-                logger.error("%s - Configuration for device failed: %s", serial, result)
+        self._hand_off(response, serial, device_ip, hostname, self.device.close, on_done)
 
     def generate_api_key(self, admin_user: str):
         """
@@ -312,72 +586,262 @@ class DeviceConnector:
 
         return result
 
-def render_template(template: str, data: dict):
+def _upgrade_queued(job: Job, serial: str, eta: float) -> None:
     """
-    Render template with passed data.
+    Reports a device waiting for an OS download slot.
     """
 
-    with open(f"./app/utils/templates/{template}", "r", encoding="utf-8") as temp:
-        template = Template(temp.read())
+    logger.info("%s - Waiting for an OS download slot, ETA %.0fs", serial, eta or 0)
+    if job is not None:
+        job.details["upgrade"] = {"eta": round(eta or 0, 1)}
+        job.update_phase("upgrade_queued")
+
+# Provisioning steps shared by main() and async_main() - blocking (NetBox, job
+# store, CPU), the async engine runs them with asyncio.to_thread.
 
-    config = template.render(hostname=data["hostname"],
-                             ip_address=data["ip_address"],
-                             default_gw=data["default_gw"],
-                             fallback_vlan=data["fallback_vlan"],
-                             interfaces=data["interfaces"],
-                             radius_servers=data["radius_servers"]
-                            )
+def begin_run(device: dict, job: Job = None) -> tuple:
+    """
+    Returns (job, NetBox connector) for a provisioning run of device.
+    """
 
-    return config
+    if job is None:
+        job = Job(device)
 
-def os_handler(conn, netbox, serial: str):
+    return job, NetboxConnector(NETBOX, NB_API_TOKEN)
+
+def fail_device(netbox, serial: str, outcome, clear_tags: bool = True) -> bool:
     """
-    Handling of OS verification and upgrade.
+    Ends a run early - counts outcome (a name, or the exception that ended the
+    run, which is logged) and marks serial failed in NetBox, by default with its
+    provisioning tags cleared. Returns the job result, False.
     """
 
-    product_raw = conn.get_device_sn()[0]["product"]
-    product = re.search(r"([\w]*)\s", product_raw).group(1)
+    if isinstance(outcome, BaseException):
+        logger.error(outcome)
+    record_outcome(outcome)
 
-    logger.info("Device Model indentified as: %s", product)
+    if serial is None:
+        logger.info("Device serial unknown, no Netbox update.")
+    else:
+        netbox.update_device_status(serial=serial, status="failed")
+        if clear_tags:
+            netbox.update_device_tag(serial=serial, tags=[])
 
-    # sftp = SFTPConnector(SFTP_SERVER, SFTP_USER, SFTP_PASSWORD)
+    return False
 
-    device_os = conn.get_device_version()
+def connect_failed(error: Exception) -> None:
+    """
+    Ends a run that never got a session to the device. Returns the job result, None.
+    """
 
-    logger.info("Device OS-version (SHA256 HASH) indentified as: %s", device_os)
+    logger.error(error)
+    record_outcome(error)
+
+def lease_device(netbox, mac: str):
+    """
+    Returns the planned/staged NetBox device the lease's MAC belongs to, None if
+    the index does not know it. With NB_MAC_FILTER such leases raise DeviceNotFound
+    instead (once the index is synced) - no session is opened to them.
+    """
+
+    if mac is None:
+        return None
+
+    expected_device = netbox.get_device_by_mac(mac)
+    if expected_device is not None:
+        logger.info("%s - Lease MAC belongs to planned NetBox device '%s'", mac, expected_device.name)
+    elif NB_MAC_FILTER and netbox.index.synced():
+        raise DeviceNotFound(serial=mac, message="No planned Netbox device with interface MAC")
+
+    return expected_device
+
+def lookup_device(netbox, job: Job, serial: str, expected_device=None):
+    """
+    Marks serial staged and returns its NetBox device, None if NetBox has none.
+    expected_device is the one the lease MAC belongs to (lease_device()) - if it
+    is serial, NetBox is not queried again.
+    """
+
+    job.update_phase("netbox_lookup")
+    logger.info("Device Serial indentified as: %s", serial)
+    if expected_device is not None and expected_device.serial != serial:
+        logger.warning("%s - Lease MAC belongs to NetBox device '%s' with serial %s", serial, expected_device.name, expected_device.serial)
 
     try:
-        desired_os = "468450af91ffd58ccafc700e72767a6be81fcbc1ce9fb43c1c74f700272c937f"
-    except KeyError:
-        logger.error("Unsupported model - verify OS_info for supported models.")
-        netbox.update_device_status(serial=serial, status="failed")
-        return True
+        netbox.update_device_status(serial=serial, status="staged")
+        nb_device = netbox.get_device(serial)
+    except DeviceNotFound as device_error:
+        logger.error(device_error)
+        record_outcome(device_error)
+        return None
+
+    logger.info("NetBox examined for device '%s' - found got following data:\nHostname: %s\nIP Address: %s\nDevice Role: %s", serial, nb_device.name, nb_device.primary_ip, nb_device.role)
+    return nb_device
 
-    tags = netbox.get_device_tags(serial)
+def plan_upgrade(netbox, serial: str, product_raw: str, device_os: str, job: Job = None) -> tuple:
+    """
+    Checks the device OS (SHA-256 of its image) against the golden image for its
+    model. Returns (None, None) if it matches, (None, desired OS) if serial has to
+    be upgraded - it is then tagged upgrading - and (job result, None) if the run
+    ends here.
+    """
+
+    product = re.search(r"([\w]*)\s", product_raw).group(1)
+
+    logger.info("Device Model indentified as: %s", product)
+    logger.info("Device OS-version (SHA256 HASH) indentified as: %s", device_os)
+
+    desired_os = IMAGE_MANIFEST.get(product)
+    if desired_os is None:
+        logger.error("Unsupported model - verify OS_info for supported models.")
+        return fail_device(netbox, serial, "unsupported_model", clear_tags=False), None
 
-    for tag in tags:
-        if str(tag) == "Upgrading":
+    for tag in netbox.get_device_tags(serial):
+        if str(tag) == "upgrading":
             logger.info("%s - Device is still upgrading.", serial)
-            return True
+            record_outcome("upgrading")
+            return True, None
+
+    if device_os.lower() == desired_os["hash"]:
+        logger.info("Device OS matches golden image hash - no upgrade required.")
+        return None, None
+
+    logger.warning("%s - OS Does NOT match", serial)
+    if desired_os["image"] is None:
+        logger.error("%s - No golden image for model %s in the OS manifest, cannot upgrade.", serial, product)
+        return fail_device(netbox, serial, "no_golden_image", clear_tags=False), None
+
+    netbox.update_device_tag(serial=serial, tags=[{"slug": "upgrading"}])
+    if job is not None:
+        job.update_phase("upgrade_queued")
+
+    return None, desired_os
+
+def upgrade_request(netbox, serial: str, host: str, desired_os: dict, job: Job = None) -> dict:
+    """
+    Returns UPGRADE_SCHEDULER.wait()/wait_async() arguments for upgrading serial
+    (connected via host) to desired_os.
+    """
+
+    return {"serial": serial,
+            "site": netbox.get_site_name(serial),
+            "host": host,
+            "image": desired_os["image"],
+            "size": desired_os["size"] or UPGRADE_IMAGE_SIZE,
+            "on_queued": lambda eta: _upgrade_queued(job, serial, eta),
+            "verify_peer": lambda peer: peer_image_matches(peer, desired_os["hash"])}
+
+def upgrade_started(job: Job, slot) -> None:
+    """
+    Records the download slot the job got.
+    """
+
+    if job is not None:
+        job.details["upgrade"] = {"source": slot.source, "peer": slot.peer, "waited": round(slot.waited, 1)}
+        job.update_phase("upgrading")
+
+def upgrade_downloaded(netbox, serial: str, desired_os: dict, downloaded_os: str) -> bool:
+    """
+    Ends serial's download - True if the image now on the device is the golden
+    one (serial is then tagged reloading), False (serial failed) otherwise.
+    """
 
-    if not bool(device_os == desired_os):
-        logger.warning("%s - OS Does NOT match", serial)
-        netbox.update_device_tag(serial=serial, tags=[{"slug": "upgrading"}])
-        conn.download_os_primary(desired_os["image"])
-        conn.get_device_version()
-        netbox.update_device_tag(serial=serial, tags=[{"slug": "reloading"}])
-        conn.reload_device()
+    if downloaded_os.lower() != desired_os["hash"]:
+        logger.error("%s - Downloaded OS (%s) does not match the golden image hash.", serial, downloaded_os)
+        UPGRADE_SCHEDULER.finish(serial, success=False)
+        return fail_device(netbox, serial, "image_mismatch")
+
+    UPGRADE_SCHEDULER.finish(serial, success=True)
+    netbox.update_device_tag(serial=serial, tags=[{"slug": "reloading"}])
+    return True
+
+def address_in_use(job: Job, serial: str, ip_address: str) -> bool:
+    """
+    Pre-check before configuring - True (outcome recorded) if serial's configured
+    IP already answers.
+    """
+
+    job.update_phase("precheck")
+    if device_already_active(serial, ip_address) is True:
+        record_outcome("already_active")
         return True
-    logger.info("Device OS matches golden image hash - no upgrade required.")
+
     return False
 
+def render_config(netbox, job: Job, serial: str, nb_device, os_slug: str, interfaces: list) -> None:
+    """
+    Renders serial's config and publishes it for the TFTP copy.
+    """
+
+    fallback_vlan = "30"
+    if nb_device.role == "Access-Industry":
+        fallback_vlan = "54"
+
+    radius_servers = local_radius_server(netbox=netbox, serial=serial)
+
+    job.update_phase("render")
+    data = {"hostname": nb_device.name,
+            "ip_address": nb_device.primary_ip,
+            "default_gw": ipaddress.ip_network(nb_device.primary_ip, strict=False)[1],
+            "fallback_vlan": fallback_vlan,
+            "interfaces": interfaces,
+            "radius_servers": radius_servers}
+
+    in_memory = publish_config(template=f"{os_slug}.j2", data=data, name=f"{serial}.conf")
+    logger.info("%s - Created %s %s.conf", serial, "in-memory config" if in_memory else "file", serial)
+
+def start_copy(netbox, job: Job, serial: str, nb_device) -> str:
+    """
+    Tags serial configuring before the config copy, returns the IP it will have.
+    """
+
+    job.update_phase("copy_config")
+    netbox.update_device_tag(serial=serial, tags=[{"slug": "configuring"}])
+
+    no_cidr_ip = nb_device.primary_ip.split("/", maxsplit=1)[0]
+    job.details["convergence"] = {"state": "copying", "device_ip": no_cidr_ip}
+
+    return no_cidr_ip
+
+def os_handler(conn, netbox, serial: str, job: Job = None):
+    """
+    Handling of OS verification and upgrade. Returns None if provisioning can go on,
+    otherwise the job result - True while the device upgrades, False if it can not.
+    """
+
+    result, desired_os = plan_upgrade(netbox, serial, conn.get_device_sn()[0]["product"], conn.get_device_version(), job)
+    if desired_os is None:
+        return result
+
+    try:
+        slot = UPGRADE_SCHEDULER.wait(**upgrade_request(netbox, serial, conn.host, desired_os, job))
+    except UpgradeQueueTimeout as exc:
+        return fail_device(netbox, serial, exc)
+    upgrade_started(job, slot)
+
+    try:
+        conn.download_os_primary(desired_os["image"], peer=slot.peer)
+        downloaded_os = conn.get_device_version()
+    except BaseException:
+        UPGRADE_SCHEDULER.finish(serial, success=False)
+        raise
+
+    if not upgrade_downloaded(netbox, serial, desired_os, downloaded_os):
+        return False
+
+    conn.reload_device()
+    record_outcome("upgraded")
+    return True
+
 def device_already_active(serial, ip_address):
     """
     Verifies whether device IP is already in use or not.
     """
 
     no_cidr_ip = ip_address.split("/", maxsplit=1)[0]
-    if ssh_test(no_cidr_ip) and icmp_test(no_cidr_ip) is not False:
+    with span("probe", "probe", ip=no_cidr_ip):
+        probe = PROBER.probe(no_cidr_ip)
+    if probe["tcp"] and probe["icmp"] is not False:
         logger.error("%s - Device IP %s is already active.", serial, no_cidr_ip)
         return True
     return False
@@ -417,78 +881,64 @@ def local_radius_server(netbox, serial):
 
 #     logger.info(conn.generate_api_key("faultfinder_api"))
 
-def main(device):
+def main(device, job=None):
     """
     Ties it all together.
     """
 
+    job, nb = begin_run(device, job)
+    conn = serial = None
+    trace_token = activate(job.trace)
+
     try:
+        job.update_phase("connecting")
         try:
+            expected_device = lease_device(nb, device.get("mac"))
             conn = DeviceConnector(host=device["ip"], device_type="Aruba")
-        except (BadDefaultCredentials, ScrapliConnectionError, UnsupportedOS) as exc:
-            logger.error(exc)
-            return None
-
-        nb = NetboxConnector(NETBOX, NB_API_TOKEN)
-
-        serial = conn.get_device_sn()[0]["serial"]
+        except (DeviceNotFound, BadDefaultCredentials, ScrapliConnectionError, UnsupportedOS) as exc:
+            return connect_failed(exc)
 
-        logger.info("Device Serial indentified as: %s", serial)
-
-        try:
-            nb.update_device_status(serial=serial, status="staged")
-            hostname = nb.get_device_name(serial)
-            ip_address = nb.get_primary_ip(serial)
-            device_role = nb.get_device_role(serial)
-
-        except DeviceNotFound as device_error:
-            logger.error(device_error)
+        serial = conn.serial
+        nb_device = lookup_device(nb, job, serial, expected_device)
+        if nb_device is None:
             return None
-        
-        logger.info("NetBox examined for device '%s' - found got following data:\nHostname: %s\nIP Address: %s\nDevice Role: %s", serial, hostname, ip_address, device_role)
 
-        if os_handler(conn=conn, netbox=nb, serial=serial) is True:
-            return None
+        job.update_phase("os_check")
+        upgrade = os_handler(conn=conn, netbox=nb, serial=serial, job=job)
+        if upgrade is not None:
+            return upgrade
 
+        job.update_phase("interfaces")
         interfaces = conn.get_interfaces_number()
 
-        if device_already_active(serial, ip_address) is True:
+        if address_in_use(job, serial, nb_device.primary_ip):
             return None
 
-        fallback_vlan = "30"
-        if device_role == "Access-Industry":
-            fallback_vlan = "54"
+        render_config(nb, job, serial, nb_device, conn.device_os["os_slug"], interfaces)
 
-        hostname = nb.get_device_name(serial)
-        radius_servers = local_radius_server(netbox=nb, serial=serial)
-
-        with open(f"/tftpboot/{serial}.conf", "w", encoding="utf-8") as file:
+        device_ip = start_copy(nb, job, serial, nb_device)
+        conn.copy_config(serial=serial, device_ip=device_ip, data_store="startup-config",
+                         hostname=nb_device.name, on_done=finalize_device(nb, job, serial))
+        # conn.copy_config(serial=serial, device_ip=device_ip, data_store="running-config")
+        job.converge()
+        return True
 
-            data = {"hostname": hostname,
-                    "ip_address": ip_address,
-                    "default_gw": ipaddress.ip_network(ip_address, strict=False)[1],
-                    "fallback_vlan": fallback_vlan,
-                    "interfaces": interfaces,
-                    "radius_servers": radius_servers}
+    except ConfigCopyFailed as exc:
+        return fail_device(nb, serial, exc)
 
-            logger.info("%s - Created file %s.conf", serial, serial)
-            file.write(render_template(template=f"{conn.device_os['os_slug']}.j2", data=data))
+    except (ScrapliConnectionNotOpened, ScrapliTimeout) as exc:
+        logger.error("%s - %s Connection to device was terminated before completion.", serial, device["ip"])
+        return fail_device(nb, serial, "timeout" if isinstance(exc, ScrapliTimeout) else "connection_lost")
 
-        nb.update_device_tag(serial=serial, tags=[{"slug": "configuring"}])
-        no_cidr_ip = ip_address.split("/", maxsplit=1)[0]
-        conn.copy_config(serial=serial, device_ip=no_cidr_ip, data_store="startup-config")
-        # conn.copy_config(serial=serial, device_ip=no_cidr_ip, data_store="running-config")
-        # nb.update_device_tag(serial=serial, tags=[])
-        return True
+    except ImageVerifyTimeout as exc:
+        logger.error(exc)
+        return fail_device(nb, serial, "timeout")
 
-    except (ScrapliConnectionNotOpened, ScrapliTimeout):
-        logger.error("%s - %s Connection to device was terminated before completion.", serial, device["ip"])
-        try:
-            nb.update_device_status(serial=serial, status="failed")
-            nb.update_device_tag(serial=serial, tags=[])
-        except UnboundLocalError:
-            logger.info("Device serial unknown, no Netbox update.")
-        return False
+    finally:
+        nb.flush()
+        if conn is not None:
+            job.details["command_cache"] = conn.commands.stats()
+        deactivate(trace_token)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+
+"""
+Post-config convergence verifier - follows devices in the background after the
+config copy was sent, until they answer on their configured IP.
+"""
+
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .probe_functions import PROBER
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    CONVERGE_DEADLINE = int(os.environ["CONVERGE_DEADLINE"])
+except KeyError:
+    CONVERGE_DEADLINE = 600
+
+try:
+    CONVERGE_POLL = float(os.environ["CONVERGE_POLL"])
+except KeyError:
+    CONVERGE_POLL = 5.0
+
+# Parallel SSH logins confirming hostnames.
+CONFIRM_WORKERS = 4
+
+class ConvergenceCheck:
+    """
+    One device converging onto its new config.
+
+    session_alive() and close() act on the provisioning session the copy was sent
+    over, confirm(device_ip, hostname) logs in to the device and verifies it runs
+    the new config, on_done(success, details) finalizes the device.
+    """
+
+    def __init__(self, serial: str, host: str, device_ip: str, hostname: str, session_alive, close, confirm, on_done, deadline: int = CONVERGE_DEADLINE) -> None:
+        """
+        Constructor.
+        """
+
+        self.serial = serial
+        self.host = host
+        self.device_ip = device_ip
+        self.hostname = hostname
+        self.session_alive = session_alive
+        self.close = close
+        self.confirm = confirm
+        self.on_done = on_done
+        self.started = time.monotonic()
+        self.deadline = self.started + deadline
+        self.state = "copying"
+        self.session_dropped = None
+        self.icmp = None
+        self.ssh = None
+        self.polls = 0
+
+    def elapsed(self) -> float:
+        """
+        Seconds since the copy was sent.
+        """
+
+        return time.monotonic() - self.started
+
+    def details(self) -> dict:
+        """
+        Returns check state for the job.
+        """
+
+        return {"state": self.state,
+                "device_ip": self.device_ip,
+                "elapsed": round(self.elapsed(), 1),
+                "session_dropped": None if self.session_dropped is None else round(self.session_dropped, 1),
+                "icmp": self.icmp,
+                "ssh": self.ssh,
+                "polls": self.polls}
+
+class ConvergenceVerifier:
+    """
+    One thread polling all converging devices - every poll interval the due devices
+    are probed together (ICMP + TCP/22). A device whose SSH is up gets its hostname
+    confirmed over a fresh session, then it is finalized. Devices that do not get
+    there before their deadline are finalized as failed.
+    """
+
+    def __init__(self, poll: float = CONVERGE_POLL, prober = PROBER, confirm_workers: int = CONFIRM_WORKERS) -> None:
+        """
+        Constructor - thread is started on first verify() (after gunicorn fork).
+        """
+
+        self.poll = poll
+        self.prober = prober
+        self.confirm_workers = confirm_workers
+        self._due = []
+        self._checks = set()
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = None
+        self._thread = None
+
+    def _start(self) -> None:
+        """
+        Starts verifier thread, if not running.
+        """
+
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.confirm_workers, thread_name_prefix="convergence-confirm")
+            self._thread = threading.Thread(target=self._run, name="convergence-verifier", daemon=True)
+            self._thread.start()
+
+    def verify(self, check: ConvergenceCheck) -> None:
+        """
+        Follows check in the background, from now on it owns the session.
+        """
+
+        self._start()
+        logger.info("%s - Verifying convergence on %s in the background (deadline %.0fs)", check.serial, check.device_ip, check.deadline - check.started)
+
+        with self._condition:
+            self._checks.add(check)
+            self._schedule(check, time.monotonic() + self.poll)
+
+    def _schedule(self, check: ConvergenceCheck, when: float) -> None:
+        """
+        Queues check's next poll (caller holds the condition).
+        """
+
+        heapq.heappush(self._due, (when, next(self._counter), check))
+        self._condition.notify()
+
+    def _reschedule(self, check: ConvergenceCheck) -> None:
+        """
+        Queues check's next poll, or fails it at the deadline.
+        """
+
+        if time.monotonic() >= check.deadline:
+            self._finish(check, False)
+            return
+
+        with self._condition:
+            self._schedule(check, min(time.monotonic() + self.poll, check.deadline))
+
+    def _finish(self, check: ConvergenceCheck, success: bool) -> None:
+        """
+        Closes the provisioning session and finalizes the device.
+        """
+
+        with self._condition:
+            self._checks.discard(check)
+
+        check.state = "converged" if success else "failed"
+        if success:
+            logger.info("%s - Converged on %s after %.1fs", check.serial, check.device_ip, check.elapsed())
+        else:
+            logger.error("%s - Did not converge on %s within deadline (ICMP: %s - SSH: %s)", check.serial, check.device_ip, check.icmp, check.ssh)
+
+        try:
+            check.close()
+        except Exception as exc: # pylint: disable=broad-exception-caught
+            logger.debug("%s - Closing provisioning session failed: %s", check.serial, exc)
+
+        try:
+            check.on_done(success, check.details())
+        except Exception: # pylint: disable=broad-exception-caught
+            logger.exception("%s - Finalizing device failed", check.serial)
+
+    def _confirm(self, check: ConvergenceCheck) -> None:
+        """
+        Confirms the hostname over SSH (executor thread).
+        """
+
+        try:
+            confirmed = check.confirm(check.device_ip, check.hostname)
+        except Exception as exc: # pylint: disable=broad-exception-caught
+            logger.debug("%s - Hostname check on %s failed: %s", check.serial, check.device_ip, exc)
+            confirmed = False
+
+        if confirmed:
+            self._finish(check, True)
+            return
+
+        check.state = "converging"
+        self._reschedule(check)
+
+    def _poll(self, checks: list) -> None:
+        """
+        Probes due checks together and advances them.
+        """
+
+        results = self.prober.probe_many([check.device_ip for check in checks], cache=False)
+
+        for check in checks:
+            check.polls += 1
+
+            if check.session_dropped is None:
+                try:
+                    alive = check.session_alive()
+                except Exception: # pylint: disable=broad-exception-caught
+                    alive = False
+                if not alive:
+                    check.session_dropped = check.elapsed()
+                    check.state = "converging"
+                    logger.info("%s - Provisioning session dropped after %.1fs", check.serial, check.session_dropped)
+
+            check.icmp = results[check.device_ip]["icmp"]
+            check.ssh = results[check.device_ip]["tcp"]
+
+            if check.ssh:
+                check.state = "confirming"
+                self._executor.submit(self._confirm, check)
+            else:
+                self._reschedule(check)
+
+    def _run(self) -> None:
+        """
+        Verifier loop.
+        """
+
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._condition.wait(timeout=None if not self._due else self._due[0][0] - time.monotonic())
+
+                checks = []
+                while self._due and self._due[0][0] <= time.monotonic():
+                    checks.append(heapq.heappop(self._due)[2])
+
+            try:
+                self._poll(checks)
+            except Exception: # pylint: disable=broad-exception-caught
+                logger.exception("Convergence poll failed")
+                for check in checks:
+                    self._reschedule(check)
+
+    def stats(self) -> dict:
+        """
+        Returns devices being verified.
+        """
+
+        with self._condition:
+            checks = sorted(self._checks, key=lambda check: check.started)
+
+        return {"verifying": len(checks),
+                "devices": [{"serial": check.serial, **check.details()} for check in checks]}
+
+CONVERGENCE_VERIFIER = ConvergenceVerifier()
+
+if __name__ == "__main__":
+
+    pass
@@ -5,79 +5,218 @@ Device Detection helpers.
 """
 
 import re
-import sys
 import logging
 from .exceptions import UnsupportedOS
 
 # pylint: disable=line-too-long
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout,
-                level=logging.INFO,
-                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-                )
+
+ANSI_REGEX = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+
+class OSRegistry:
+    """
+    Known device OSes. Signatures are precompiled and grouped by probe command,
+    so each distinct probe runs once per device and its output is matched
+    against every signature for that probe in one regex pass.
+    """
+
+    def __init__(self) -> None:
+        """
+        Constructor.
+        """
+
+        self.device_types = {}
+        self._signatures = {}
+        self._probes = {}
+        # Bumped on every register() - lets caches built from the registry notice new OSes.
+        self.version = 0
+
+    def register(self, name: str, commands: dict, signature: str = None) -> None:
+        """
+        Registers device OS name. signature (regex, default: name itself) is searched
+        for in the output of commands["version_command"].
+        """
+
+        probe = commands["version_command"]
+
+        self.device_types[name] = commands
+        self._signatures.setdefault(probe, {})[name] = signature if signature is not None else re.escape(name)
+
+        # One alternation per probe - group name tells which OS matched.
+        self._probes[probe] = (re.compile("|".join(f"(?P<os{number}>{pattern})" for number, pattern in enumerate(self._signatures[probe].values()))),
+                               list(self._signatures[probe]))
+        self.version += 1
+
+    def probes(self) -> list:
+        """
+        Returns the distinct probe commands.
+        """
+
+        return list(self._probes)
+
+    def match(self, probe: str, output: str) -> dict:
+        """
+        Returns device type whose signature is in probe output, None if none matched.
+        """
+
+        regex, names = self._probes[probe]
+        match = regex.search(output)
+
+        if match is None:
+            logger.debug("No known OS found in the '%s' output.", probe)
+            return None
+
+        return self.device_types[names[int(match.lastgroup[2:])]]
+
+    def get_by_slug(self, os_slug: str) -> dict:
+        """
+        Returns device type entry for os_slug (scrapli platform name).
+        """
+
+        for commands in self.device_types.values():
+            if commands.get("os_slug") == os_slug:
+                return commands
+
+        raise UnsupportedOS(host=os_slug)
+
+OS_REGISTRY = OSRegistry()
+
+def register_os(name: str, commands: dict, signature: str = None) -> None:
+    """
+    Registers a device OS for detection - see OSRegistry.register.
+    """
+
+    OS_REGISTRY.register(name, commands, signature=signature)
 
 class DeviceDetection:
     """
     Device Detection helpers.
     """
 
-    def __init__(self, conn):
+    def __init__(self, conn, registry: OSRegistry = OS_REGISTRY):
         """
         Constructor, make stuff available.
         """
 
-        self.device_types = {
-            "TEST": {
-                "version_command": "blah",
-                "configure_command": "blah",
-                "interfaces_command": "blah"   
-            },
-            "ArubaOS-CX": {
-                "os_slug": "aruba_aoscx",
-                "version_command": "show version",
-                "images_command": "show images",
-                "system_command": "show system",
-                "verify_os_regex": r"\bSHA-256\s+:\sVerifying\s([0-9]+%)\s+-",
-                "os_regex": r"\bSHA-256\s+:\s(.+)\b",
-                "download_os_command": [], #FIXME - Add command list.
-                "reload_command": [("boot system", "Do you want to save the current configuration (y/n)?"),("n", "Continue (y/n)?"),("y", "")],
-                "configure_command": "configure terminal",
-                "interfaces_command": "show interface",
-                "copy_config_command": "copy tftp://{tftp_server}/{serial}.conf {data_store}",
-                "tftp_success_command": "Copying configuration: [Success]",
-            }
-        }
+        self.registry = registry
+        self.device_types = registry.device_types
 
         self.conn = conn
 
-    def match_device_os(self, show_version_command: str, regex_filter: str) -> bool:
+    @staticmethod
+    def get_os_by_slug(os_slug: str) -> dict:
         """
-        Searches 'show version' command for supplied regex to find device OS.
+        Returns device type entry for os_slug (scrapli platform name).
         """
 
-        result = self.conn.send_command(show_version_command)
-
-        try:
-            if regex_filter in re.search(r"" + re.escape(regex_filter) + r"", result.result).group(0):
-                return True
-            return False
-        except AttributeError:
-            logger.debug("%s was not found in the '%s' output.", regex_filter, show_version_command)
-            return False
+        return OS_REGISTRY.get_by_slug(os_slug)
 
     def get_device_os(self) -> dict:
         """
-        Goes through known DEVICE_TYPES and run 'show version' equivalent to get device OS.
+        Runs each distinct probe command ('show version' equivalent) once and matches
+        its output against all known OS signatures.
         """
 
-        for device_os, commands in self.device_types.items():
+        for probe in self.registry.probes():
 
-            if self.match_device_os(commands["version_command"], device_os):
-                return self.device_types[device_os]
+            device_type = self.registry.match(probe, self.conn.send_command(probe).result)
+            if device_type is not None:
+                return device_type
 
         raise UnsupportedOS
 
+    async def get_device_os_async(self) -> dict:
+        """
+        Awaitable get_device_os() for AsyncScrapli connections.
+        """
+
+        for probe in self.registry.probes():
+
+            device_type = self.registry.match(probe, (await self.conn.send_command(probe)).result)
+            if device_type is not None:
+                return device_type
+
+        raise UnsupportedOS
+
+class LoginStateMachine:
+    """
+    Expect-style login - reacts to the login prompts declared for an OS in
+    the OS registry (register_os) as soon as they appear on the channel.
+    """
+
+    # Prompt -> what to send.
+    ANSWERS = {
+        "username": "username",
+        "password": "password",
+        "new_password": "password",
+        "confirm_password": "password",
+    }
+
+    def __init__(self, os_slug: str, prompt_pattern: str) -> None:
+        """
+        Constructor - compiles the prompt patterns for os_slug. prompt_pattern is the
+        driver's comms_prompt_pattern - seeing it means the CLI prompt is reached.
+        """
+
+        device_type = OS_REGISTRY.get_by_slug(os_slug)
+
+        self.prompts = [(name, re.compile(pattern, re.MULTILINE)) for name, pattern in device_type["login_prompts"].items()]
+        self.prompts.append(("logged_in", re.compile(prompt_pattern, re.MULTILINE | re.IGNORECASE)))
+        self.deadline = device_type["login_deadline"]
+        self.buffer = ""
+
+    def feed(self, output) -> str:
+        """
+        Adds channel output, returns the prompt now waiting for input (or 'logged_in'),
+        None if no complete prompt has been seen yet.
+        """
+
+        if isinstance(output, bytes):
+            output = output.decode("utf-8", "replace")
+        output = ANSI_REGEX.sub("", output)
+        self.buffer = (self.buffer + output)[-4096:]
+
+        tail = self.buffer.rstrip("\x00").splitlines()[-1:] or [""]
+        for name, pattern in self.prompts:
+            if pattern.search(tail[0]):
+                self.buffer = ""
+                return name
+
+        return None
+
+    def answer(self, prompt: str, username: str, password: str) -> str:
+        """
+        Returns what to write for prompt.
+        """
+
+        return username if self.ANSWERS[prompt] == "username" else password
+
+register_os("ArubaOS-CX", {
+    "os_slug": "aruba_aoscx",
+    "version_command": "show version",
+    "images_command": "show images",
+    "system_command": "show system",
+    "verify_os_regex": r"\bSHA-256\s+:\sVerifying\s([0-9]+%)\s+-",
+    "os_regex": r"\bSHA-256\s+:\s(.+)\b",
+    "download_os_command": [], #FIXME - Add command list.
+    "reload_command": [("boot system", "Do you want to save the current configuration (y/n)?"),("n", "Continue (y/n)?"),("y", "")],
+    "configure_command": "configure terminal",
+    "interfaces_command": "show interface",
+    "hostname_command": "show hostname",
+    "copy_config_command": "copy tftp://{tftp_server}/{serial}.conf {data_store}",
+    "tftp_success_command": "Copying configuration: [Success]",
+    "tftp_error_outputs": ["Copying configuration: [Failed]", "% Error", "Invalid input"],
+    # First-boot login, answered as soon as each prompt shows up (see LoginStateMachine).
+    "login_prompts": {
+        "new_password": r"Enter new password:\s*$",
+        "confirm_password": r"Confirm new password:\s*$",
+        "password": r"[Pp]assword:\s*$",
+        "username": r"[Ll]ogin:\s*$",
+    },
+    "login_deadline": 60,
+})
+
 if __name__ == "__main__":
 
     pass
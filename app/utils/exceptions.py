@@ -33,3 +33,42 @@ class BadDefaultCredentials(Exception):
         self.serial = host
         self.message = f"{host} - {message}"
         super().__init__(self.message)
+
+class JobQueueFull(Exception):
+    "Raised when the provisioning job queue is full"
+    def __init__(self, size: int, message: str = "Provisioning job queue is full") -> None:
+        self.size = size
+        self.message = f"{message} ({size} jobs queued)"
+        super().__init__(self.message)
+
+class ConnectSchedulerFull(Exception):
+    "Raised when the connect scheduler has the most devices waiting for SSH it may park"
+    def __init__(self, size: int, message: str = "Too many devices waiting for SSH") -> None:
+        self.size = size
+        self.message = f"{message} ({size} parked)"
+        super().__init__(self.message)
+
+class ImageVerifyTimeout(Exception):
+    "Raised when on-device OS image verification did not finish in time"
+    def __init__(self, host: str, deadline: int, percent: float = None, message: str = "OS image verification did not finish within") -> None:
+        self.host = host
+        self.deadline = deadline
+        self.percent = percent
+        self.message = f"{host} - {message} {deadline}s (last seen at {percent}%)"
+        super().__init__(self.message)
+
+class ConfigCopyFailed(Exception):
+    "Raised when the device reported an error copying its config, or no success in time"
+    def __init__(self, host: str, output: str, message: str = "Config copy failed") -> None:
+        self.host = host
+        self.output = output
+        self.message = f"{host} - {message}: {output.strip()[-200:]}"
+        super().__init__(self.message)
+
+class UpgradeQueueTimeout(Exception):
+    "Raised when a device waited too long for an OS download slot"
+    def __init__(self, serial: str, deadline: int, message: str = "No OS download slot within") -> None:
+        self.serial = serial
+        self.deadline = deadline
+        self.message = f"{serial} - {message} {deadline}s"
+        super().__init__(self.message)
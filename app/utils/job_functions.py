@@ -0,0 +1,693 @@
+#!/usr/bin/python3
+
+"""
+Provisioning job queue and job status store.
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import logging
+import cProfile
+import threading
+from contextlib import closing
+from .exceptions import JobQueueFull, ConnectSchedulerFull
+from .metrics_functions import PHASE_SECONDS, JOBS_INFLIGHT
+from .trace_functions import Trace, profile_report
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    JOB_WORKERS = int(os.environ["JOB_WORKERS"])
+except KeyError:
+    JOB_WORKERS = 4
+
+try:
+    JOB_QUEUE_SIZE = int(os.environ["JOB_QUEUE_SIZE"])
+except KeyError:
+    JOB_QUEUE_SIZE = 100
+
+try:
+    JOB_HISTORY = int(os.environ["JOB_HISTORY"])
+except KeyError:
+    JOB_HISTORY = 500
+
+try:
+    JOB_DB = os.environ["JOB_DB"]
+except KeyError:
+    JOB_DB = "/tmp/dhcp_provision_jobs.sqlite"
+
+try:
+    INFLIGHT_TTL = int(os.environ["INFLIGHT_TTL"])
+except KeyError:
+    INFLIGHT_TTL = 1800
+
+def dedup_key(device: dict) -> str:
+    """
+    Returns in-flight key for a lease - MAC, falling back to IP.
+    """
+
+    if device.get("mac"):
+        return "mac:" + device["mac"].lower().replace("-", ":")
+    return f"ip:{device.get('ip')}"
+
+def pid_alive(pid: int) -> bool:
+    """
+    Verifies whether process (gunicorn worker) is still running.
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobStore:
+    """
+    Job status and in-flight tables shared by all gunicorn workers (SQLite file).
+    """
+
+    def __init__(self, path: str = JOB_DB, history: int = JOB_HISTORY, inflight_ttl: int = INFLIGHT_TTL) -> None:
+        """
+        Constructor - creates the tables if missing.
+        """
+
+        self.path = path
+        self.history = history
+        self.inflight_ttl = inflight_ttl
+
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            job_id TEXT PRIMARY KEY,
+                            pid INTEGER,
+                            status TEXT,
+                            phase TEXT,
+                            device TEXT,
+                            result TEXT,
+                            error TEXT,
+                            created REAL,
+                            started REAL,
+                            finished REAL,
+                            coalesced INTEGER DEFAULT 0,
+                            details TEXT)""")
+            # Tables created by older releases.
+            columns = [row["name"] for row in db.execute("PRAGMA table_info(jobs)")]
+            if "details" not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN details TEXT")
+            db.execute("""CREATE TABLE IF NOT EXISTS inflight (
+                            dedup_key TEXT PRIMARY KEY,
+                            job_id TEXT,
+                            pid INTEGER,
+                            created REAL)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS traces (
+                            job_id TEXT PRIMARY KEY,
+                            trace TEXT)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS settings (
+                            key TEXT PRIMARY KEY,
+                            value INTEGER)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS workers (
+                            pid INTEGER PRIMARY KEY,
+                            workers INTEGER,
+                            busy INTEGER,
+                            queue_depth INTEGER,
+                            queue_size INTEGER,
+                            updated REAL)""")
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        New connection per operation - safe across threads and forks.
+        """
+
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def save(self, job) -> None:
+        """
+        Insert or update job row.
+        """
+
+        row = job.as_dict()
+
+        with closing(self._connect()) as db:
+            db.execute("INSERT INTO jobs (job_id, pid, status, phase, device, result, error, created, started, finished, details) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(job_id) DO UPDATE SET "
+                       "status = excluded.status, phase = excluded.phase, result = excluded.result, "
+                       "error = excluded.error, started = excluded.started, finished = excluded.finished, "
+                       "details = excluded.details",
+                       (row["job_id"], row["pid"], row["status"], row["phase"], json.dumps(row["device"]),
+                        json.dumps(row["result"]), row["error"], row["created"], row["started"], row["finished"],
+                        json.dumps(row["details"])))
+
+            if row["finished"] is not None:
+                db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND job_id NOT IN "
+                           "(SELECT job_id FROM jobs WHERE finished IS NOT NULL ORDER BY finished DESC LIMIT ?)",
+                           (self.history,))
+                db.execute("DELETE FROM traces WHERE job_id NOT IN (SELECT job_id FROM jobs)")
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row) -> dict:
+        """
+        Decodes a jobs row.
+        """
+
+        job = dict(row)
+        job["device"] = json.loads(job["device"])
+        job["result"] = json.loads(job["result"])
+        job["details"] = json.loads(job["details"]) if job["details"] is not None else {}
+
+        return job
+
+    def get(self, job_id: str) -> dict:
+        """
+        Returns job as dict, None if unknown.
+        """
+
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+        if row is None:
+            return None
+        return self._row_to_dict(row)
+
+    def save_trace(self, job_id: str, trace: dict) -> None:
+        """
+        Insert or update trace of job_id.
+        """
+
+        with closing(self._connect()) as db:
+            db.execute("INSERT OR REPLACE INTO traces VALUES (?, ?)", (job_id, json.dumps(trace)))
+
+    def get_trace(self, job_id: str) -> dict:
+        """
+        Returns trace of job_id, None if unknown.
+        """
+
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT trace FROM traces WHERE job_id = ?", (job_id,)).fetchone()
+
+        if row is None:
+            return None
+        return json.loads(row["trace"])
+
+    def arm_profiling(self, jobs: int) -> None:
+        """
+        Profiles the next jobs started on any gunicorn worker (0 turns it off).
+        """
+
+        with closing(self._connect()) as db:
+            db.execute("INSERT OR REPLACE INTO settings VALUES ('profile_jobs', ?)", (max(0, jobs),))
+
+    def profiling_armed(self) -> int:
+        """
+        Returns number of jobs still to be profiled.
+        """
+
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT value FROM settings WHERE key = 'profile_jobs'").fetchone()
+
+        return row["value"] if row is not None else 0
+
+    def take_profiling(self) -> bool:
+        """
+        Claims one of the armed profiling runs, False if none left.
+        """
+
+        with closing(self._connect()) as db:
+            cursor = db.execute("UPDATE settings SET value = value - 1 WHERE key = 'profile_jobs' AND value > 0")
+
+        return cursor.rowcount == 1
+
+    def recent(self, limit: int = 50) -> list:
+        """
+        Returns the most recently created jobs.
+        """
+
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+
+        return [self._row_to_dict(row) for row in rows]
+
+    def claim(self, key: str, job_id: str) -> str:
+        """
+        Registers job_id as in-flight for key. Returns the job_id already running
+        for key instead, if any (the new event is then coalesced onto it).
+        """
+
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT job_id, pid, created FROM inflight WHERE dedup_key = ?", (key,)).fetchone()
+
+                if row is not None and pid_alive(row["pid"]) and time.time() - row["created"] < self.inflight_ttl:
+                    db.execute("UPDATE jobs SET coalesced = coalesced + 1 WHERE job_id = ?", (row["job_id"],))
+                    db.execute("COMMIT")
+                    return row["job_id"]
+
+                db.execute("INSERT OR REPLACE INTO inflight VALUES (?, ?, ?, ?)", (key, job_id, os.getpid(), time.time()))
+                db.execute("COMMIT")
+                return None
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+
+    def release(self, key: str, job_id: str) -> None:
+        """
+        Removes in-flight entry for key, if still owned by job_id.
+        """
+
+        with closing(self._connect()) as db:
+            db.execute("DELETE FROM inflight WHERE dedup_key = ? AND job_id = ?", (key, job_id))
+
+    def inflight(self) -> list:
+        """
+        Returns in-flight keys with their job.
+        """
+
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT * FROM inflight ORDER BY created").fetchall()
+
+        return [dict(row) for row in rows]
+
+    def count_by_status(self) -> dict:
+        """
+        Returns number of jobs per status.
+        """
+
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+
+        return {status: count for status, count in rows}
+
+    def report_worker(self, workers: int, busy: int, queue_depth: int, queue_size: int) -> None:
+        """
+        Records the job queue load of this process (gunicorn worker).
+        """
+
+        with closing(self._connect()) as db:
+            db.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?, ?)",
+                       (os.getpid(), workers, busy, queue_depth, queue_size, time.time()))
+
+    def worker_totals(self) -> dict:
+        """
+        Returns the job queue load summed over the live gunicorn workers, and per pid.
+        """
+
+        with closing(self._connect()) as db:
+            rows = [dict(row) for row in db.execute("SELECT * FROM workers ORDER BY pid")]
+
+        processes = [row for row in rows if pid_alive(row["pid"])]
+
+        return {"workers": sum(row["workers"] for row in processes),
+                "busy_workers": sum(row["busy"] for row in processes),
+                "queue_depth": sum(row["queue_depth"] for row in processes),
+                "queue_size": sum(row["queue_size"] for row in processes),
+                "processes": processes}
+
+    def reap(self) -> int:
+        """
+        Fails the unfinished jobs of gunicorn workers that are gone (killed, restarted)
+        and drops their in-flight claims and load rows. Returns number of jobs failed.
+        """
+
+        with closing(self._connect()) as db:
+            pids = {row["pid"] for row in db.execute("SELECT DISTINCT pid FROM jobs WHERE finished IS NULL "
+                                                     "UNION SELECT pid FROM inflight UNION SELECT pid FROM workers")}
+            dead = [pid for pid in pids if pid != os.getpid() and not pid_alive(pid)]
+
+            reaped = 0
+            for pid in dead:
+                cursor = db.execute("UPDATE jobs SET status = 'failed', phase = 'done', error = ?, finished = ? "
+                                    "WHERE pid = ? AND finished IS NULL",
+                                    (f"Worker process {pid} exited before the job finished", time.time(), pid))
+                reaped += cursor.rowcount
+                db.execute("DELETE FROM inflight WHERE pid = ?", (pid,))
+                db.execute("DELETE FROM workers WHERE pid = ?", (pid,))
+
+        if reaped:
+            logger.warning("Marked %s job(s) of exited worker process(es) %s as failed", reaped, dead)
+
+        return reaped
+
+class Job:
+    """
+    A single provisioning run for one DHCP lease.
+    """
+
+    def __init__(self, device: dict, store: JobStore = None) -> None:
+        """
+        Constructor - job starts out queued.
+        """
+
+        self.job_id = uuid.uuid4().hex
+        self.device = device
+        self.dedup_key = dedup_key(device)
+        self.store = store
+        self.status = "queued"
+        self.phase = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.details = {}
+        self.trace = Trace(self.job_id)
+        self._phase_started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _save(self) -> None:
+        """
+        Persists job to store, if any.
+        """
+
+        if self.store is not None:
+            self.store.save(self)
+
+    def update_phase(self, phase: str) -> None:
+        """
+        Called by main() as provisioning progresses.
+        """
+
+        logger.debug("Job %s - phase %s", self.job_id, phase)
+        self._observe_phase(phase)
+        self.phase = phase
+        self._save()
+
+    def _observe_phase(self, phase: str) -> None:
+        """
+        Records time spent in the current phase when moving on to phase.
+        """
+
+        if phase == self.phase:
+            return
+
+        now = time.perf_counter()
+        PHASE_SECONDS.labels(self.phase).observe(now - self._phase_started)
+        self.trace.add(self.phase, "phase", self._phase_started, now)
+        self._phase_started = now
+
+    def update_details(self, **details) -> None:
+        """
+        Merges details - also after the job finished (background follow-up).
+        """
+
+        self.details.update(details)
+        self._save()
+
+    def start(self) -> None:
+        """
+        Marks job as running.
+        """
+
+        self.status = "running"
+        self.started = time.time()
+        JOBS_INFLIGHT.inc()
+        self._save()
+
+    def converge(self) -> None:
+        """
+        Marks job as converging - the config copy was handed to the convergence
+        verifier, whose callback finishes the job. Its worker is free again, the
+        in-flight claim is kept. No-op if the callback already finished it.
+        """
+
+        with self._lock:
+            if self.finished is not None:
+                return
+            if self.status == "running":
+                JOBS_INFLIGHT.dec()
+            self.status = "converging"
+            self._observe_phase("converging")
+            self.phase = "converging"
+            self._save()
+
+    def finish(self, result=None, error: str = None) -> None:
+        """
+        Marks job as done, with result or error - a False/None result is a failed run.
+        Only the first call counts.
+        """
+
+        with self._lock:
+            if self.finished is not None:
+                return
+            if self.status == "running":
+                JOBS_INFLIGHT.dec()
+
+            self.status = "failed" if error is not None or result is None or result is False else "finished"
+            self._observe_phase("done")
+            self.phase = "done"
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+            self._save()
+        self.save_trace()
+
+        if self.store is not None:
+            self.store.release(self.dedup_key, self.job_id)
+
+    def save_trace(self) -> None:
+        """
+        Persists trace to store, if any - again for spans added after finish().
+        """
+
+        if self.store is not None:
+            self.store.save_trace(self.job_id, self.trace.as_dict())
+
+    def as_dict(self) -> dict:
+        """
+        Returns job as dict.
+        """
+
+        return {"job_id": self.job_id,
+                "pid": os.getpid(),
+                "status": self.status,
+                "phase": self.phase,
+                "device": self.device,
+                "result": self.result,
+                "error": self.error,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished,
+                "details": self.details}
+
+class JobQueue:
+    """
+    Bounded in-process worker pool running provisioning jobs.
+    """
+
+    def __init__(self, target, workers: int = JOB_WORKERS, maxsize: int = JOB_QUEUE_SIZE, store: JobStore = None, scheduler = None, engine = None) -> None:
+        """
+        Constructor - worker threads are started on first submit (after gunicorn fork).
+        With a ConnectScheduler, jobs are parked until the device accepts SSH before
+        they take a worker. With an AsyncEngine, jobs run on its event loop instead
+        of the worker threads.
+        """
+
+        self.target = target
+        self.scheduler = scheduler
+        self.engine = engine
+        self.workers = workers
+        self.store = store if store is not None else JobStore()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._started = False
+        self._busy = 0
+        self._lock = threading.Lock()
+
+    def _report(self) -> None:
+        """
+        Publishes this process' queue load to the shared store (see stats()).
+        """
+
+        if self.engine is not None:
+            engine = self.engine.stats()
+            self.store.report_worker(self.workers, engine["running"], engine["pending"], self._queue.maxsize)
+        else:
+            self.store.report_worker(self.workers, self._busy, self._queue.qsize(), self._queue.maxsize)
+
+    def _full(self) -> bool:
+        """
+        True if no more jobs are accepted. With the async engine its pending runs and
+        the devices parked on their way to it count against maxsize.
+        """
+
+        if self.engine is None:
+            return self._queue.full()
+
+        parked = self.scheduler.waiting() if self.scheduler is not None else 0
+        return self.engine.stats()["pending"] + parked >= self._queue.maxsize
+
+    def _start(self) -> None:
+        """
+        Starts worker threads if not running - first fails the jobs left behind by
+        worker processes that are gone.
+        """
+
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self.store.reap()
+            self._report()
+            if self.engine is not None:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{number}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker(self) -> None:
+        """
+        Worker loop - runs target for every queued job.
+        """
+
+        while True:
+            job = self._queue.get()
+
+            with self._lock:
+                self._busy += 1
+            self._report()
+
+            profiler = cProfile.Profile() if self.store.take_profiling() else None
+
+            job.start()
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    result = self.target(job.device, job=job)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+                        job.trace.profile = profile_report(profiler)
+                # A converging job is finished by the convergence verifier.
+                if job.status != "converging":
+                    job.finish(result=result)
+            except Exception as exc: # pylint: disable=broad-exception-caught
+                logger.exception("Job %s - unhandled error", job.job_id)
+                job.finish(error=str(exc))
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                self._queue.task_done()
+                self._report()
+
+    def submit(self, device: dict) -> dict:
+        """
+        Queues a provisioning job for device. Repeated leases for a device with a
+        job in flight (on any gunicorn worker) are coalesced onto that job.
+        """
+
+        self._start()
+
+        job = Job(device, store=self.store)
+
+        running_job_id = self.store.claim(job.dedup_key, job.job_id)
+        if running_job_id is not None:
+            logger.info("%s - Provisioning already in flight (job %s), lease coalesced.", job.dedup_key, running_job_id)
+            return {"job_id": running_job_id, "status": "coalesced"}
+
+        if self._full():
+            error = JobQueueFull(self._queue.maxsize)
+            job.finish(error=str(error))
+            raise error
+
+        if self.scheduler is None:
+            job.update_phase("queued")
+            self._enqueue(job)
+            return {"job_id": job.job_id, "status": "queued"}
+
+        job.update_phase("waiting_for_ssh")
+        try:
+            self.scheduler.park(device["ip"],
+                                on_ready=lambda: self._enqueue(job),
+                                on_timeout=lambda: job.finish(error=f"{device['ip']} - SSH not reachable before connect deadline"))
+        except ConnectSchedulerFull as error:
+            job.finish(error=str(error))
+            raise
+        logger.info("Job %s - waiting for %s to accept SSH", job.job_id, device["ip"])
+
+        return {"job_id": job.job_id, "status": "queued"}
+
+    def _enqueue(self, job: Job) -> None:
+        """
+        Hands job to the worker threads (or the async engine).
+        """
+
+        if self.engine is not None:
+            job.start()
+            self.engine.submit(job.device, job=job).add_done_callback(lambda future: self._finish_async(job, future))
+            self._report()
+            return
+
+        # Before the put - a worker may finish the job before put_nowait returns.
+        job.update_phase("queued")
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            job.finish(error=str(JobQueueFull(self._queue.maxsize)))
+            return
+
+        self._report()
+        logger.info("Job %s - queued for %s (queue depth %s)", job.job_id, job.device, self._queue.qsize())
+
+    def _finish_async(self, job: Job, future) -> None:
+        """
+        Records result of a job run on the async engine.
+        """
+
+        self._report()
+
+        exc = future.exception()
+        if exc is not None:
+            logger.error("Job %s - unhandled error: %s", job.job_id, exc)
+            job.finish(error=str(exc))
+        elif job.status != "converging":
+            job.finish(result=future.result())
+
+    def get(self, job_id: str) -> dict:
+        """
+        Returns job status from the shared store.
+        """
+
+        return self.store.get(job_id)
+
+    def get_trace(self, job_id: str) -> dict:
+        """
+        Returns job trace (and profile, if captured) from the shared store.
+        """
+
+        return self.store.get_trace(job_id)
+
+    def stats(self) -> dict:
+        """
+        Returns queue depth and job counters - summed over all gunicorn workers, like
+        the job counts.
+        """
+
+        self.store.reap()
+        totals = self.store.worker_totals()
+
+        return {"pid": os.getpid(),
+                "workers": totals["workers"],
+                "busy_workers": totals["busy_workers"],
+                "queue_depth": totals["queue_depth"],
+                "queue_size": totals["queue_size"],
+                "processes": totals["processes"],
+                "jobs_by_status": self.store.count_by_status(),
+                "profile_jobs": self.store.profiling_armed(),
+                "inflight": self.store.inflight(),
+                "connect_scheduler": self.scheduler.stats() if self.scheduler is not None else None,
+                "async_engine": self.engine.stats() if self.engine is not None else None}
+
+if __name__ == "__main__":
+
+    pass
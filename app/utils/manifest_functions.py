@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+
+"""
+Golden image manifest - product model to desired OS image, cached in memory.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import pynetbox
+from .os_download_functions import SFTPConnector
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    OS_MANIFEST = os.environ["OS_MANIFEST"]
+except KeyError:
+    OS_MANIFEST = None
+
+try:
+    MANIFEST_CHECK_INTERVAL = int(os.environ["MANIFEST_CHECK_INTERVAL"])
+except KeyError:
+    MANIFEST_CHECK_INTERVAL = 60
+
+# Used without OS_MANIFEST - the golden image hash every model was checked against
+# before the manifest existed. It has no image, so mismatches cannot be upgraded.
+DEFAULT_MANIFEST = {"*": {"hash": "468450af91ffd58ccafc700e72767a6be81fcbc1ce9fb43c1c74f700272c937f", "image": None}}
+
+# NetBox device type custom fields holding the golden image.
+NB_IMAGE_FIELD = "golden_image"
+NB_HASH_FIELD = "golden_image_hash"
+NB_SIZE_FIELD = "golden_image_size"
+
+def _entries(manifest: dict) -> dict:
+    """
+    Validates a manifest ({product: {"hash", "image", "size"}}), returns it.
+    """
+
+    entries = {}
+    for product, entry in manifest.items():
+        if not isinstance(entry, dict) or not entry.get("hash"):
+            logger.warning("Ignoring manifest entry for '%s' without hash", product)
+            continue
+        entries[product] = {"hash": entry["hash"].lower(), "image": entry.get("image"), "size": entry.get("size")}
+
+    return entries
+
+class StaticManifestSource:
+    """
+    Fixed manifest (DEFAULT_MANIFEST).
+    """
+
+    def __init__(self, manifest: dict) -> None:
+        """
+        Constructor.
+        """
+
+        self.manifest = manifest
+
+    def fingerprint(self) -> str:
+        """
+        Never changes.
+        """
+
+        return "static"
+
+    def load(self) -> dict:
+        """
+        Returns the manifest.
+        """
+
+        return self.manifest
+
+class FileManifestSource:
+    """
+    JSON manifest in a local file, reloaded when its mtime or size change.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Constructor.
+        """
+
+        self.path = path
+
+    def fingerprint(self) -> str:
+        """
+        Returns mtime and size of the file.
+        """
+
+        stat = os.stat(self.path)
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    def load(self) -> dict:
+        """
+        Reads the manifest.
+        """
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+class SFTPManifestSource:
+    """
+    JSON manifest on the SFTP server - one SSH session per check, the file is only
+    read when its SHA-256 changed.
+    """
+
+    def __init__(self, path: str, host: str, user: str, password: str) -> None:
+        """
+        Constructor.
+        """
+
+        self.path = path
+        self.host = host
+        self.user = user
+        self.password = password
+        self._pending = None
+
+    def fingerprint(self) -> str:
+        """
+        Returns SHA-256 of the remote file, keeps the session for load().
+        """
+
+        sftp = SFTPConnector(self.host, self.user, self.password)
+        fingerprint = sftp.file_hash(self.path)
+        self._pending = sftp
+
+        return fingerprint
+
+    def load(self) -> dict:
+        """
+        Reads the manifest over the session opened by fingerprint().
+        """
+
+        sftp, self._pending = self._pending, None
+        if sftp is None:
+            sftp = SFTPConnector(self.host, self.user, self.password)
+
+        try:
+            return sftp.load_os_json(self.path)
+        finally:
+            sftp.close()
+
+    def done(self) -> None:
+        """
+        Closes a session left open by an unchanged fingerprint().
+        """
+
+        if self._pending is not None:
+            self._pending.close()
+            self._pending = None
+
+class NetboxManifestSource:
+    """
+    Golden images from NetBox device type custom fields (golden_image,
+    golden_image_hash, golden_image_size), keyed by part number.
+    """
+
+    def __init__(self, host: str, token: str) -> None:
+        """
+        Constructor.
+        """
+
+        self.netbox = pynetbox.api(url=f"http://{host}", token=token)
+        self._device_types = None
+
+    def fingerprint(self) -> str:
+        """
+        Returns a hash over the device types' golden image fields.
+        """
+
+        self._device_types = list(self.netbox.dcim.device_types.all())
+
+        digest = hashlib.sha256()
+        for device_type in self._device_types:
+            fields = device_type.custom_fields or {}
+            digest.update(json.dumps([device_type.part_number, device_type.model, fields.get(NB_HASH_FIELD), fields.get(NB_IMAGE_FIELD), fields.get(NB_SIZE_FIELD)]).encode("utf-8"))
+
+        return digest.hexdigest()
+
+    def load(self) -> dict:
+        """
+        Builds the manifest from the device types fetched by fingerprint().
+        """
+
+        manifest = {}
+        for device_type in self._device_types or []:
+            fields = device_type.custom_fields or {}
+            if not fields.get(NB_HASH_FIELD):
+                continue
+            entry = {"hash": fields[NB_HASH_FIELD], "image": fields.get(NB_IMAGE_FIELD), "size": fields.get(NB_SIZE_FIELD)}
+            manifest[device_type.part_number or device_type.model] = entry
+
+        return manifest
+
+def manifest_source(spec: str, netbox: tuple = None, sftp: tuple = None):
+    """
+    Returns source for OS_MANIFEST - 'file:<path>', 'sftp:<path>' or 'netbox'.
+    netbox is (host, token), sftp (host, user, password).
+    """
+
+    if spec is None:
+        return StaticManifestSource(DEFAULT_MANIFEST)
+    if spec.startswith("file:"):
+        return FileManifestSource(spec[5:])
+    if spec.startswith("sftp:"):
+        return SFTPManifestSource(spec[5:], *sftp)
+    if spec == "netbox":
+        return NetboxManifestSource(*netbox)
+
+    raise ValueError(f"Unknown OS_MANIFEST source '{spec}'")
+
+class ImageManifest:
+    """
+    Product model -> golden image, held in memory. The source is checked at most
+    every check_interval seconds and only reloaded when its fingerprint (mtime,
+    hash) changed, so an OS check is a dict lookup.
+    """
+
+    def __init__(self, source, check_interval: int = MANIFEST_CHECK_INTERVAL) -> None:
+        """
+        Constructor - manifest is loaded on first use.
+        """
+
+        self.source = source
+        self.check_interval = check_interval
+        self.entries = {}
+        self.fingerprint = None
+        self.loaded = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Reloads the manifest if the source changed. Returns True if it was reloaded.
+        """
+
+        with self._lock:
+            if not force and time.monotonic() - self._checked < self.check_interval:
+                return False
+            self._checked = time.monotonic()
+
+            try:
+                fingerprint = self.source.fingerprint()
+                if fingerprint == self.fingerprint and not force:
+                    return False
+
+                self.entries = _entries(self.source.load())
+            except Exception as exc: # pylint: disable=broad-exception-caught
+                # Keep serving the last good manifest.
+                logger.error("Could not load OS manifest: %s", exc)
+                return False
+            finally:
+                if hasattr(self.source, "done"):
+                    self.source.done()
+
+            self.fingerprint = fingerprint
+            self.loaded = time.time()
+
+        logger.info("OS manifest loaded - %s model(s)", len(self.entries))
+        return True
+
+    def get(self, product: str) -> dict:
+        """
+        Returns {"hash", "image", "size"} for product ('*' entry as fallback), None if
+        the model is not in the manifest.
+        """
+
+        self.refresh()
+
+        return self.entries.get(product, self.entries.get("*"))
+
+    def stats(self) -> dict:
+        """
+        Returns manifest size and when it was loaded.
+        """
+
+        return {"models": len(self.entries), "loaded": self.loaded, "fingerprint": self.fingerprint}
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+"""
+Prometheus metrics - aggregated across gunicorn workers in multiprocess mode
+(PROMETHEUS_MULTIPROC_DIR, set up in gunicorn.conf.py).
+"""
+
+import os
+import re
+import logging
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+# Phases range from sub-second (render) to many minutes (OS upgrade, waiting for SSH).
+PHASE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+CALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PHASE_SECONDS = Histogram("provision_phase_seconds", "Time spent per provisioning phase", ["phase"], buckets=PHASE_BUCKETS)
+OUTCOMES = Counter("provision_outcomes_total", "Provisioning runs per outcome", ["outcome"])
+JOBS_INFLIGHT = Gauge("provision_jobs_inflight", "Provisioning jobs running", multiprocess_mode="livesum")
+NETBOX_SECONDS = Histogram("netbox_api_seconds", "NetBox API call latency", ["call"], buckets=CALL_BUCKETS)
+SSH_COMMAND_SECONDS = Histogram("ssh_command_seconds", "Device command latency", ["command"], buckets=CALL_BUCKETS)
+
+def record_outcome(outcome) -> None:
+    """
+    Counts a provisioning run ending with outcome - a name, or the exception that
+    ended it (DeviceNotFound counts as 'device_not_found').
+    """
+
+    if isinstance(outcome, BaseException):
+        outcome = re.sub(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])", "_", type(outcome).__name__).lower()
+
+    OUTCOMES.labels(outcome).inc()
+
+def render_metrics() -> tuple:
+    """
+    Returns (body, content type) for /metrics - all workers' metrics in multiprocess
+    mode, this process' otherwise.
+    """
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+if __name__ == "__main__":
+
+    pass
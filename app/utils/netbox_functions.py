@@ -4,8 +4,664 @@
 Class/functions to help interact with Netbox
 """
 
+import os
+import copy
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from contextlib import closing
 import pynetbox
 from .exceptions import DeviceNotFound
+from .job_functions import JOB_DB, pid_alive
+from .metrics_functions import NETBOX_SECONDS
+from .trace_functions import span
+
+logger = logging.getLogger(__name__)
+
+try:
+    NB_CACHE_TTL = int(os.environ["NB_CACHE_TTL"])
+except KeyError:
+    NB_CACHE_TTL = 60
+
+try:
+    NB_CACHE_SIZE = int(os.environ["NB_CACHE_SIZE"])
+except KeyError:
+    NB_CACHE_SIZE = 256
+
+try:
+    NB_INDEX_REFRESH = int(os.environ["NB_INDEX_REFRESH"])
+except KeyError:
+    NB_INDEX_REFRESH = 30
+
+try:
+    NB_INDEX_FULL_SYNC = int(os.environ["NB_INDEX_FULL_SYNC"])
+except KeyError:
+    NB_INDEX_FULL_SYNC = 3600
+
+try:
+    NB_FLUSH_INTERVAL = float(os.environ["NB_FLUSH_INTERVAL"])
+except KeyError:
+    NB_FLUSH_INTERVAL = 2.0
+
+try:
+    NB_FLUSH_BATCH = int(os.environ["NB_FLUSH_BATCH"])
+except KeyError:
+    NB_FLUSH_BATCH = 20
+
+try:
+    NB_FLUSH_RETRIES = int(os.environ["NB_FLUSH_RETRIES"])
+except KeyError:
+    NB_FLUSH_RETRIES = 5
+
+try:
+    NB_FLUSH_BACKOFF = float(os.environ["NB_FLUSH_BACKOFF"])
+except KeyError:
+    NB_FLUSH_BACKOFF = 2.0
+
+try:
+    NB_MAC_FILTER = os.environ["NB_MAC_FILTER"].lower() in ("1", "true", "yes")
+except KeyError:
+    NB_MAC_FILTER = False
+
+INDEX_STATUSES = ("planned", "staged")
+
+def normalize_mac(mac: str) -> str:
+    """
+    Returns MAC in NetBox notation (AA:BB:CC:DD:EE:FF).
+    """
+
+    return mac.upper().replace("-", ":")
+
+class DeviceSnapshot:
+    """
+    The device attributes provisioning needs, taken from one NetBox response.
+    """
+
+    def __init__(self, record) -> None:
+        """
+        Constructor - copies attributes off a pynetbox device record.
+        """
+
+        self.id = record.id
+        self.serial = record.serial
+        self.name = str(record.name)
+        self.primary_ip = str(record.primary_ip)
+        self.role = str(record.device_role)
+        self.site = str(record.site.name) if record.site is not None else "None"
+        self.status = str(record.status.value) if hasattr(record.status, "value") else str(record.status)
+        self.tags = [str(tag.slug) for tag in record.tags]
+        self.macs = []
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DeviceSnapshot":
+        """
+        Returns the snapshot vars() gave data of.
+        """
+
+        snapshot = cls.__new__(cls)
+        snapshot.__dict__.update(data)
+        return snapshot
+
+class DeviceCache:
+    """
+    Small TTL/LRU cache of DeviceSnapshots keyed by serial. Each gunicorn worker
+    has its own - a device changed in one worker (changed()) is recorded in the
+    job database, and the other workers drop their older snapshot of it on the
+    next get().
+    """
+
+    def __init__(self, ttl: int = NB_CACHE_TTL, size: int = NB_CACHE_SIZE, path: str = JOB_DB) -> None:
+        """
+        Constructor - creates the table if missing.
+        """
+
+        self.ttl = ttl
+        self.size = size
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS device_changes (
+                            serial TEXT PRIMARY KEY,
+                            changed REAL)""")
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        New connection per operation - safe across threads and forks.
+        """
+
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def _changed_since(self, serial: str, stored: float) -> bool:
+        """
+        True if serial was changed (by any worker) after stored (time.time()).
+        """
+
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT changed FROM device_changes WHERE serial = ?", (serial,)).fetchone()
+
+        return row is not None and row[0] > stored
+
+    def get(self, serial: str) -> DeviceSnapshot:
+        """
+        Returns cached snapshot, None if missing, expired or changed since.
+        """
+
+        with self._lock:
+            entry = self._entries.get(serial)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[serial]
+                return None
+
+        if self._changed_since(serial, entry[1]):
+            self.invalidate(serial)
+            return None
+
+        with self._lock:
+            if serial in self._entries:
+                self._entries.move_to_end(serial)
+        return entry[2]
+
+    def put(self, snapshot: DeviceSnapshot) -> None:
+        """
+        Stores snapshot, evicting the least recently used entry when full.
+        """
+
+        with self._lock:
+            self._entries[snapshot.serial] = (time.monotonic(), time.time(), snapshot)
+            self._entries.move_to_end(snapshot.serial)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def changed(self, serial: str) -> None:
+        """
+        Records that serial changed - snapshots of it stored before now are stale
+        in every worker. Call before put()ting the new state.
+        """
+
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute("INSERT OR REPLACE INTO device_changes VALUES (?, ?)", (serial, now))
+            # Snapshots older than ttl are expired anyway.
+            db.execute("DELETE FROM device_changes WHERE changed < ?", (now - self.ttl,))
+
+    def invalidate(self, serial: str) -> None:
+        """
+        Drops snapshot for serial.
+        """
+
+        with self._lock:
+            self._entries.pop(serial, None)
+
+# Shared by all NetboxConnectors in the process, kept coherent across workers.
+DEVICE_CACHE = DeviceCache()
+
+class NetboxIndex:
+    """
+    Index of planned/staged devices keyed by serial and MAC, kept in the job
+    database so all gunicorn workers share one copy. Only the worker holding the
+    sync lease talks to NetBox - it loads the index in bulk once, then only pulls
+    devices changed since the last sync. If it exits, another worker takes over
+    once the lease ran out.
+    """
+
+    def __init__(self, host: str, token: str, refresh: int = NB_INDEX_REFRESH, full_sync: int = NB_INDEX_FULL_SYNC, path: str = JOB_DB) -> None:
+        """
+        Constructor - creates the tables if missing, refresh thread is started by start().
+        """
+
+        self.netbox = pynetbox.api(url=f"http://{host}", token=token)
+        self.host = host
+        self.refresh = refresh
+        self.full_sync = full_sync
+        self.path = path
+        self._lock = threading.Lock()
+        self._thread = None
+
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS netbox_index (
+                            host TEXT,
+                            serial TEXT,
+                            device TEXT,
+                            PRIMARY KEY (host, serial))""")
+            db.execute("""CREATE TABLE IF NOT EXISTS netbox_index_macs (
+                            host TEXT,
+                            mac TEXT,
+                            serial TEXT,
+                            PRIMARY KEY (host, mac))""")
+            db.execute("""CREATE TABLE IF NOT EXISTS netbox_index_sync (
+                            host TEXT PRIMARY KEY,
+                            pid INTEGER,
+                            lease REAL,
+                            last_sync TEXT,
+                            last_full_sync TEXT)""")
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        New connection per operation - safe across threads and forks.
+        """
+
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def start(self) -> None:
+        """
+        Starts refresh thread, if not running.
+        """
+
+        with self._lock:
+            if self._thread is not None or self.refresh <= 0:
+                return
+            self._thread = threading.Thread(target=self._run, name="netbox-index", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        """
+        Refresh loop - syncs while this worker holds the lease.
+        """
+
+        while True:
+            try:
+                if self._lease():
+                    self.sync()
+            except Exception as exc: # pylint: disable=broad-exception-caught
+                logger.error("NetBox index sync failed: %s", exc)
+            time.sleep(self.refresh)
+
+    def _lease(self) -> bool:
+        """
+        Takes or renews the sync lease - True if this worker is (now) the one syncing.
+        """
+
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT pid, lease FROM netbox_index_sync WHERE host = ?", (self.host,)).fetchone()
+            if row is not None and row["pid"] != os.getpid() and row["lease"] > now and pid_alive(row["pid"]):
+                db.execute("COMMIT")
+                return False
+
+            db.execute("""INSERT INTO netbox_index_sync (host, pid, lease) VALUES (?, ?, ?)
+                          ON CONFLICT (host) DO UPDATE SET pid = excluded.pid, lease = excluded.lease""",
+                       (self.host, os.getpid(), now + 3 * self.refresh))
+            db.execute("COMMIT")
+
+        return True
+
+    def _macs(self, device_ids: list) -> dict:
+        """
+        Returns {device_id: [MACs]} for device_ids, in bulk.
+        """
+
+        macs = {}
+        for start in range(0, len(device_ids), 100):
+            with NETBOX_SECONDS.labels("dcim.interfaces.filter").time(), span("dcim.interfaces.filter", "netbox"):
+                interfaces = list(self.netbox.dcim.interfaces.filter(device_id=device_ids[start:start + 100]))
+            for interface in interfaces:
+                if interface.mac_address:
+                    macs.setdefault(interface.device.id, []).append(normalize_mac(str(interface.mac_address)))
+
+        return macs
+
+    def sync(self) -> None:
+        """
+        Full load on first run (and every full_sync seconds, to drop deleted devices),
+        incremental via last_updated__gte otherwise.
+        """
+
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT last_sync, last_full_sync FROM netbox_index_sync WHERE host = ?", (self.host,)).fetchone()
+        last_sync, last_full_sync = [datetime.fromisoformat(value) if value else None for value in (row or (None, None))]
+
+        started = datetime.now(timezone.utc)
+        full = last_sync is None or last_full_sync is None or (started - last_full_sync).total_seconds() > self.full_sync
+
+        with NETBOX_SECONDS.labels("dcim.devices.filter").time(), span("dcim.devices.filter", "netbox", full=full):
+            if full:
+                records = list(self.netbox.dcim.devices.filter(status=list(INDEX_STATUSES)))
+            else:
+                # Margin for clock skew between us and NetBox.
+                since = last_sync - timedelta(seconds=self.refresh)
+                records = list(self.netbox.dcim.devices.filter(last_updated__gte=since.isoformat()))
+
+        snapshots = [DeviceSnapshot(record) for record in records if record.serial]
+        wanted = [snapshot for snapshot in snapshots if snapshot.status in INDEX_STATUSES]
+        macs = self._macs([snapshot.id for snapshot in wanted])
+
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            if full:
+                db.execute("DELETE FROM netbox_index WHERE host = ?", (self.host,))
+                db.execute("DELETE FROM netbox_index_macs WHERE host = ?", (self.host,))
+            for snapshot in snapshots:
+                self._remove(db, snapshot.serial)
+            for snapshot in wanted:
+                snapshot.macs = macs.get(snapshot.id, [])
+                self._put(db, snapshot)
+            db.execute("UPDATE netbox_index_sync SET last_sync = ?, last_full_sync = COALESCE(?, last_full_sync) WHERE host = ?",
+                       (started.isoformat(), started.isoformat() if full else None, self.host))
+            indexed = db.execute("SELECT COUNT(*) FROM netbox_index WHERE host = ?", (self.host,)).fetchone()[0]
+            db.execute("COMMIT")
+
+        logger.info("NetBox index %s sync - %s changed, %s devices indexed", "full" if full else "incremental", len(records), indexed)
+
+    def _put(self, db: sqlite3.Connection, snapshot: DeviceSnapshot) -> None:
+        """
+        Adds snapshot (in db's transaction).
+        """
+
+        db.execute("INSERT OR REPLACE INTO netbox_index VALUES (?, ?, ?)", (self.host, snapshot.serial, json.dumps(vars(snapshot))))
+        db.executemany("INSERT OR REPLACE INTO netbox_index_macs VALUES (?, ?, ?)", [(self.host, mac, snapshot.serial) for mac in snapshot.macs])
+
+    def _remove(self, db: sqlite3.Connection, serial: str) -> None:
+        """
+        Drops device (in db's transaction).
+        """
+
+        db.execute("DELETE FROM netbox_index WHERE host = ? AND serial = ?", (self.host, serial))
+        db.execute("DELETE FROM netbox_index_macs WHERE host = ? AND serial = ?", (self.host, serial))
+
+    def update(self, snapshot: DeviceSnapshot) -> None:
+        """
+        Write-through from NetboxConnector updates.
+        """
+
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            previous = self._get(db, "SELECT device FROM netbox_index WHERE host = ? AND serial = ?", snapshot.serial)
+            if previous is not None:
+                self._remove(db, snapshot.serial)
+                if snapshot.status in INDEX_STATUSES:
+                    snapshot = copy.copy(snapshot)
+                    snapshot.macs = previous.macs
+                    self._put(db, snapshot)
+            db.execute("COMMIT")
+
+    def invalidate(self, serial: str) -> None:
+        """
+        Drops device, next lookup goes to the API.
+        """
+
+        with closing(self._connect()) as db:
+            self._remove(db, serial)
+
+    def _get(self, db: sqlite3.Connection, query: str, key: str) -> DeviceSnapshot:
+        """
+        Returns the indexed device query selects by key, None on miss.
+        """
+
+        row = db.execute(query, (self.host, key)).fetchone()
+        return DeviceSnapshot.from_dict(json.loads(row["device"])) if row is not None else None
+
+    def get(self, serial: str) -> DeviceSnapshot:
+        """
+        Returns indexed device by serial, None on miss.
+        """
+
+        if self.refresh <= 0:
+            return None
+
+        with closing(self._connect()) as db:
+            return self._get(db, "SELECT device FROM netbox_index WHERE host = ? AND serial = ?", serial)
+
+    def get_by_mac(self, mac: str) -> DeviceSnapshot:
+        """
+        Returns indexed device by MAC, None on miss.
+        """
+
+        if self.refresh <= 0:
+            return None
+
+        with closing(self._connect()) as db:
+            return self._get(db, """SELECT device FROM netbox_index_macs JOIN netbox_index USING (host, serial)
+                                    WHERE host = ? AND mac = ?""", normalize_mac(mac))
+
+    def synced(self) -> bool:
+        """
+        True if the index is enabled and was synced within the last few refresh intervals.
+        """
+
+        if self.refresh <= 0:
+            return False
+
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT last_sync FROM netbox_index_sync WHERE host = ?", (self.host,)).fetchone()
+
+        return row is not None and row["last_sync"] is not None and \
+            (datetime.now(timezone.utc) - datetime.fromisoformat(row["last_sync"])).total_seconds() < 3 * self.refresh
+
+class WriteBehindQueue:
+    """
+    Merges status/tag changes per device and PATCHes many devices in one
+    dcim.devices.update() call, on an interval or once batch devices are pending.
+    A change to a field that is still pending flushes first, so NetBox sees every
+    state transition in order (staged -> upgrading -> reloading -> configuring).
+    If the bulk PATCH fails, each device is PATCHed on its own so one bad object
+    does not take the others down - the failed ones are re-queued with backoff
+    and given up (on_failed) after retries attempts.
+    """
+
+    def __init__(self, netbox, on_flushed, on_failed, interval: float = NB_FLUSH_INTERVAL, batch: int = NB_FLUSH_BATCH,
+                 retries: int = NB_FLUSH_RETRIES, backoff: float = NB_FLUSH_BACKOFF) -> None:
+        """
+        Constructor - flush thread is started on first change.
+        """
+
+        self.netbox = netbox
+        self.on_flushed = on_flushed
+        self.on_failed = on_failed
+        self.interval = interval
+        self.batch = batch
+        self.retries = retries
+        self.backoff = backoff
+        self._pending = OrderedDict()
+        self._serials = {}
+        # {device_id: (failed attempts, monotonic time of the next one)}
+        self._retry = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def _start(self) -> None:
+        """
+        Starts interval flush thread, if not running.
+        """
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="netbox-write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        """
+        Interval flush loop.
+        """
+
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def add(self, serial: str, device_id: int, changes: dict) -> None:
+        """
+        Queues changes for device.
+        """
+
+        self._start()
+
+        with self._lock:
+            entry = self._pending.get(device_id)
+            conflict = entry is not None and any(field in entry for field in changes)
+
+        if conflict:
+            self.flush()
+
+        with self._lock:
+            self._pending.setdefault(device_id, {"id": device_id}).update(changes)
+            self._serials[device_id] = serial
+            full = len(self._pending) >= self.batch
+
+        if full:
+            self.flush()
+
+    def pending(self) -> int:
+        """
+        Returns number of devices with unsent changes.
+        """
+
+        return len(self._pending)
+
+    def _update(self, objects: list) -> list:
+        """
+        PATCHes objects in one dcim.devices.update() call.
+        """
+
+        with NETBOX_SECONDS.labels("dcim.devices.update").time(), span("dcim.devices.update", "netbox", devices=len(objects)):
+            return self.netbox.dcim.devices.update(objects)
+
+    def _update_each(self, objects: list, serials: list) -> tuple:
+        """
+        PATCHes objects one device at a time. Returns (updated records, serials of
+        the updated devices, [(object, serial)] that failed).
+        """
+
+        result, updated, failed = [], [], []
+        for obj, serial in zip(objects, serials):
+            try:
+                result.extend(self._update([obj]))
+                updated.append(serial)
+            except Exception as exc: # pylint: disable=broad-exception-caught
+                logger.error("%s - NetBox update %s failed: %s", serial, obj, exc)
+                failed.append((obj, serial))
+
+        return result, updated, failed
+
+    def _requeue(self, failed: list) -> list:
+        """
+        Puts failed [(object, serial)] back for a later flush, under any change
+        queued for the device since. Returns serials given up after retries attempts.
+        """
+
+        given_up = []
+        with self._lock:
+            for obj, serial in failed:
+                attempts = self._retry.pop(obj["id"], (0, 0))[0] + 1
+                if attempts >= self.retries:
+                    logger.error("%s - Giving up NetBox update after %s attempts", serial, attempts)
+                    given_up.append(serial)
+                    continue
+
+                obj.update(self._pending.pop(obj["id"], {}))
+                self._pending[obj["id"]] = obj
+                self._serials.setdefault(obj["id"], serial)
+                self._retry[obj["id"]] = (attempts, time.monotonic() + self.backoff * 2 ** (attempts - 1))
+
+        return given_up
+
+    def flush(self) -> list:
+        """
+        Sends pending changes in one bulk PATCH - devices waiting out a retry
+        backoff stay queued.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                now = time.monotonic()
+                due = [device_id for device_id in self._pending if self._retry.get(device_id, (0, 0))[1] <= now]
+                if not due:
+                    return []
+                objects = [self._pending.pop(device_id) for device_id in due]
+                serials = [self._serials.pop(device_id) for device_id in due]
+
+            try:
+                result = self._update(objects)
+                updated, failed = serials, []
+            except Exception as exc: # pylint: disable=broad-exception-caught
+                logger.error("NetBox bulk update of %s device(s) failed: %s", len(objects), exc)
+                if len(objects) > 1:
+                    result, updated, failed = self._update_each(objects, serials)
+                else:
+                    result, updated, failed = [], [], list(zip(objects, serials))
+
+            with self._lock:
+                for obj, serial in zip(objects, serials):
+                    if serial in updated:
+                        self._retry.pop(obj["id"], None)
+
+            given_up = self._requeue(failed)
+            if given_up:
+                self.on_failed(given_up)
+
+            logger.debug("NetBox bulk update of %s device(s)", len(updated))
+            self.on_flushed(result, updated)
+
+            return result
+
+NETBOX_INDEXES = {}
+
+def get_netbox_index(host: str, token: str) -> NetboxIndex:
+    """
+    Returns the process-wide view of the shared index for host, started on first use.
+    """
+
+    index = NETBOX_INDEXES.get(host)
+    if index is None:
+        index = NETBOX_INDEXES.setdefault(host, NetboxIndex(host, token))
+    index.start()
+
+    return index
+
+WRITE_QUEUES = {}
+
+def _written_through(records: list, serials: list) -> None:
+    """
+    Refreshes cache and index from a bulk PATCH response.
+    """
+
+    try:
+        for record in records:
+            snapshot = DeviceSnapshot(record)
+            previous = DEVICE_CACHE.get(snapshot.serial)
+            # A newer change may already be queued for this device - keep the optimistic one.
+            if previous is None or (previous.status, previous.tags) == (snapshot.status, snapshot.tags):
+                DEVICE_CACHE.put(snapshot)
+    except (AttributeError, TypeError):
+        for serial in serials:
+            DEVICE_CACHE.invalidate(serial)
+
+def _write_failed(serials: list) -> None:
+    """
+    Drops optimistic cache/index entries after a failed bulk PATCH.
+    """
+
+    for serial in serials:
+        DEVICE_CACHE.changed(serial)
+        DEVICE_CACHE.invalidate(serial)
+        for index in NETBOX_INDEXES.values():
+            index.invalidate(serial)
+
+def get_write_queue(host: str, token: str) -> WriteBehindQueue:
+    """
+    Returns the process-wide write-behind queue for host.
+    """
+
+    writes = WRITE_QUEUES.get(host)
+    if writes is None:
+        writes = WRITE_QUEUES.setdefault(host, WriteBehindQueue(pynetbox.api(url=f"http://{host}", token=token),
+                                                                on_flushed=_written_through,
+                                                                on_failed=_write_failed))
+
+    return writes
 
 class NetboxConnector:
     """
@@ -18,6 +674,68 @@ class NetboxConnector:
         """
 
         self.netbox = pynetbox.api(url=f"http://{host}", token=token)
+        self.cache = DEVICE_CACHE
+        self.index = get_netbox_index(host, token)
+        self.writes = get_write_queue(host, token)
+
+    def get_device(self, serial: str) -> DeviceSnapshot:
+        """
+        Returns device snapshot - served from cache or the planned/staged index,
+        falling back to one API lookup.
+        """
+
+        snapshot = self.cache.get(serial)
+        if snapshot is not None:
+            return snapshot
+
+        snapshot = self.index.get(serial)
+        if snapshot is not None:
+            return snapshot
+
+        with NETBOX_SECONDS.labels("dcim.devices.get").time(), span("dcim.devices.get", "netbox", serial=serial):
+            record = self.netbox.dcim.devices.get(serial=serial)
+        if record is None:
+            raise DeviceNotFound(serial=serial)
+
+        snapshot = DeviceSnapshot(record)
+        self.cache.put(snapshot)
+
+        return snapshot
+
+    def _update_device(self, serial: str, changes: dict) -> None:
+        """
+        Queue device PATCH and write the change through to cache and index right away.
+        """
+
+        snapshot = copy.copy(self.get_device(serial))
+        if "status" in changes:
+            snapshot.status = changes["status"]
+        if "tags" in changes:
+            snapshot.tags = [tag["slug"] for tag in changes["tags"]]
+        self.cache.changed(serial)
+        self.cache.put(snapshot)
+        self.index.update(snapshot)
+
+        self.writes.add(serial, snapshot.id, changes)
+
+    def flush(self) -> list:
+        """
+        Sends queued status/tag changes now - call at job end.
+        """
+
+        return self.writes.flush()
+
+    def get_device_by_mac(self, mac: str) -> DeviceSnapshot:
+        """
+        Returns planned/staged device with interface MAC from the index, None if
+        unknown. A hit is cached, so the run's lookups by serial are served from it.
+        """
+
+        snapshot = self.index.get_by_mac(mac)
+        if snapshot is not None:
+            self.cache.put(snapshot)
+
+        return snapshot
 
     def get_primary_ip(self, serial: str, hostname: str = None) -> str:
         """
@@ -26,78 +744,55 @@ class NetboxConnector:
 
         if hostname is not None:
             try:
-                return str(self.netbox.dcim.devices.get(name=hostname).primary_ip)
+                with NETBOX_SECONDS.labels("dcim.devices.get").time(), span("dcim.devices.get", "netbox", hostname=hostname):
+                    record = self.netbox.dcim.devices.get(name=hostname)
+                return str(record.primary_ip)
             except AttributeError as error:
                 raise DeviceNotFound(serial=serial) from error
 
-        try:
-            return str(self.netbox.dcim.devices.get(serial=serial).primary_ip)
-        except AttributeError as error:
-            raise DeviceNotFound(serial=serial) from error
+        return self.get_device(serial).primary_ip
 
     def get_device_role(self, serial: str) -> str:
         """
         Returns device role.
         """
 
-        try:
-            return str(self.netbox.dcim.devices.get(serial=serial).device_role)
-        except AttributeError as error:
-            raise DeviceNotFound(serial=serial) from error
+        return self.get_device(serial).role
 
-    def get_device_tags(self, serial: str) -> str:
+    def get_device_tags(self, serial: str) -> list:
         """
-        Returns device role.
+        Returns device tags (slugs).
         """
 
-        try:
-            return self.netbox.dcim.devices.get(serial=serial).tags
-        except AttributeError as error:
-            raise DeviceNotFound(serial=serial) from error
+        return self.get_device(serial).tags
 
     def get_device_name(self, serial: str) -> str:
         """
         Returns device (host)name.
         """
 
-        try:
-            return str(self.netbox.dcim.devices.get(serial=serial).name)
-        except AttributeError as error:
-            raise DeviceNotFound(serial=serial) from error
+        return self.get_device(serial).name
 
     def get_site_name(self, serial: str) -> str:
         """
         Returns device site name.
         """
 
-        try:
-            return str(self.netbox.dcim.devices.get(serial=serial).site.name)
-        except AttributeError as error:
-            raise DeviceNotFound(serial=serial) from error
+        return self.get_device(serial).site
 
-    def update_device_status(self, serial: str, status: str) -> str:
+    def update_device_status(self, serial: str, status: str) -> None:
         """
         Update device status.
         """
 
-        try:
-            device_id = self.netbox.dcim.devices.get(serial=serial).id
-        except AttributeError as error:
-            raise DeviceNotFound(serial=serial) from error
-
-        return self.netbox.dcim.devices.update([{"id": device_id, "status": status}])
+        self._update_device(serial, {"status": status})
 
-    def update_device_tag(self, serial: str, tags: list) -> str:
+    def update_device_tag(self, serial: str, tags: list) -> None:
         """
         Update device tags.
         """
 
-        try:
-            device_id = self.netbox.dcim.devices.get(serial=serial).id
-        except AttributeError as error:
-            raise DeviceNotFound(serial=serial) from error
-
-        return self.netbox.dcim.devices.update([{"id": device_id, "tags": tags}])
+        self._update_device(serial, {"tags": tags})
 
 if __name__ == "__main__":
 
@@ -4,16 +4,136 @@
 Functions to help with verifying OS
 """
 
-import sys
+import os
+import re
 import json
+import time
+import asyncio
 import logging
 from scrapli.driver import GenericDriver
+from .exceptions import ImageVerifyTimeout
+from .trace_functions import span
+
+# pylint: disable=line-too-long
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout,
-                level=logging.INFO,
-                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-                )
+
+try:
+    VERIFY_DEADLINE = int(os.environ["VERIFY_DEADLINE"])
+except KeyError:
+    VERIFY_DEADLINE = 1800
+
+try:
+    VERIFY_POLL_MIN = float(os.environ["VERIFY_POLL_MIN"])
+except KeyError:
+    VERIFY_POLL_MIN = 2.0
+
+try:
+    VERIFY_POLL_MAX = float(os.environ["VERIFY_POLL_MAX"])
+except KeyError:
+    VERIFY_POLL_MAX = 60.0
+
+class ImageVerifyWatcher:
+    """
+    Waits out an on-device image verification ('show images' reporting a
+    percentage). Progress samples give the verification rate, the next poll is
+    timed for the estimated completion (within VERIFY_POLL_MIN/MAX), stalled
+    progress backs off, and a hard deadline ends the wait.
+    """
+
+    def __init__(self, host: str, verify_regex: str, deadline: int = VERIFY_DEADLINE, poll_min: float = VERIFY_POLL_MIN, poll_max: float = VERIFY_POLL_MAX) -> None:
+        """
+        Constructor - verify_regex captures the percentage in group 1.
+        """
+
+        self.host = host
+        self.verify_regex = re.compile(verify_regex)
+        self.deadline = deadline
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.started = time.monotonic()
+        self.polls = 0
+        self._samples = []
+        self._stalled = 0
+
+    def progress(self, output: str) -> float:
+        """
+        Returns verification percentage in output, None if no verification is running.
+        """
+
+        match = self.verify_regex.search(output)
+        if match is None:
+            return None
+
+        try:
+            return float(match.group(1).rstrip("%"))
+        except ValueError:
+            return 0.0
+
+    def next_delay(self, percent: float) -> float:
+        """
+        Records a progress sample, returns seconds until the next poll.
+        Raises ImageVerifyTimeout once the deadline has passed.
+        """
+
+        now = time.monotonic()
+        self.polls += 1
+
+        if now - self.started >= self.deadline:
+            raise ImageVerifyTimeout(host=self.host, deadline=self.deadline, percent=percent)
+
+        if self._samples and percent <= self._samples[-1][1]:
+            self._stalled += 1
+        else:
+            self._stalled = 0
+            self._samples.append((now, percent))
+
+        if self._stalled:
+            delay = self.poll_min * 2 ** self._stalled
+        elif len(self._samples) < 2:
+            delay = self.poll_min
+        else:
+            (first_time, first_percent), (last_time, last_percent) = self._samples[0], self._samples[-1]
+            rate = (last_percent - first_percent) / (last_time - first_time)
+            delay = (100.0 - percent) / rate
+
+        delay = max(self.poll_min, min(delay, self.poll_max))
+
+        return min(delay, self.started + self.deadline - now)
+
+    def wait(self, poll) -> str:
+        """
+        Calls poll() (returns 'show images' output) until no verification is running,
+        sleeping between polls. Returns the final output.
+        """
+
+        while True:
+            output = poll()
+            percent = self.progress(output)
+            if percent is None:
+                return output
+
+            delay = self.next_delay(percent)
+            logger.info("%s - Verifying OS - %.0f%%, next check in %.1fs", self.host, percent, delay)
+            with span("image_verify", "sleep", percent=percent, delay=round(delay, 1)):
+                time.sleep(delay)
+
+    async def wait_async(self, poll) -> str:
+        """
+        wait() for the async engine - poll is a coroutine function, nothing is held
+        between polls.
+        """
+
+        while True:
+            output = await poll()
+            percent = self.progress(output)
+            if percent is None:
+                return output
+
+            delay = self.next_delay(percent)
+            logger.info("%s - Verifying OS - %.0f%%, next check in %.1fs", self.host, percent, delay)
+            with span("image_verify", "sleep", percent=percent, delay=round(delay, 1)):
+                await asyncio.sleep(delay)
 
 class SFTPConnector:
     """
@@ -44,6 +164,20 @@ class SFTPConnector:
 
         return json.loads(result)
 
+    def file_hash(self, path: str) -> str:
+        """
+        Returns SHA-256 of a file on the SFTP-server.
+        """
+
+        return self.device.send_command(f"sha256sum {path}").result.split(maxsplit=1)[0]
+
+    def close(self) -> None:
+        """
+        Closes the SSH session.
+        """
+
+        self.device.close()
+
     @staticmethod
     def compare_os_versions(device_os: str, desired_os: str) -> bool:
         """
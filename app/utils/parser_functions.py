@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+"""
+Shared cache of compiled ntc-templates TextFSM parsers.
+"""
+
+import os
+import copy
+import logging
+import tempfile
+import threading
+import importlib.resources
+import textfsm
+from textfsm import clitable
+from ntc_templates.parse import parse_output
+from .device_detection_functions import OS_REGISTRY
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    TEXTFSM_CACHE_DIR = os.environ["TEXTFSM_CACHE_DIR"]
+except KeyError:
+    TEXTFSM_CACHE_DIR = os.path.join(tempfile.gettempdir(), "dhcp_provision_textfsm")
+
+def ntc_template_dir() -> str:
+    """
+    The ntc-templates template directory - $NTC_TEMPLATES_DIR if set (as for
+    parse_output()), else the one shipped in the package.
+    """
+
+    try:
+        return os.environ["NTC_TEMPLATES_DIR"]
+    except KeyError:
+        return str(importlib.resources.files("ntc_templates") / "templates")
+
+class TemplateCache:
+    """
+    Resolves and compiles each (platform, command) template once. Callers get a
+    per-thread copy of the compiled parser, reset before every use, instead of
+    parse_output() re-reading and compiling the template on every call.
+    """
+
+    def __init__(self, template_dir: str = None) -> None:
+        """
+        Constructor.
+        """
+
+        self.template_dir = template_dir
+        self._prototypes = {}
+        self._index = None
+        self._index_version = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _index_table(self) -> clitable.CliTable:
+        """
+        The ntc-templates index, reduced to the rows of the registered OSes - the
+        command regexes of every other vendor are never compiled. Rebuilt when an
+        OS is registered after it was built.
+        """
+
+        if self._index is None or self._index_version != OS_REGISTRY.version:
+            version = OS_REGISTRY.version
+            platforms = {commands["os_slug"] for commands in OS_REGISTRY.device_types.values() if "os_slug" in commands}
+
+            with open(os.path.join(self.template_dir, "index"), "r", encoding="utf-8") as index:
+                lines = index.readlines()
+
+            # Comments, blank lines and the header row are kept as they are.
+            kept = []
+            header_seen = False
+            for line in lines:
+                fields = line.split(",")
+                if not header_seen or not line.strip() or line.startswith("#"):
+                    header_seen = header_seen or fields[0].strip() == "Template"
+                    kept.append(line)
+                elif len(fields) > 2 and fields[2].strip() in platforms:
+                    kept.append(line)
+
+            os.makedirs(TEXTFSM_CACHE_DIR, exist_ok=True)
+            path = os.path.join(TEXTFSM_CACHE_DIR, "index")
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as index:
+                index.writelines(kept)
+            os.replace(temp_path, path)
+
+            # CliTable keeps every index it parsed by path - drop the one of the previous build.
+            clitable.CliTable.INDEX.pop(os.path.join(self.template_dir, path), None)
+            self._index = clitable.CliTable(path, self.template_dir)
+            self._index_version = version
+
+        return self._index
+
+    def _compile(self, platform: str, command: str) -> textfsm.TextFSM:
+        """
+        Looks template up in the ntc-templates index and compiles it. Returns None for
+        commands mapped to several templates (left to parse_output).
+        """
+
+        if self.template_dir is None:
+            self.template_dir = ntc_template_dir()
+
+        cli_table = self._index_table()
+        row = cli_table.index.GetRowMatch({"Command": command, "Platform": platform})
+        if not row:
+            raise clitable.CliTableError(f"No template found for platform '{platform}' and command '{command}'")
+
+        templates = cli_table.index.index[row]["Template"].split(":")
+        if len(templates) != 1:
+            return None
+
+        with open(os.path.join(self.template_dir, templates[0]), "r", encoding="utf-8") as template:
+            return textfsm.TextFSM(template)
+
+    def prototype(self, platform: str, command: str) -> textfsm.TextFSM:
+        """
+        Returns the shared compiled parser for (platform, command).
+        """
+
+        key = (platform, command)
+        if key not in self._prototypes:
+            with self._lock:
+                if key not in self._prototypes:
+                    self._prototypes[key] = self._compile(platform, command)
+
+        return self._prototypes[key]
+
+    def parser(self, platform: str, command: str) -> textfsm.TextFSM:
+        """
+        Returns this thread's parser for (platform, command), reset and ready to use.
+        """
+
+        parsers = self._local.__dict__.setdefault("parsers", {})
+        key = (platform, command)
+
+        if key not in parsers:
+            prototype = self.prototype(platform, command)
+            parsers[key] = copy.deepcopy(prototype) if prototype is not None else None
+
+        fsm = parsers[key]
+        if fsm is not None:
+            fsm.Reset()
+
+        return fsm
+
+    def parse(self, platform: str, command: str, data: str, fields: tuple = None) -> list:
+        """
+        Parses data like ntc_templates parse_output() (list of dicts, lower-case keys).
+        With fields, rows are projected to those columns - TextFSM still parses every
+        value, the rows just carry (and cache) less.
+        """
+
+        fsm = self.parser(platform, command)
+        if fsm is None:
+            return parse_output(platform=platform, command=command, data=data)
+
+        rows = fsm.ParseText(data)
+        header = [column.lower() for column in fsm.header]
+
+        if fields is None:
+            return [dict(zip(header, row)) for row in rows]
+
+        columns = [(field, header.index(field)) for field in fields]
+        return [{field: row[column] for field, column in columns} for row in rows]
+
+    def preload(self, pairs: list) -> None:
+        """
+        Compiles templates for [(platform, command), ...] up front - call before
+        gunicorn forks so workers share them.
+        """
+
+        for platform, command in pairs:
+            try:
+                self.prototype(platform, command)
+            except (clitable.CliTableError, textfsm.TextFSMError, OSError) as exc:
+                logger.warning("Could not preload template for %s '%s': %s", platform, command, exc)
+
+        logger.info("Preloaded %s TextFSM template(s)", len(self._prototypes))
+
+TEMPLATE_CACHE = TemplateCache()
+
+def preload_templates() -> None:
+    """
+    Preloads templates for the parsed commands of every registered OS.
+    """
+
+    pairs = []
+    for commands in OS_REGISTRY.device_types.values():
+        for command in ("system_command", "interfaces_command"):
+            if "os_slug" in commands and command in commands:
+                pairs.append((commands["os_slug"], commands[command]))
+
+    TEMPLATE_CACHE.preload(pairs)
+
+if __name__ == "__main__":
+
+    pass
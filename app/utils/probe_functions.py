@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+
+"""
+In-process reachability prober - ICMP echo and TCP connects to many IPs at once.
+"""
+
+import os
+import time
+import errno
+import socket
+import struct
+import random
+import logging
+import selectors
+import threading
+import subprocess
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    PROBE_TIMEOUT = float(os.environ["PROBE_TIMEOUT"])
+except KeyError:
+    PROBE_TIMEOUT = 3.0
+
+try:
+    PROBE_CACHE_TTL = float(os.environ["PROBE_CACHE_TTL"])
+except KeyError:
+    PROBE_CACHE_TTL = 5.0
+
+# Echo requests are repeated this often until a reply (or the timeout).
+ICMP_RESEND = 0.5
+
+ICMP_ECHO_REPLY, ICMP_ECHO_REQUEST = 0, 8
+
+def _checksum(data: bytes) -> int:
+    """
+    RFC 1071 internet checksum.
+    """
+
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+
+    return ~total & 0xffff
+
+def _echo_request(ident: int, sequence: int) -> bytes:
+    """
+    Builds an ICMP echo request.
+    """
+
+    payload = b"dhcp_provision"
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, sequence)
+
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, _checksum(header + payload), ident, sequence) + payload
+
+def _icmp_socket() -> tuple:
+    """
+    Returns (socket, raw) - an unprivileged ICMP datagram socket if the kernel
+    allows it (net.ipv4.ping_group_range), a raw socket otherwise. (None, False)
+    if neither is permitted.
+    """
+
+    for kind, raw in ((socket.SOCK_DGRAM, False), (socket.SOCK_RAW, True)):
+        try:
+            sock = socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+        sock.setblocking(False)
+        return sock, raw
+
+    return None, False
+
+class Prober:
+    """
+    Probes ICMP and TCP reachability of many IPs concurrently from one selector -
+    each IP is done as soon as it answered. Results are cached for cache_ttl seconds.
+    Falls back to the ping command if ICMP sockets are not permitted.
+    """
+
+    def __init__(self, timeout: float = PROBE_TIMEOUT, cache_ttl: float = PROBE_CACHE_TTL) -> None:
+        """
+        Constructor.
+        """
+
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, kind: str, ip_address: str):
+        """
+        Returns cached result, None if missing or expired.
+        """
+
+        with self._lock:
+            entry = self._cache.get((kind, ip_address))
+
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def _store(self, kind: str, results: dict) -> None:
+        """
+        Caches results ({ip: bool}).
+        """
+
+        expires = time.monotonic() + self.cache_ttl
+        with self._lock:
+            for ip_address, result in results.items():
+                self._cache[(kind, ip_address)] = (expires, result)
+            if len(self._cache) > 4096:
+                now = time.monotonic()
+                self._cache = {key: entry for key, entry in self._cache.items() if entry[0] >= now}
+
+    def _start_icmp(self, selector: selectors.BaseSelector, ips: list) -> dict:
+        """
+        Opens the ICMP socket and registers it, returns the ICMP probe state.
+        """
+
+        sock, raw = _icmp_socket()
+        if sock is None:
+            return None
+
+        state = {"sock": sock, "raw": raw, "ident": random.randint(0, 0xffff), "waiting": set(ips), "sent": 0.0, "sequence": 0}
+        selector.register(sock, selectors.EVENT_READ, ("icmp", None))
+
+        return state
+
+    @staticmethod
+    def _send_echo(state: dict) -> None:
+        """
+        (Re)sends echo requests to the IPs that did not answer yet.
+        """
+
+        state["sequence"] += 1
+        state["sent"] = time.monotonic()
+        packet = _echo_request(state["ident"], state["sequence"])
+
+        for ip_address in state["waiting"]:
+            try:
+                state["sock"].sendto(packet, (ip_address, 0))
+            except OSError as exc:
+                logger.debug("ICMP echo to %s failed: %s", ip_address, exc)
+
+    @staticmethod
+    def _read_echo(state: dict, results: dict) -> None:
+        """
+        Reads echo replies.
+        """
+
+        while True:
+            try:
+                data, (ip_address, _) = state["sock"].recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            if state["raw"]:
+                data = data[(data[0] & 0x0f) * 4:]
+                if len(data) < 8 or struct.unpack("!H", data[4:6])[0] != state["ident"]:
+                    continue
+
+            # Datagram ICMP sockets only deliver replies to our own echoes.
+            if len(data) >= 8 and data[0] == ICMP_ECHO_REPLY and ip_address in state["waiting"]:
+                state["waiting"].discard(ip_address)
+                results[ip_address] = True
+
+    def _start_tcp(self, selector: selectors.BaseSelector, ips: list, port: int, results: dict) -> dict:
+        """
+        Starts non-blocking connects, returns {socket: ip} still in progress.
+        """
+
+        pending = {}
+        for ip_address in ips:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                result = sock.connect_ex((ip_address, port))
+            except OSError:
+                result = errno.EHOSTUNREACH
+
+            if result in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                pending[sock] = ip_address
+                selector.register(sock, selectors.EVENT_WRITE, ("tcp", ip_address))
+                continue
+
+            results[ip_address] = result == 0
+            sock.close()
+
+        return pending
+
+    def _start_ping_command(self, ips: list) -> dict:
+        """
+        Fallback - starts one ping process per IP, returns {ip: process}.
+        """
+
+        wait = str(max(1, int(self.timeout)))
+        return {ip_address: subprocess.Popen(["ping", "-c", "1", "-W", wait, ip_address], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) # pylint: disable=consider-using-with
+                for ip_address in ips}
+
+    def probe_many(self, ips: list, icmp: bool = True, port: int = 22, cache: bool = True) -> dict:
+        """
+        Probes ips at once - ICMP echo if icmp, TCP connect to port unless port is None.
+        Returns {ip: {"icmp": bool, "tcp": bool}} (only the probes asked for).
+        """
+
+        ips = list(dict.fromkeys(ips))
+        icmp_results = {}
+        tcp_results = {}
+
+        if cache:
+            for ip_address in ips:
+                if icmp and self._cached("icmp", ip_address) is not None:
+                    icmp_results[ip_address] = self._cached("icmp", ip_address)
+                if port is not None and self._cached(f"tcp/{port}", ip_address) is not None:
+                    tcp_results[ip_address] = self._cached(f"tcp/{port}", ip_address)
+
+        icmp_ips = [ip_address for ip_address in ips if icmp and ip_address not in icmp_results]
+        tcp_ips = [ip_address for ip_address in ips if port is not None and ip_address not in tcp_results]
+
+        selector = selectors.DefaultSelector()
+        new_icmp = {}
+        new_tcp = {}
+        echo = self._start_icmp(selector, icmp_ips) if icmp_ips else None
+        if echo is not None:
+            self._send_echo(echo)
+        pings = self._start_ping_command(icmp_ips) if icmp_ips and echo is None else {}
+        pending = self._start_tcp(selector, tcp_ips, port, new_tcp) if tcp_ips else {}
+
+        deadline = time.monotonic() + self.timeout
+        try:
+            while pending or (echo is not None and echo["waiting"]):
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+
+                timeout = deadline - now
+                if echo is not None and echo["waiting"]:
+                    resend = echo["sent"] + ICMP_RESEND
+                    if resend <= now:
+                        self._send_echo(echo)
+                        resend = now + ICMP_RESEND
+                    timeout = min(timeout, resend - now)
+
+                for key, _ in selector.select(timeout=timeout):
+                    kind, ip_address = key.data
+                    if kind == "icmp":
+                        self._read_echo(echo, new_icmp)
+                        continue
+
+                    sock = key.fileobj
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    new_tcp[ip_address] = error == 0
+                    selector.unregister(sock)
+                    sock.close()
+                    del pending[sock]
+        finally:
+            for sock, ip_address in pending.items():
+                new_tcp[ip_address] = False
+                selector.unregister(sock)
+                sock.close()
+            if echo is not None:
+                for ip_address in echo["waiting"]:
+                    new_icmp[ip_address] = False
+                selector.unregister(echo["sock"])
+                echo["sock"].close()
+            selector.close()
+
+        for ip_address, process in pings.items():
+            new_icmp[ip_address] = process.wait() == 0
+
+        self._store("icmp", new_icmp)
+        if port is not None:
+            self._store(f"tcp/{port}", new_tcp)
+
+        icmp_results.update(new_icmp)
+        tcp_results.update(new_tcp)
+
+        results = {}
+        for ip_address in ips:
+            results[ip_address] = {}
+            if icmp:
+                results[ip_address]["icmp"] = icmp_results[ip_address]
+            if port is not None:
+                results[ip_address]["tcp"] = tcp_results[ip_address]
+
+        return results
+
+    def probe(self, ip_address: str, icmp: bool = True, port: int = 22, cache: bool = True) -> dict:
+        """
+        probe_many() for a single IP.
+        """
+
+        return self.probe_many([ip_address], icmp=icmp, port=port, cache=cache)[ip_address]
+
+PROBER = Prober()
+
+def probe_many(ips: list, icmp: bool = True, port: int = 22, cache: bool = True) -> dict:
+    """
+    Probes ips with the shared prober - see Prober.probe_many.
+    """
+
+    return PROBER.probe_many(ips, icmp=icmp, port=port, cache=cache)
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+
+"""
+Reachability-gated connect scheduler - parks booting devices until TCP/22 answers.
+"""
+
+import os
+import time
+import heapq
+import queue
+import asyncio
+import errno
+import socket
+import random
+import logging
+import itertools
+import selectors
+import threading
+from .exceptions import ConnectSchedulerFull
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    CONNECT_DEADLINE = int(os.environ["CONNECT_DEADLINE"])
+except KeyError:
+    CONNECT_DEADLINE = 600
+
+try:
+    CONNECT_BACKOFF_MIN = float(os.environ["CONNECT_BACKOFF_MIN"])
+except KeyError:
+    CONNECT_BACKOFF_MIN = 1.0
+
+try:
+    CONNECT_BACKOFF_MAX = float(os.environ["CONNECT_BACKOFF_MAX"])
+except KeyError:
+    CONNECT_BACKOFF_MAX = 30.0
+
+try:
+    CONNECT_MAX_PARKED = int(os.environ["CONNECT_MAX_PARKED"])
+except KeyError:
+    CONNECT_MAX_PARKED = 1000
+
+PROBE_TIMEOUT = 3.0
+
+class ParkedDevice:
+    """
+    A device waiting for its SSH port.
+    """
+
+    def __init__(self, host: str, port: int, on_ready, on_timeout, deadline: float) -> None:
+        """
+        Constructor.
+        """
+
+        self.host = host
+        self.port = port
+        self.on_ready = on_ready
+        self.on_timeout = on_timeout
+        self.parked = time.monotonic()
+        self.deadline = self.parked + deadline
+        self.attempts = 0
+        self.sock = None
+        self.probe_started = None
+
+    def waited(self) -> float:
+        """
+        Seconds since the device was parked.
+        """
+
+        return time.monotonic() - self.parked
+
+class ConnectScheduler:
+    """
+    One thread probing TCP/22 of all parked devices with non-blocking connects,
+    exponential backoff and jitter. No thread is held per waiting device.
+    Callbacks run on a second thread, so slow ones do not hold up the probes.
+    """
+
+    def __init__(self, backoff_min: float = CONNECT_BACKOFF_MIN, backoff_max: float = CONNECT_BACKOFF_MAX, probe_timeout: float = PROBE_TIMEOUT,
+                 max_parked: int = CONNECT_MAX_PARKED) -> None:
+        """
+        Constructor - scheduler threads are started on first park().
+        """
+
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.probe_timeout = probe_timeout
+        self.max_parked = max_parked
+        self._callbacks = queue.Queue()
+        self._due = []
+        self._probing = {}
+        self._waiting = set()
+        self._counter = itertools.count()
+        self._selector = None
+        self._wakeup = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self) -> None:
+        """
+        Starts scheduler thread, if not running.
+        """
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._selector = selectors.DefaultSelector()
+            self._wakeup = socket.socketpair()
+            self._wakeup[0].setblocking(False)
+            self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+            self._thread = threading.Thread(target=self._run, name="connect-scheduler", daemon=True)
+            self._thread.start()
+            threading.Thread(target=self._run_callbacks, name="connect-callbacks", daemon=True).start()
+
+    def park(self, host: str, on_ready, on_timeout, deadline: int = CONNECT_DEADLINE, port: int = 22, bounded: bool = True) -> None:
+        """
+        Parks host until port accepts connections, then calls on_ready().
+        Calls on_timeout() if that does not happen within deadline seconds.
+        Callbacks run one at a time on the callback thread. Raises
+        ConnectSchedulerFull if max_parked devices are parked already, unless
+        bounded is False.
+        """
+
+        self._start()
+
+        device = ParkedDevice(host, port, on_ready, on_timeout, deadline)
+
+        with self._lock:
+            if bounded and len(self._waiting) >= self.max_parked:
+                raise ConnectSchedulerFull(self.max_parked)
+            self._waiting.add(device)
+            heapq.heappush(self._due, (time.monotonic(), next(self._counter), device))
+
+        self._wakeup[1].send(b"\0")
+
+    def wait(self, host: str, timeout: int = CONNECT_DEADLINE, port: int = 22) -> bool:
+        """
+        Blocking helper - returns True once host accepts connections, False on timeout.
+        Not bounded by max_parked - the waiting job was admitted already.
+        """
+
+        ready = threading.Event()
+        result = []
+
+        def on_ready():
+            result.append(True)
+            ready.set()
+
+        self.park(host, on_ready=on_ready, on_timeout=ready.set, deadline=timeout, port=port, bounded=False)
+        ready.wait()
+
+        return bool(result)
+
+    async def wait_async(self, host: str, timeout: int = CONNECT_DEADLINE, port: int = 22) -> bool:
+        """
+        Awaitable wait() for the async engine - no thread is held while parked.
+        """
+
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def resolve(result: bool):
+            loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(result))
+
+        self.park(host, on_ready=lambda: resolve(True), on_timeout=lambda: resolve(False), deadline=timeout, port=port, bounded=False)
+
+        return await ready
+
+    def waiting(self) -> int:
+        """
+        Returns number of parked devices.
+        """
+
+        with self._lock:
+            return len(self._waiting)
+
+    def stats(self) -> dict:
+        """
+        Returns number of waiting devices and how long they have waited.
+        """
+
+        with self._lock:
+            waiting = sorted(self._waiting, key=lambda device: device.parked)
+
+        return {"waiting": len(waiting),
+                "max_parked": self.max_parked,
+                "devices": [{"host": device.host,
+                             "waited": round(device.waited(), 1),
+                             "attempts": device.attempts} for device in waiting]}
+
+    def _backoff(self, attempts: int) -> float:
+        """
+        Exponential backoff with jitter.
+        """
+
+        delay = min(self.backoff_max, self.backoff_min * 2 ** attempts)
+        return random.uniform(delay / 2, delay)
+
+    def _finish(self, device: ParkedDevice, ready: bool) -> None:
+        """
+        Removes device and hands its callback to the callback thread.
+        """
+
+        with self._lock:
+            self._waiting.discard(device)
+
+        if ready:
+            logger.info("%s - TCP/%s open after %.1fs (%s probes)", device.host, device.port, device.waited(), device.attempts)
+        else:
+            logger.error("%s - TCP/%s not reachable within deadline, giving up.", device.host, device.port)
+
+        self._callbacks.put((device, device.on_ready if ready else device.on_timeout))
+
+    def _run_callbacks(self) -> None:
+        """
+        Callback loop - on_ready/on_timeout may block (job store writes).
+        """
+
+        while True:
+            device, callback = self._callbacks.get()
+            try:
+                callback()
+            except Exception: # pylint: disable=broad-exception-caught
+                logger.exception("%s - Connect scheduler callback failed", device.host)
+
+    def _reschedule(self, device: ParkedDevice) -> None:
+        """
+        Schedules next probe, or times device out.
+        """
+
+        now = time.monotonic()
+        if now >= device.deadline:
+            self._finish(device, ready=False)
+            return
+
+        next_probe = min(now + self._backoff(device.attempts), device.deadline)
+        with self._lock:
+            heapq.heappush(self._due, (next_probe, next(self._counter), device))
+
+    def _probe(self, device: ParkedDevice) -> None:
+        """
+        Starts a non-blocking connect to device.
+        """
+
+        device.attempts += 1
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+
+        try:
+            result = sock.connect_ex((device.host, device.port))
+        except OSError as exc:
+            logger.debug("%s - probe failed: %s", device.host, exc)
+            sock.close()
+            self._reschedule(device)
+            return
+
+        if result == 0:
+            sock.close()
+            self._finish(device, ready=True)
+            return
+
+        if result not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._reschedule(device)
+            return
+
+        device.sock = sock
+        device.probe_started = time.monotonic()
+        self._probing[sock] = device
+        self._selector.register(sock, selectors.EVENT_WRITE, device)
+
+    def _close_probe(self, device: ParkedDevice) -> None:
+        """
+        Tears down device's in-flight probe.
+        """
+
+        self._selector.unregister(device.sock)
+        self._probing.pop(device.sock, None)
+        device.sock.close()
+        device.sock = None
+
+    def _run(self) -> None:
+        """
+        Scheduler loop.
+        """
+
+        while True:
+            now = time.monotonic()
+
+            while True:
+                with self._lock:
+                    if not self._due or self._due[0][0] > now:
+                        break
+                    _, _, device = heapq.heappop(self._due)
+                self._probe(device)
+
+            for device in list(self._probing.values()):
+                if now - device.probe_started > self.probe_timeout:
+                    self._close_probe(device)
+                    self._reschedule(device)
+
+            with self._lock:
+                timeout = self._due[0][0] - now if self._due else None
+            if self._probing:
+                timeout = self.probe_timeout if timeout is None else min(timeout, self.probe_timeout)
+
+            for key, _ in self._selector.select(timeout=None if timeout is None else max(timeout, 0)):
+                if key.fileobj is self._wakeup[0]:
+                    try:
+                        self._wakeup[0].recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+
+                device = key.data
+                error = device.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                self._close_probe(device)
+
+                if error == 0:
+                    self._finish(device, ready=True)
+                else:
+                    logger.debug("%s - TCP/%s not ready (%s)", device.host, device.port, os.strerror(error))
+                    self._reschedule(device)
+
+CONNECT_SCHEDULER = ConnectScheduler()
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+"""
+Process startup - logging, required environment and the state preloaded once in
+the gunicorn master and shared copy-on-write by the workers.
+"""
+
+import gc
+import os
+import sys
+import time
+import logging
+from .parser_functions import preload_templates
+from .template_functions import precompile_templates
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+# Provisioning can not run without these.
+REQUIRED_ENV = ("TFTP_SERVER", "NB_API_TOKEN")
+
+def configure_logging() -> None:
+    """
+    Logging for the whole service - call once, before the other modules log.
+    """
+
+    logging.basicConfig(stream=sys.stdout,
+                    level=logging.INFO,
+                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+                    )
+
+    # Turns of Scrapli-logging.
+    logging.getLogger('scrapli').propagate = False
+
+def check_environment() -> list:
+    """
+    Returns the required env-vars that are not set.
+    """
+
+    return [name for name in REQUIRED_ENV if name not in os.environ]
+
+def preload_shared_state() -> None:
+    """
+    Builds the immutable state every worker needs - TextFSM index and parsers and
+    compiled config templates (the OS signature table is compiled at import) - and
+    moves everything allocated so far out of the garbage collector's reach. With
+    gunicorn preload_app this runs in the master: workers then share these pages
+    instead of copying them the first time a collection walks the objects.
+    """
+
+    timings = {}
+    for name, step in (("textfsm", preload_templates), ("config_templates", precompile_templates)):
+        started = time.perf_counter()
+        step()
+        timings[name] = (time.perf_counter() - started) * 1000
+
+    gc.collect()
+    gc.freeze()
+
+    logger.info("Preloaded shared state (%s) - %s objects frozen for copy-on-write sharing",
+                ", ".join(f"{name} {elapsed:.0f} ms" for name, elapsed in timings.items()), gc.get_freeze_count())
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+"""
+Config template rendering.
+"""
+
+import os
+import logging
+import tempfile
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from .trace_functions import span
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+try:
+    JINJA_CACHE_DIR = os.environ["JINJA_CACHE_DIR"]
+except KeyError:
+    JINJA_CACHE_DIR = os.path.join(tempfile.gettempdir(), "dhcp_provision_jinja")
+
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+
+# auto_reload checks the template file's mtime, so edited templates are picked up without a restart.
+ENVIRONMENT = Environment(loader=FileSystemLoader(TEMPLATE_DIR),
+                          auto_reload=True,
+                          bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR))
+
+def precompile_templates() -> None:
+    """
+    Compiles every template in templates/ - call before gunicorn forks.
+    """
+
+    templates = ENVIRONMENT.list_templates()
+    for template in templates:
+        ENVIRONMENT.get_template(template)
+
+    logger.info("Precompiled %s config template(s)", len(templates))
+
+def _template_context(data: dict) -> dict:
+    """
+    Variables passed to config templates.
+    """
+
+    return {"hostname": data["hostname"],
+            "ip_address": data["ip_address"],
+            "default_gw": data["default_gw"],
+            "fallback_vlan": data["fallback_vlan"],
+            "interfaces": data["interfaces"],
+            "radius_servers": data["radius_servers"]}
+
+def render_template(template: str, data: dict) -> str:
+    """
+    Render template with passed data.
+    """
+
+    with span(template, "template"):
+        return ENVIRONMENT.get_template(template).render(**_template_context(data))
+
+def write_template(template: str, data: dict, path: str) -> None:
+    """
+    Render template with passed data, streamed straight into path. Written to a
+    temporary file first so a half-written config is never served.
+    """
+
+    temp_path = f"{path}.tmp"
+
+    with span(template, "template"), open(temp_path, "w", encoding="utf-8") as file:
+        for chunk in ENVIRONMENT.get_template(template).generate(**_template_context(data)):
+            file.write(chunk)
+
+    os.replace(temp_path, path)
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,531 @@
+#!/usr/bin/python3
+
+"""
+Embedded TFTP server (RFC 1350, blksize/tsize/timeout/windowsize options) serving
+rendered configs from memory.
+"""
+
+import os
+import time
+import errno
+import struct
+import socket
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from .template_functions import render_template, write_template
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    TFTP_EMBEDDED = os.environ["TFTP_EMBEDDED"].lower() in ("1", "true", "yes")
+except KeyError:
+    TFTP_EMBEDDED = False
+
+try:
+    TFTP_BIND = os.environ["TFTP_BIND"]
+except KeyError:
+    TFTP_BIND = "0.0.0.0"
+
+try:
+    TFTP_PORT = int(os.environ["TFTP_PORT"])
+except KeyError:
+    TFTP_PORT = 69
+
+try:
+    TFTP_ROOT = os.environ["TFTP_ROOT"]
+except KeyError:
+    TFTP_ROOT = "/tftpboot"
+
+try:
+    TFTP_STORE_SIZE = int(os.environ["TFTP_STORE_SIZE"])
+except KeyError:
+    TFTP_STORE_SIZE = 64 * 1024 * 1024
+
+try:
+    TFTP_STORE_TTL = int(os.environ["TFTP_STORE_TTL"])
+except KeyError:
+    TFTP_STORE_TTL = 3600
+
+try:
+    TFTP_MAX_BLKSIZE = int(os.environ["TFTP_MAX_BLKSIZE"])
+except KeyError:
+    TFTP_MAX_BLKSIZE = 65464
+
+try:
+    TFTP_MAX_WINDOWSIZE = int(os.environ["TFTP_MAX_WINDOWSIZE"])
+except KeyError:
+    TFTP_MAX_WINDOWSIZE = 64
+
+TFTP_TIMEOUT = 1.0
+TFTP_RETRIES = 5
+
+RRQ, WRQ, DATA, ACK, ERROR, OACK = 1, 2, 3, 4, 5, 6
+
+ERR_UNDEFINED, ERR_NOT_FOUND, ERR_ACCESS, ERR_ILLEGAL, ERR_OPTION = 0, 1, 2, 4, 8
+
+class ConfigStore:
+    """
+    Size-bounded in-memory store of rendered configs keyed by file name. Entries
+    stay until retracted (pop()) - a device may pull its config more than once -
+    and expire after ttl seconds, least recently published go first when full.
+    """
+
+    def __init__(self, max_bytes: int = TFTP_STORE_SIZE, ttl: int = TFTP_STORE_TTL) -> None:
+        """
+        Constructor.
+        """
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, name: str, data: bytes) -> None:
+        """
+        Stores data as name, evicting the oldest entries if over max_bytes.
+        """
+
+        with self._lock:
+            self._drop(name)
+            self._entries[name] = (time.monotonic() + self.ttl, data)
+            self.size += len(data)
+
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                evicted = next(iter(self._entries))
+                logger.warning("TFTP config store full, evicting '%s'", evicted)
+                self._drop(evicted)
+
+    def get(self, name: str) -> bytes:
+        """
+        Returns data stored as name, None if missing or expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._drop(name)
+                return None
+            return entry[1]
+
+    def pop(self, name: str) -> None:
+        """
+        Removes name.
+        """
+
+        with self._lock:
+            self._drop(name)
+
+    def _drop(self, name: str) -> None:
+        """
+        Removes name - caller holds the lock.
+        """
+
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def stats(self) -> dict:
+        """
+        Returns number of entries and bytes held.
+        """
+
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes}
+
+def _packet_error(code: int, message: str) -> bytes:
+    """
+    Builds an ERROR packet.
+    """
+
+    return struct.pack("!HH", ERROR, code) + message.encode("ascii", "replace") + b"\0"
+
+def _parse_request(packet: bytes) -> tuple:
+    """
+    Parses RRQ/WRQ into (opcode, filename, mode, options). Raises ValueError if malformed.
+    """
+
+    opcode = struct.unpack("!H", packet[:2])[0]
+    fields = packet[2:].split(b"\0")
+    if len(fields) < 3 or fields[-1] != b"":
+        raise ValueError("malformed request")
+
+    fields = [field.decode("ascii") for field in fields[:-1]]
+    options = {name.lower(): value for name, value in zip(fields[2::2], fields[3::2])}
+
+    return opcode, fields[0], fields[1].lower(), options
+
+def _netascii(data: bytes) -> bytes:
+    """
+    Converts data to netascii line endings.
+    """
+
+    return data.replace(b"\r", b"\r\0").replace(b"\n", b"\r\n")
+
+class TFTPTransfer(asyncio.DatagramProtocol):
+    """
+    One read transfer, on its own socket (TID). Sends windowsize blocks per ACK and
+    resends the unacknowledged window on timeout.
+    """
+
+    def __init__(self, server, name: str, data: bytes, options: dict, in_memory: bool) -> None:
+        """
+        Constructor.
+        """
+
+        self.server = server
+        self.name = name
+        self.data = data
+        self.in_memory = in_memory
+        self.blksize = 512
+        self.windowsize = 1
+        self.timeout = TFTP_TIMEOUT
+        self.oack = self._negotiate(options)
+        self.oack_pending = bool(self.oack)
+        self.blocks = len(data) // self.blksize + 1
+        self.acked = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.transport = None
+        self._timer = None
+        self.done = asyncio.get_running_loop().create_future()
+
+    def _negotiate(self, options: dict) -> dict:
+        """
+        Applies the options we support, returns those to acknowledge in an OACK.
+        """
+
+        accepted = {}
+
+        try:
+            if "blksize" in options:
+                self.blksize = max(8, min(int(options["blksize"]), TFTP_MAX_BLKSIZE))
+                accepted["blksize"] = self.blksize
+            if "windowsize" in options:
+                self.windowsize = max(1, min(int(options["windowsize"]), TFTP_MAX_WINDOWSIZE))
+                accepted["windowsize"] = self.windowsize
+            if "timeout" in options and 1 <= int(options["timeout"]) <= 255:
+                self.timeout = int(options["timeout"])
+                accepted["timeout"] = self.timeout
+            if "tsize" in options:
+                accepted["tsize"] = len(self.data)
+        except ValueError:
+            logger.debug("Ignoring malformed TFTP options %s", options)
+
+        return accepted
+
+    def connection_made(self, transport) -> None:
+        """
+        Starts the transfer - OACK first if options were negotiated.
+        """
+
+        self.transport = transport
+        self._send_window()
+
+    def _block(self, number: int) -> bytes:
+        """
+        Builds DATA packet for absolute block number (1-based).
+        """
+
+        start = (number - 1) * self.blksize
+        return struct.pack("!HH", DATA, number % 65536) + self.data[start:start + self.blksize]
+
+    def _send_window(self) -> None:
+        """
+        (Re)sends OACK, or the blocks after the last acknowledged one.
+        """
+
+        if self.oack_pending:
+            self.transport.sendto(struct.pack("!H", OACK) + b"".join(f"{name}\0{value}\0".encode("ascii") for name, value in self.oack.items()))
+        else:
+            for number in range(self.acked + 1, min(self.acked + self.windowsize, self.blocks) + 1):
+                self.transport.sendto(self._block(number))
+
+        self._arm_timer()
+
+    def _arm_timer(self) -> None:
+        """
+        (Re)starts the retransmit timer.
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self.timeout, self._on_timeout)
+
+    def _on_timeout(self) -> None:
+        """
+        Resends the unacknowledged window, gives up after TFTP_RETRIES.
+        """
+
+        self.retries += 1
+        if self.retries > TFTP_RETRIES:
+            logger.error("TFTP - '%s' timed out after block %s of %s", self.name, self.acked, self.blocks)
+            self._finish(False)
+            return
+
+        self._send_window()
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        """
+        Handles ACK/ERROR from the client.
+        """
+
+        if len(data) < 4:
+            return
+
+        opcode, number = struct.unpack("!HH", data[:4])
+
+        if opcode == ERROR:
+            logger.error("TFTP - client aborted '%s': %s", self.name, data[4:].rstrip(b"\0").decode("ascii", "replace"))
+            self._finish(False)
+            return
+
+        if opcode != ACK:
+            self.transport.sendto(_packet_error(ERR_ILLEGAL, "Illegal TFTP operation"))
+            return
+
+        if self.oack_pending:
+            if number != 0:
+                return
+            self.oack_pending = False
+            self.retries = 0
+            self._send_window()
+            return
+
+        # Map the 16-bit block number onto the outstanding window.
+        for absolute in range(self.acked + 1, min(self.acked + self.windowsize, self.blocks) + 1):
+            if absolute % 65536 == number:
+                break
+        else:
+            return
+
+        self.acked = absolute
+        self.retries = 0
+
+        if self.acked >= self.blocks:
+            self._finish(True)
+            return
+
+        self._send_window()
+
+    def error_received(self, exc) -> None:
+        """
+        ICMP unreachable from the client.
+        """
+
+        logger.error("TFTP - transfer of '%s' failed: %s", self.name, exc)
+        self._finish(False)
+
+    def _finish(self, success: bool) -> None:
+        """
+        Closes the transfer and reports it to the server.
+        """
+
+        if self.done.done():
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+        self.transport.close()
+        self.done.set_result(success)
+        self.server.transfer_finished(self, success)
+
+class TFTPServer(asyncio.DatagramProtocol):
+    """
+    Listens for read requests on TFTP_PORT, serving names from the config store
+    and falling back to TFTP_ROOT. Runs its own event loop thread.
+    """
+
+    def __init__(self, store: ConfigStore, host: str = TFTP_BIND, port: int = TFTP_PORT, root: str = TFTP_ROOT) -> None:
+        """
+        Constructor - server is started by start().
+        """
+
+        self.store = store
+        self.host = host
+        self.port = port
+        self.root = root
+        self.loop = None
+        self.transport = None
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """
+        Binds the TFTP port and starts serving, if not running. Returns True if this
+        process serves TFTP - with several gunicorn workers only one can bind.
+        """
+
+        with self._lock:
+            if self.loop is not None:
+                return True
+
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.bind((self.host, self.port))
+            except OSError as exc:
+                sock.close()
+                if exc.errno not in (errno.EADDRINUSE, errno.EACCES):
+                    logger.error("TFTP - cannot bind %s:%s: %s", self.host, self.port, exc)
+                return False
+
+            self.loop = asyncio.new_event_loop()
+            asyncio.run_coroutine_threadsafe(self._listen(sock), self.loop)
+            threading.Thread(target=self.loop.run_forever, name="tftp-server", daemon=True).start()
+
+        logger.info("TFTP - serving configs from memory on %s:%s (pid %s)", self.host, self.port, os.getpid())
+        return True
+
+    async def _listen(self, sock: socket.socket) -> None:
+        """
+        Attaches the bound socket to the loop.
+        """
+
+        await self.loop.create_datagram_endpoint(lambda: self, sock=sock)
+
+    def connection_made(self, transport) -> None:
+        """
+        Stores listening transport.
+        """
+
+        self.transport = transport
+
+    def _lookup(self, filename: str) -> tuple:
+        """
+        Returns (data, in_memory) for filename, (None, False) if not found.
+        Only plain names inside root are served.
+        """
+
+        name = os.path.basename(filename.replace("\\", "/"))
+        if not name or name in (".", ".."):
+            return None, False
+
+        data = self.store.get(name)
+        if data is not None:
+            return data, True
+
+        try:
+            with open(os.path.join(self.root, name), "rb") as file:
+                return file.read(), False
+        except OSError:
+            return None, False
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        """
+        Handles a new request.
+        """
+
+        try:
+            opcode, filename, mode, options = _parse_request(data)
+        except (ValueError, UnicodeDecodeError, struct.error):
+            self.transport.sendto(_packet_error(ERR_ILLEGAL, "Malformed request"), addr)
+            return
+
+        if opcode == WRQ:
+            self.transport.sendto(_packet_error(ERR_ACCESS, "Read-only server"), addr)
+            return
+        if opcode != RRQ or mode not in ("octet", "netascii"):
+            self.transport.sendto(_packet_error(ERR_ILLEGAL, "Illegal TFTP operation"), addr)
+            return
+
+        content, in_memory = self._lookup(filename)
+        if content is None:
+            logger.warning("TFTP - %s requested unknown file '%s'", addr[0], filename)
+            self.transport.sendto(_packet_error(ERR_NOT_FOUND, "File not found"), addr)
+            return
+
+        if mode == "netascii":
+            content = _netascii(content)
+
+        logger.info("TFTP - %s reading '%s' (%s bytes, options %s)", addr[0], filename, len(content), options)
+        self.loop.create_task(self._serve(addr, os.path.basename(filename), content, options, in_memory))
+
+    async def _serve(self, addr, name: str, content: bytes, options: dict, in_memory: bool) -> None:
+        """
+        Runs one transfer from a fresh socket.
+        """
+
+        with self._lock:
+            self.active += 1
+
+        try:
+            await self.loop.create_datagram_endpoint(lambda: TFTPTransfer(self, name, content, options, in_memory),
+                                                     local_addr=(self.host, 0), remote_addr=addr)
+        except OSError as exc:
+            logger.error("TFTP - cannot start transfer to %s: %s", addr[0], exc)
+            with self._lock:
+                self.active -= 1
+                self.failed += 1
+
+    def transfer_finished(self, transfer: TFTPTransfer, success: bool) -> None:
+        """
+        Books the transfer. In-memory configs stay until retract_config() - the
+        device may fetch again (a retried copy, a reload before converging).
+        """
+
+        with self._lock:
+            self.active -= 1
+            if success:
+                self.completed += 1
+                self.bytes_sent += len(transfer.data)
+            else:
+                self.failed += 1
+
+        if success:
+            logger.info("TFTP - '%s' sent in %.2fs (blksize %s, windowsize %s)", transfer.name, time.monotonic() - transfer.started, transfer.blksize, transfer.windowsize)
+
+    def stats(self) -> dict:
+        """
+        Returns transfer counters and config store usage.
+        """
+
+        return {"serving": self.loop is not None,
+                "active": self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "bytes_sent": self.bytes_sent,
+                "store": self.store.stats()}
+
+CONFIG_STORE = ConfigStore()
+EMBEDDED_TFTP = TFTPServer(CONFIG_STORE)
+
+def publish_config(template: str, data: dict, name: str) -> bool:
+    """
+    Renders template into config name for devices to pull over TFTP. Kept in memory
+    when this process runs the embedded server, written to TFTP_ROOT otherwise.
+    Returns True if held in memory.
+    """
+
+    if TFTP_EMBEDDED and EMBEDDED_TFTP.start():
+        CONFIG_STORE.put(name, render_template(template, data).encode("utf-8"))
+        return True
+
+    write_template(template=template, data=data, path=os.path.join(TFTP_ROOT, name))
+    return False
+
+def retract_config(name: str) -> None:
+    """
+    Removes config name once the device converged on it.
+    """
+
+    CONFIG_STORE.pop(name)
+
+    try:
+        os.remove(os.path.join(TFTP_ROOT, name))
+    except FileNotFoundError:
+        pass
+    except OSError as exc:
+        logger.warning("Could not remove %s: %s", name, exc)
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+"""
+Per-job trace timeline (timed spans for SSH commands, NetBox calls, renders and
+waits) and on-demand cProfile capture.
+"""
+
+import io
+import os
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    TRACE_MAX_SPANS = int(os.environ["TRACE_MAX_SPANS"])
+except KeyError:
+    TRACE_MAX_SPANS = 2000
+
+try:
+    PROFILE_TOP = int(os.environ["PROFILE_TOP"])
+except KeyError:
+    PROFILE_TOP = 40
+
+# Trace of the job running in this thread / asyncio task.
+_CURRENT = contextvars.ContextVar("trace", default=None)
+
+class Trace:
+    """
+    Timed spans of one job. Span times are relative to the trace start, so spans
+    from several threads (the async engine, NetBox calls in to_thread) line up.
+    """
+
+    def __init__(self, job_id: str, max_spans: int = TRACE_MAX_SPANS) -> None:
+        """
+        Constructor.
+        """
+
+        self.job_id = job_id
+        self.max_spans = max_spans
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        self.profile = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, category: str, start: float, end: float, args: dict = None) -> None:
+        """
+        Records a span - start and end are time.perf_counter() values.
+        """
+
+        with self._lock:
+            if len(self.spans) >= self.max_spans:
+                self.dropped += 1
+                return
+            self.spans.append({"name": name,
+                               "category": category,
+                               "start": round(start - self.origin, 6),
+                               "duration": round(end - start, 6),
+                               "pid": os.getpid(),
+                               "thread": threading.current_thread().name,
+                               "args": args or {}})
+
+    def as_dict(self) -> dict:
+        """
+        Returns trace as dict (stored with the job).
+        """
+
+        with self._lock:
+            spans = list(self.spans)
+
+        return {"job_id": self.job_id,
+                "started": self.started,
+                "spans": spans,
+                "dropped": self.dropped,
+                "profile": self.profile}
+
+def chrome_trace(trace: dict) -> dict:
+    """
+    Converts a stored trace to Chrome trace-event format (chrome://tracing, Perfetto).
+    """
+
+    started = trace["started"] * 1e6
+    threads = {}
+    events = []
+
+    for record in trace["spans"]:
+        tid = threads.setdefault((record["pid"], record["thread"]), len(threads) + 1)
+        events.append({"name": record["name"],
+                       "cat": record["category"],
+                       "ph": "X",
+                       "ts": round(started + record["start"] * 1e6),
+                       "dur": round(record["duration"] * 1e6),
+                       "pid": record["pid"],
+                       "tid": tid,
+                       "args": record["args"]})
+
+    for (pid, thread), tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+
+    return {"traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"job_id": trace["job_id"], "dropped": trace["dropped"]}}
+
+def activate(trace: Trace) -> contextvars.Token:
+    """
+    Makes trace the current one for this thread / task, returns token for deactivate().
+    """
+
+    return _CURRENT.set(trace)
+
+def deactivate(token: contextvars.Token) -> None:
+    """
+    Restores the trace active before activate().
+    """
+
+    _CURRENT.reset(token)
+
+@contextmanager
+def span(name: str, category: str, **args):
+    """
+    Records the enclosed block as a span of the current job's trace, if any.
+    """
+
+    trace = _CURRENT.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, category, start, time.perf_counter(), args)
+
+def profile_report(profiler: cProfile.Profile, top: int = PROFILE_TOP) -> str:
+    """
+    Returns the top functions by cumulative time of a finished profiler run.
+    """
+
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+
+    return output.getvalue()
+
+if __name__ == "__main__":
+
+    pass
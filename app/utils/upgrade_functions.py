@@ -0,0 +1,473 @@
+#!/usr/bin/python3
+
+"""
+OS upgrade wave scheduler - admits image downloads under per-site and global
+caps and an aggregate bandwidth budget, shared by all gunicorn workers.
+"""
+
+import os
+import math
+import time
+import socket
+import asyncio
+import sqlite3
+import logging
+from contextlib import closing
+from .job_functions import JOB_DB, pid_alive
+from .exceptions import UpgradeQueueTimeout
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+try:
+    UPGRADE_SITE_LIMIT = int(os.environ["UPGRADE_SITE_LIMIT"])
+except KeyError:
+    UPGRADE_SITE_LIMIT = 2
+
+try:
+    UPGRADE_GLOBAL_LIMIT = int(os.environ["UPGRADE_GLOBAL_LIMIT"])
+except KeyError:
+    UPGRADE_GLOBAL_LIMIT = 10
+
+try:
+    UPGRADE_BANDWIDTH = float(os.environ["UPGRADE_BANDWIDTH"])
+except KeyError:
+    UPGRADE_BANDWIDTH = 0.0
+
+try:
+    UPGRADE_IMAGE_SIZE = int(os.environ["UPGRADE_IMAGE_SIZE"])
+except KeyError:
+    UPGRADE_IMAGE_SIZE = 600 * 1024 * 1024
+
+try:
+    UPGRADE_CHAIN_LOAD = os.environ["UPGRADE_CHAIN_LOAD"].lower() in ("1", "true", "yes")
+except KeyError:
+    UPGRADE_CHAIN_LOAD = False
+
+try:
+    UPGRADE_TIMEOUT = int(os.environ["UPGRADE_TIMEOUT"])
+except KeyError:
+    UPGRADE_TIMEOUT = 3600
+
+try:
+    UPGRADE_QUEUE_TIMEOUT = int(os.environ["UPGRADE_QUEUE_TIMEOUT"])
+except KeyError:
+    UPGRADE_QUEUE_TIMEOUT = 7200
+
+# Chain-loading logs in to peers with their own account and copies from a path
+# that depends on how the peers serve the image - both have to be configured.
+try:
+    UPGRADE_PEER_USER = os.environ["UPGRADE_PEER_USER"]
+    UPGRADE_PEER_PASSWORD = os.environ["UPGRADE_PEER_PASSWORD"]
+    UPGRADE_PEER_IMAGE_PATH = os.environ["UPGRADE_PEER_IMAGE_PATH"]
+except KeyError:
+    if UPGRADE_CHAIN_LOAD:
+        logger.warning("$UPGRADE_PEER_USER/$UPGRADE_PEER_PASSWORD/$UPGRADE_PEER_IMAGE_PATH not set. Chain-loading disabled.")
+    UPGRADE_CHAIN_LOAD = False
+    UPGRADE_PEER_USER = UPGRADE_PEER_PASSWORD = UPGRADE_PEER_IMAGE_PATH = None
+
+UPGRADE_POLL = 5.0
+# A queued entry not re-checked by its waiter for this many polls was abandoned.
+UPGRADE_STALE_POLLS = 6
+# Fallback download time for ETAs until downloads have been observed (the SFTP copy timeout).
+UPGRADE_DEFAULT_DURATION = 1200.0
+
+class UpgradeSlot:
+    """
+    Admission to download an image - from the central SFTP server, or from peer.
+    """
+
+    def __init__(self, serial: str, peer: str = None, waited: float = 0.0) -> None:
+        """
+        Constructor.
+        """
+
+        self.serial = serial
+        self.peer = peer
+        self.waited = waited
+
+    @property
+    def source(self) -> str:
+        """
+        'peer' when chain-loading, else 'central'.
+        """
+
+        return "peer" if self.peer is not None else "central"
+
+class UpgradeScheduler:
+    """
+    Queues OS image downloads and admits them oldest-first per site while fewer
+    than site_limit run at that site and global_limit overall. With bandwidth
+    (bytes/s) set, each admission also takes the image size from a token bucket
+    refilled at that rate, so downloads over the WAN are paced.
+
+    With chain-loading, a device may instead copy the image from a peer at the
+    same site that already downloaded it and converged on its configured IP
+    (register_peer()) - such copies stay on the LAN and skip the caps and the
+    bucket.
+
+    State lives in the job database so the caps hold across gunicorn workers.
+    """
+
+    def __init__(self, path: str = JOB_DB, site_limit: int = UPGRADE_SITE_LIMIT, global_limit: int = UPGRADE_GLOBAL_LIMIT, bandwidth: float = UPGRADE_BANDWIDTH,
+                 chain_load: bool = UPGRADE_CHAIN_LOAD, timeout: int = UPGRADE_TIMEOUT, queue_timeout: int = UPGRADE_QUEUE_TIMEOUT, poll: float = UPGRADE_POLL) -> None:
+        """
+        Constructor - creates the tables if missing.
+        """
+
+        self.path = path
+        self.site_limit = site_limit
+        self.global_limit = global_limit
+        self.bandwidth = bandwidth
+        self.chain_load = chain_load
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.poll = poll
+        # (peer host, image) -> monotonic expiry of a passed verify_peer - one login per peer and wave, not per waiter and poll.
+        self._verified = {}
+
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS upgrades (
+                            serial TEXT PRIMARY KEY,
+                            site TEXT,
+                            host TEXT,
+                            image TEXT,
+                            size INTEGER,
+                            pid INTEGER,
+                            state TEXT,
+                            peer TEXT,
+                            queued REAL,
+                            started REAL,
+                            finished REAL,
+                            peer_host TEXT,
+                            checked REAL)""")
+            # Tables created by older releases.
+            columns = [row["name"] for row in db.execute("PRAGMA table_info(upgrades)")]
+            for column, column_type in (("peer_host", "TEXT"), ("checked", "REAL")):
+                if column not in columns:
+                    db.execute(f"ALTER TABLE upgrades ADD COLUMN {column} {column_type}")
+            db.execute("""CREATE TABLE IF NOT EXISTS upgrade_bucket (
+                            id INTEGER PRIMARY KEY CHECK (id = 1),
+                            tokens REAL,
+                            updated REAL)""")
+            db.execute("INSERT OR IGNORE INTO upgrade_bucket VALUES (1, 0, ?)", (time.time(),))
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        New connection per operation - safe across threads and forks.
+        """
+
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _expire(self, db: sqlite3.Connection) -> None:
+        """
+        Drops entries of dead workers, queued entries their waiter stopped
+        re-checking and downloads running past the timeout.
+        """
+
+        now = time.time()
+        stale = now - self.poll * UPGRADE_STALE_POLLS
+        for row in db.execute("SELECT serial, pid, state, started, COALESCE(checked, queued) AS checked FROM upgrades WHERE state != 'done'").fetchall():
+            if not pid_alive(row["pid"]) \
+                or (row["state"] == "queued" and row["checked"] < stale) \
+                or (row["state"] == "downloading" and now - row["started"] > self.timeout):
+                logger.warning("%s - Dropping stale OS upgrade entry (%s)", row["serial"], row["state"])
+                db.execute("DELETE FROM upgrades WHERE serial = ?", (row["serial"],))
+
+    def _tokens(self, db: sqlite3.Connection) -> float:
+        """
+        Refills the bucket, returns available bytes. Allowed to go negative (one
+        image of burst), the debt is paid back at the bandwidth rate.
+        """
+
+        now = time.time()
+        row = db.execute("SELECT tokens, updated FROM upgrade_bucket WHERE id = 1").fetchone()
+        tokens = min(0.0, row["tokens"] + (now - row["updated"]) * self.bandwidth)
+        db.execute("UPDATE upgrade_bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens, now))
+
+        return tokens
+
+    @staticmethod
+    def _busy_peers(db: sqlite3.Connection) -> set:
+        """
+        Returns hosts currently serving a chain-load.
+        """
+
+        return {peer for (peer,) in db.execute("SELECT peer FROM upgrades WHERE state = 'downloading' AND peer IS NOT NULL")}
+
+    def _peer(self, serial: str, verify_peer=None) -> str:
+        """
+        Returns management IP of a reachable, registered peer at serial's site
+        holding the same image and not already serving it, None if there is none.
+        verify_peer(host), if given, has to confirm the image on the peer - a peer
+        failing it is unregistered.
+        """
+
+        with closing(self._connect()) as db:
+            busy = self._busy_peers(db)
+            peers = [(row["peer_host"], row["image"]) for row in db.execute("SELECT peer.peer_host, peer.image FROM upgrades AS peer JOIN upgrades AS device ON device.serial = ? "
+                                                                            "WHERE peer.state = 'done' AND peer.peer_host IS NOT NULL AND peer.site = device.site AND peer.image = device.image "
+                                                                            "ORDER BY peer.finished DESC", (serial,))]
+
+        for host, image in peers:
+            if host in busy:
+                continue
+            try:
+                with closing(socket.create_connection((host, 22), timeout=2)):
+                    pass
+            except OSError:
+                logger.debug("%s - Peer %s not reachable for chain-loading", serial, host)
+                continue
+
+            if verify_peer is not None and self._verified.get((host, image), 0) < time.monotonic():
+                if not verify_peer(host):
+                    logger.warning("%s - Peer %s does not hold the expected image, no longer used for chain-loading", serial, host)
+                    self.unregister_peer(host)
+                    continue
+                self._verified[(host, image)] = time.monotonic() + self.timeout
+
+            return host
+
+        return None
+
+    def register_peer(self, serial: str, host: str) -> None:
+        """
+        Lets serial serve its image to devices at its site - call once it converged
+        on its configured management IP host. No-op unless serial was upgraded here.
+        """
+
+        with closing(self._connect()) as db:
+            cursor = db.execute("UPDATE upgrades SET peer_host = ? WHERE serial = ? AND state = 'done'", (host, serial))
+
+        if cursor.rowcount:
+            logger.info("%s - Registered as chain-loading peer on %s", serial, host)
+
+    def unregister_peer(self, host: str) -> None:
+        """
+        Stops using host as a chain-loading peer.
+        """
+
+        with closing(self._connect()) as db:
+            db.execute("UPDATE upgrades SET peer_host = NULL WHERE peer_host = ?", (host,))
+
+        for key in [key for key in self._verified if key[0] == host]:
+            self._verified.pop(key, None)
+
+    def request(self, serial: str, site: str, host: str, image: str, size: int = UPGRADE_IMAGE_SIZE, queued: float = None) -> None:
+        """
+        Queues serial for an image download - at queued (epoch seconds, default now),
+        so a re-queued entry keeps its place.
+        """
+
+        with closing(self._connect()) as db:
+            now = time.time()
+            db.execute("INSERT OR REPLACE INTO upgrades (serial, site, host, image, size, pid, state, queued, checked) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                       (serial, site, host, image, size, os.getpid(), queued or now, now))
+
+    def check_in(self, serial: str) -> bool:
+        """
+        Marks serial's queued entry as still waited on. Returns False if it is no
+        longer queued (dropped as stale).
+        """
+
+        with closing(self._connect()) as db:
+            cursor = db.execute("UPDATE upgrades SET checked = ? WHERE serial = ? AND state = 'queued'", (time.time(), serial))
+
+        return cursor.rowcount > 0
+
+    def try_admit(self, serial: str, verify_peer=None) -> UpgradeSlot:
+        """
+        Admits serial if a slot (or a verified peer) is free. Returns an
+        UpgradeSlot, None if it has to keep waiting. Call check_in() first - the
+        peer probes can take longer than an entry may go unchecked.
+        """
+
+        # Probed outside the transaction - re-checked below in case another device took it.
+        peer = self._peer(serial, verify_peer) if self.chain_load else None
+
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire(db)
+                row = db.execute("SELECT * FROM upgrades WHERE serial = ?", (serial,)).fetchone()
+                if row is None or row["state"] != "queued":
+                    db.execute("COMMIT")
+                    return None
+                db.execute("UPDATE upgrades SET checked = ? WHERE serial = ?", (time.time(), serial))
+
+                if peer in self._busy_peers(db):
+                    peer = None
+
+                if peer is None:
+                    older = db.execute("SELECT COUNT(*) FROM upgrades WHERE state = 'queued' AND site = ? AND queued < ?", (row["site"], row["queued"])).fetchone()[0]
+                    at_site = db.execute("SELECT COUNT(*) FROM upgrades WHERE state = 'downloading' AND peer IS NULL AND site = ?", (row["site"],)).fetchone()[0]
+                    running = db.execute("SELECT COUNT(*) FROM upgrades WHERE state = 'downloading' AND peer IS NULL").fetchone()[0]
+
+                    if older or at_site >= self.site_limit or running >= self.global_limit:
+                        db.execute("COMMIT")
+                        return None
+
+                    if self.bandwidth:
+                        tokens = self._tokens(db)
+                        if tokens < 0:
+                            db.execute("COMMIT")
+                            return None
+                        db.execute("UPDATE upgrade_bucket SET tokens = ? WHERE id = 1", (tokens - row["size"],))
+
+                db.execute("UPDATE upgrades SET state = 'downloading', peer = ?, started = ? WHERE serial = ?", (peer, time.time(), serial))
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+
+        return UpgradeSlot(serial, peer=peer, waited=time.time() - row["queued"])
+
+    def _average_duration(self, db: sqlite3.Connection) -> float:
+        """
+        Average of the last central downloads, UPGRADE_DEFAULT_DURATION if none yet.
+        """
+
+        durations = [row[0] for row in db.execute("SELECT finished - started FROM upgrades WHERE state = 'done' AND peer IS NULL ORDER BY finished DESC LIMIT 20")]
+        return sum(durations) / len(durations) if durations else UPGRADE_DEFAULT_DURATION
+
+    def eta(self, serial: str) -> float:
+        """
+        Estimated seconds until serial is admitted - the longer of waiting for a
+        site slot and waiting for the bandwidth budget. None if not queued.
+        """
+
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT * FROM upgrades WHERE serial = ?", (serial,)).fetchone()
+            if row is None or row["state"] != "queued":
+                return None
+
+            duration = self._average_duration(db)
+            ahead = db.execute("SELECT COUNT(*) FROM upgrades WHERE state = 'queued' AND site = ? AND queued < ?", (row["site"], row["queued"])).fetchone()[0]
+            at_site = db.execute("SELECT COUNT(*) FROM upgrades WHERE state = 'downloading' AND peer IS NULL AND site = ?", (row["site"],)).fetchone()[0]
+            slot_wait = math.ceil(max(0, ahead + at_site + 1 - self.site_limit) / self.site_limit) * duration
+
+            token_wait = 0.0
+            if self.bandwidth:
+                bucket = db.execute("SELECT tokens, updated FROM upgrade_bucket WHERE id = 1").fetchone()
+                tokens = min(0.0, bucket["tokens"] + (time.time() - bucket["updated"]) * self.bandwidth)
+                queued_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM upgrades WHERE state = 'queued' AND queued < ?", (row["queued"],)).fetchone()[0]
+                token_wait = max(0.0, (queued_bytes - tokens) / self.bandwidth)
+
+        return max(slot_wait, token_wait)
+
+    def _check_queue_timeout(self, serial: str, started: float) -> None:
+        """
+        Raises UpgradeQueueTimeout once serial waited longer than queue_timeout.
+        """
+
+        if time.monotonic() - started > self.queue_timeout:
+            raise UpgradeQueueTimeout(serial, self.queue_timeout)
+
+    def wait(self, serial: str, site: str, host: str, image: str, size: int = UPGRADE_IMAGE_SIZE, on_queued=None, verify_peer=None) -> UpgradeSlot:
+        """
+        Blocking helper - queues serial and returns its UpgradeSlot once admitted.
+        on_queued(eta) is called when it has to wait, and on every re-check.
+        Raises UpgradeQueueTimeout after queue_timeout - serial leaves the queue
+        however the wait ends without a slot.
+        """
+
+        queued = time.time()
+        self.request(serial, site, host, image, size, queued)
+        started = time.monotonic()
+
+        try:
+            while True:
+                if not self.check_in(serial):
+                    logger.warning("%s - OS upgrade entry dropped while waiting, re-queued", serial)
+                    self.request(serial, site, host, image, size, queued)
+
+                slot = self.try_admit(serial, verify_peer)
+                if slot is not None:
+                    return slot
+
+                self._check_queue_timeout(serial, started)
+                if on_queued is not None:
+                    on_queued(self.eta(serial))
+                time.sleep(self.poll)
+        except BaseException:
+            self.finish(serial, success=False)
+            raise
+
+    async def wait_async(self, serial: str, site: str, host: str, image: str, size: int = UPGRADE_IMAGE_SIZE, on_queued=None, verify_peer=None) -> UpgradeSlot:
+        """
+        Awaitable wait() for the async engine.
+        """
+
+        queued = time.time()
+        await asyncio.to_thread(self.request, serial, site, host, image, size, queued)
+        started = time.monotonic()
+
+        try:
+            while True:
+                if not await asyncio.to_thread(self.check_in, serial):
+                    logger.warning("%s - OS upgrade entry dropped while waiting, re-queued", serial)
+                    await asyncio.to_thread(self.request, serial, site, host, image, size, queued)
+
+                slot = await asyncio.to_thread(self.try_admit, serial, verify_peer)
+                if slot is not None:
+                    return slot
+
+                self._check_queue_timeout(serial, started)
+                if on_queued is not None:
+                    # Blocking as well - it records the wait in the job store.
+                    await asyncio.to_thread(on_queued, await asyncio.to_thread(self.eta, serial))
+                await asyncio.sleep(self.poll)
+        except BaseException:
+            await asyncio.to_thread(self.finish, serial, False)
+            raise
+
+    def finish(self, serial: str, success: bool) -> None:
+        """
+        Ends serial's download (or wait for one). Successful ones can serve peers at
+        their site once registered (register_peer()).
+        """
+
+        with closing(self._connect()) as db:
+            if success:
+                db.execute("UPDATE upgrades SET state = 'done', finished = ? WHERE serial = ?", (time.time(), serial))
+            else:
+                db.execute("DELETE FROM upgrades WHERE serial = ?", (serial,))
+
+            # Keep a bounded history of completed downloads (peers and ETAs).
+            db.execute("DELETE FROM upgrades WHERE state = 'done' AND serial NOT IN "
+                       "(SELECT serial FROM upgrades WHERE state = 'done' ORDER BY finished DESC LIMIT 500)")
+
+    def stats(self) -> dict:
+        """
+        Returns running and queued downloads per site, with ETAs.
+        """
+
+        with closing(self._connect()) as db:
+            self._expire(db)
+            rows = db.execute("SELECT serial, site, state, peer, queued, started FROM upgrades WHERE state != 'done' ORDER BY queued").fetchall()
+
+        sites = {}
+        now = time.time()
+        for row in rows:
+            site = sites.setdefault(row["site"], {"downloading": [], "queued": []})
+            if row["state"] == "downloading":
+                site["downloading"].append({"serial": row["serial"], "source": "peer" if row["peer"] else "central", "running": round(now - row["started"], 1)})
+            else:
+                site["queued"].append({"serial": row["serial"], "waited": round(now - row["queued"], 1), "eta": round(self.eta(row["serial"]) or 0, 1)})
+
+        return {"site_limit": self.site_limit,
+                "global_limit": self.global_limit,
+                "bandwidth": self.bandwidth,
+                "chain_load": self.chain_load,
+                "queue_timeout": self.queue_timeout,
+                "sites": sites}
+
+UPGRADE_SCHEDULER = UpgradeScheduler()
+
+if __name__ == "__main__":
+
+    pass
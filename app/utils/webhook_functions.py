@@ -4,92 +4,276 @@
 Helper functions to parse incoming webhook.
 """
 
+import os
 import re
-import sys
+import json
 import logging
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout,
-                level=logging.INFO,
-                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-                )
 
-def get_sender_hostname(data: str) -> str:
+try:
+    LOG_MAX_LINE = int(os.environ["LOG_MAX_LINE"])
+except KeyError:
+    LOG_MAX_LINE = 65536
+
+# FortiGate logs are key=value pairs, values optionally double-quoted.
+KV_PATTERN = r'(\w+)=(?:"((?:[^"\\]|\\.)*)"|(\S*))'
+KV_REGEX = re.compile(KV_PATTERN)
+KV_REGEX_BYTES = re.compile(KV_PATTERN.encode())
+AP_REGEX = re.compile(r"AP[-|_].*\b")
+BGP_UP_REGEX = re.compile(r"VRF\s[0-9]\sneighbor\s((?:[0-9]{1,3}\.){3}[0-9]{1,3})\sUp")
+
+LEASE_FIELDS = ("devname", "hostname", "ip", "mac")
+
+class LeaseRecord:
+    """
+    DHCP lease handed out by a FortiGate.
+    """
+
+    __slots__ = ("sender", "hostname", "ip", "mac")
+
+    def __init__(self, sender: str, hostname: str, ip: str, mac: str) -> None:
+        """
+        Constructor.
+        """
+
+        self.sender = sender
+        self.hostname = hostname
+        self.ip = ip
+        self.mac = mac
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> "LeaseRecord":
+        """
+        Builds record from tokenized log fields.
+        """
+
+        return cls(sender=fields.get("devname"),
+                   hostname=fields.get("hostname"),
+                   ip=fields.get("ip"),
+                   mac=fields.get("mac"))
+
+    def as_dict(self) -> dict:
+        """
+        Returns the device dict main() expects.
+        """
+
+        return {"ip": self.ip, "mac": self.mac}
+
+def tokenize_log(data, wanted: tuple = None) -> dict:
+    """
+    Single pass over a FortiGate log line (str or bytes, not copied) returning
+    its key=value fields. Stops early once all wanted keys are found.
+    """
+
+    if isinstance(data, str):
+        regex = KV_REGEX
+        decode = None
+    else:
+        regex = KV_REGEX_BYTES
+        decode = bytes.decode
+
+    fields = {}
+    for match in regex.finditer(data):
+        key, quoted, bare = match.groups()
+        value = quoted if quoted is not None else bare
+
+        if decode is not None:
+            key = decode(key, "ascii", "replace")
+            value = decode(value, "utf-8", "replace")
+
+        if wanted is not None and key not in wanted:
+            continue
+
+        fields[key] = value
+
+        if wanted is not None and len(fields) == len(wanted):
+            break
+
+    return fields
+
+def get_sender_hostname(data) -> str:
     """
     Parse originating devices' hostname from log.
     """
 
-    try:
-        return re.search(r'devname="?([^"]*)"?\s', data).group(1)
-    except AttributeError:
+    sender = tokenize_log(data, wanted=("devname",)).get("devname")
+    if sender is None:
         logger.error("No Sender Name")
-        return None
+    return sender
 
-def get_device_hostname(data: str) -> str:
+def get_device_hostname(data) -> str:
     """
     Parse originating devices' hostname from log.
     """
 
-    try:
-        return re.search(r'hostname="?([^"]*)"?\s', data).group(1)
-    except AttributeError:
+    hostname = tokenize_log(data, wanted=("hostname",)).get("hostname")
+    if hostname is None:
         logger.error("No Device Name")
-        return None
+    return hostname
 
-
-def get_ip_address(data: str) -> str:
+def get_ip_address(data) -> str:
     """
-    Parse device-IP from log.
+    Parse device-IP (lease IP) from log.
     """
 
-    try:
-        return re.search(r"(\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b)", data).group(0)
-    except AttributeError:
+    ip_address = tokenize_log(data, wanted=("ip",)).get("ip")
+    if ip_address is None:
         logger.error("No IP-Address")
-        return None
+    return ip_address
 
-def get_mac_address(data: str) -> str:
+def get_mac_address(data) -> str:
     """
     Parse device-mac from log.
     """
 
-    try:
-        return re.search(r"([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})", data).group(0)
-    except AttributeError:
+    mac_address = tokenize_log(data, wanted=("mac",)).get("mac")
+    if mac_address is None:
         logger.error("No MAC-Address")
-        return None
+    return mac_address
 
-def parse_dhcp_log(data: str) -> dict:
+def skip_reason(lease: LeaseRecord) -> str:
     """
-    Parse device-information from log. Returns dict
+    Returns why lease should not be provisioned, None if it should.
     """
 
-    sender_hostname = get_sender_hostname(data)
-    device_hostname = get_device_hostname(data)
-    ip_address = get_ip_address(data)
-    mac_address = get_mac_address(data)
+    if lease.ip is None or lease.mac is None:
+        return "incomplete"
+
+    if lease.hostname is not None and AP_REGEX.match(lease.hostname):
+        return "access_point"
 
-    logger.info("%s handed out lease - MAC: %s - IP: %s - Client: %s", sender_hostname,
-                                                                        mac_address,
-                                                                        ip_address,
-                                                                        device_hostname)
+    return None
 
-    if re.match(r"AP[-|_].*\b", device_hostname):
+def parse_dhcp_log(data) -> LeaseRecord:
+    """
+    Parse device-information from log. Returns LeaseRecord, None if it should not be provisioned.
+    """
+
+    lease = LeaseRecord.from_fields(tokenize_log(data, wanted=LEASE_FIELDS))
+
+    logger.info("%s handed out lease - MAC: %s - IP: %s - Client: %s", lease.sender,
+                                                                        lease.mac,
+                                                                        lease.ip,
+                                                                        lease.hostname)
+
+    reason = skip_reason(lease)
+
+    if reason == "incomplete":
+        logger.error("Lease without IP-Address or MAC-Address - automation will not run.")
+        return None
+
+    if reason == "access_point":
         logger.info("DHCP Client hostname contains 'AP-' - automation will not run.")
         return None
 
-    return {"ip": ip_address, "mac": mac_address}
+    return lease
+
+def iter_log_lines(stream, chunk_size: int = 65536, max_line: int = LOG_MAX_LINE):
+    """
+    Yields lines (bytes) from a file-like request stream, reading it in chunks
+    instead of loading the whole body. Only the new chunk is searched for line
+    ends. A line longer than max_line is skipped and yielded as None.
+    """
+
+    buffer = bytearray()
+    too_long = False
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+
+        start = 0
+        end = chunk.find(b"\n")
+        while end != -1:
+            if too_long or len(buffer) + end - start > max_line:
+                yield None
+            elif buffer:
+                buffer += chunk[start:end]
+                yield bytes(buffer)
+            else:
+                yield chunk[start:end]
+            buffer.clear()
+            too_long = False
+            start = end + 1
+            end = chunk.find(b"\n", start)
+
+        if not too_long:
+            buffer += chunk[start:]
+            if len(buffer) > max_line:
+                # Rest of the line is dropped as it arrives.
+                buffer.clear()
+                too_long = True
+
+    if too_long:
+        yield None
+    elif buffer:
+        yield bytes(buffer)
 
-def parse_init_log(data: str) -> dict:
+def parse_log_line(line: bytes) -> LeaseRecord:
+    """
+    Parse one batch line - raw FortiGate log, or NDJSON holding either the raw log
+    ("log"/"message") or the log fields themselves.
+    """
+
+    if line.startswith(b"{"):
+        record = json.loads(line)
+        raw_log = record.get("log", record.get("message"))
+        if isinstance(raw_log, str):
+            return LeaseRecord.from_fields(tokenize_log(raw_log, wanted=LEASE_FIELDS))
+
+        wrong = [field for field in LEASE_FIELDS if record.get(field) is not None and not isinstance(record[field], str)]
+        if wrong:
+            raise TypeError(f"Non-string lease field(s) {', '.join(wrong)}")
+        return LeaseRecord.from_fields(record)
+
+    return LeaseRecord.from_fields(tokenize_log(line, wanted=LEASE_FIELDS))
+
+def parse_log_stream(stream):
+    """
+    Generator over a batch body. Yields (line number, LeaseRecord or None, status).
+    Status is None for provisioning candidates.
+    """
+
+    for number, line in enumerate(iter_log_lines(stream), start=1):
+        if line is None:
+            logger.debug("Line %s - longer than %s bytes", number, LOG_MAX_LINE)
+            yield number, None, "too_long"
+            continue
+
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            lease = parse_log_line(line)
+        except TypeError as exc:
+            logger.debug("Line %s - rejected: %s", number, exc)
+            yield number, None, "rejected"
+            continue
+        except (ValueError, AttributeError) as exc:
+            logger.debug("Line %s - unparsable: %s", number, exc)
+            yield number, None, "invalid"
+            continue
+
+        reason = skip_reason(lease)
+        if reason is not None:
+            yield number, None, reason
+            continue
+
+        yield number, lease, None
+
+def parse_init_log(data) -> dict:
     """
     Parse BGP event.
     """
 
     sender_hostname = get_sender_hostname(data)
 
-    try:
-        re.search(r"VRF\s[0-9]\sneighbor\s((?:[0-9]{1,3}\.){3}[0-9]{1,3})\sUp", data).group(1)
-    except AttributeError:
+    if not isinstance(data, str):
+        data = bytes(data).decode("utf-8", "replace")
+
+    if BGP_UP_REGEX.search(data) is None:
         logger.error("BGP Event was not 'Up'.")
         return None
 
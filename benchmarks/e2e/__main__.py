@@ -0,0 +1,420 @@
+#!/usr/bin/python3
+
+"""
+End-to-end provisioning benchmark - runs the service under gunicorn against
+emulated AOS-CX switches, a stub NetBox and a TFTP sink, all on loopback, fires
+DHCP lease webhooks in bursts and reports throughput and time-to-configured.
+
+    sudo python -m benchmarks.e2e --devices 50 --burst-size 10 --burst-interval 2
+
+Switches listen on port 22 of 127.10.0.0/16 (DHCP leases) and 127.20.0.0/16
+(configured IPs), like real devices - binding port 22 needs root or
+CAP_NET_BIND_SERVICE.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import logging
+import tempfile
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+import asyncssh
+from .aoscx_emulator import EmulatedSwitch
+from .netbox_stub import NetboxStub
+from .tftp_sink import TFTPSink
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout,
+                level=logging.INFO,
+                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+                )
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+METRIC_REGEX = re.compile(r'^(\w+)(?:\{(\w+)="([^"]*)"\})? (\S+)$', re.MULTILINE)
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """
+    Command line.
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.e2e", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=20, help="emulated switches (default 20)")
+    parser.add_argument("--burst-size", type=int, default=10, help="leases per webhook burst (default 10)")
+    parser.add_argument("--burst-interval", type=float, default=1.0, help="seconds between bursts (default 1)")
+    parser.add_argument("--batch", action="store_true", help="send each burst as one /webhook/batch request")
+    parser.add_argument("--boot-delay", type=float, default=2.0, help="max seconds from lease until a switch accepts SSH, spread evenly (default 2)")
+    parser.add_argument("--reboot-delay", type=float, default=3.0, help="seconds a switch takes to come back on its configured IP (default 3)")
+    parser.add_argument("--command-delay", type=float, default=0.05, help="seconds a switch takes per CLI command (default 0.05)")
+    parser.add_argument("--verify-polls", type=int, default=0, help="'show images' answers still verifying the image (default 0)")
+    parser.add_argument("--password-change", type=float, default=1.0, help="share of switches asking for a new password on first login (default 1)")
+    parser.add_argument("--access-ports", type=int, default=48, help="1GbT ports per switch, plus 4 uplinks (default 48)")
+    parser.add_argument("--netbox-latency", type=float, default=0.0, help="seconds added to every stub NetBox request (default 0)")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers (default 2)")
+    parser.add_argument("--job-workers", type=int, default=4, help="JOB_WORKERS per gunicorn worker (default 4)")
+    parser.add_argument("--engine", choices=("sync", "async"), default="sync", help="PROVISION_ENGINE (default sync)")
+    parser.add_argument("--async-concurrency", type=int, default=100, help="ASYNC_CONCURRENCY with --engine async (default 100)")
+    parser.add_argument("--embedded-tftp", action="store_true", help="serve configs with the service's embedded TFTP server instead of the sink")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra environment for the service")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for all devices (default 600)")
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory (service log, configs)")
+
+    return parser.parse_args(argv)
+
+def free_port(kind: int = socket.SOCK_STREAM) -> int:
+    """
+    Returns a free loopback port.
+    """
+
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def lease_log(mac: str, ip_address: str, hostname: str = "switch") -> str:
+    """
+    FortiGate DHCP ACK log line for a lease.
+    """
+
+    now = time.strftime("%Y-%m-%d time=%H:%M:%S")
+    return (f'date={now} devname="FGT-BENCH-01" devid="FG100FTK00000001" eventtime={time.time_ns()} tz="+0000" '
+            f'logid="0100026001" type="event" subtype="system" level="information" vd="root" logdesc="DHCP Ack log" '
+            f'interface="provisioning" dhcp_msg="Ack" mac="{mac}" ip={ip_address} lease=86400 hostname="{hostname}" '
+            f'msg="DHCP server sends a DHCPACK"')
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Nearest-rank percentile, None if values is empty.
+    """
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))]
+
+def device_plan(count: int) -> list:
+    """
+    Serial, hostname, MAC, lease IP and configured IP per device.
+    """
+
+    plan = []
+    for number in range(count):
+        high, low = divmod(number, 250)
+        plan.append({"serial": f"BENCH{number:05d}",
+                     "name": f"bench-sw-{number:05d}",
+                     "mac": f"02:BE:00:00:{number >> 8:02X}:{number & 0xff:02X}",
+                     "lease_ip": f"127.10.{high}.{low + 1}",
+                     "ip_address": f"127.20.{high}.{low + 1}/16"})
+
+    return plan
+
+class ServiceProcess:
+    """
+    The service under gunicorn, on a free loopback port.
+    """
+
+    def __init__(self, workdir: str, env: dict, workers: int) -> None:
+        """
+        Constructor.
+        """
+
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log_path = os.path.join(workdir, "service.log")
+        self.config_path = os.path.join(workdir, "gunicorn.conf.py")
+        self.env = {**os.environ, **env}
+        self.workers = workers
+        self.process = None
+
+    def start(self, timeout: float = 60) -> None:
+        """
+        Starts gunicorn and waits until /jobs answers.
+        """
+
+        # Plain HTTP - the repo's gunicorn.conf.py wants TLS certificates.
+        with open(self.config_path, "w", encoding="utf-8") as config:
+            config.write(f"bind = '127.0.0.1:{self.port}'\nworkers = {self.workers}\npreload_app = True\ntimeout = 1500\n")
+
+        with open(self.log_path, "wb") as log:
+            self.process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", self.config_path, "app:app"], # pylint: disable=consider-using-with
+                                            cwd=REPO_ROOT, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Service exited with {self.process.returncode}, see {self.log_path}")
+            try:
+                with urllib.request.urlopen(f"{self.url}/jobs", timeout=2):
+                    return
+            except (urllib.error.URLError, OSError):
+                time.sleep(0.2)
+
+        raise RuntimeError(f"Service did not answer within {timeout}s, see {self.log_path}")
+
+    def stop(self) -> None:
+        """
+        Stops gunicorn.
+        """
+
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def post(self, path: str, body: str) -> int:
+        """
+        POSTs body, returns the HTTP status.
+        """
+
+        request = urllib.request.Request(f"{self.url}{path}", data=body.encode(), method="POST", headers={"Content-Type": "text/plain"})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status
+        except urllib.error.HTTPError as exc:
+            return exc.code
+
+    def metrics(self) -> dict:
+        """
+        Returns /metrics as {(name, label value): value}.
+        """
+
+        with urllib.request.urlopen(f"{self.url}/metrics", timeout=10) as response:
+            text = response.read().decode()
+
+        return {(name, label_value): float(value) for name, _, label_value, value in METRIC_REGEX.findall(text)}
+
+async def fire_bursts(service: ServiceProcess, plan: list, burst_size: int, interval: float, batch: bool, sent: dict) -> dict:
+    """
+    Sends lease webhooks burst_size at a time, records send time per serial.
+    Returns HTTP status counts.
+    """
+
+    statuses = {}
+    for start in range(0, len(plan), burst_size):
+        burst = plan[start:start + burst_size]
+        now = time.time()
+        for device in burst:
+            sent[device["serial"]] = now
+
+        if batch:
+            body = "\n".join(lease_log(device["mac"], device["lease_ip"]) for device in burst)
+            results = [await asyncio.to_thread(service.post, "/webhook/batch", body)]
+        else:
+            results = await asyncio.gather(*(asyncio.to_thread(service.post, "/webhook", lease_log(device["mac"], device["lease_ip"])) for device in burst))
+
+        for status in results:
+            statuses[status] = statuses.get(status, 0) + 1
+
+        if start + burst_size < len(plan):
+            await asyncio.sleep(interval)
+
+    return statuses
+
+async def sample_inflight(service: ServiceProcess, stop: asyncio.Event, samples: list, interval: float = 0.5) -> None:
+    """
+    Samples jobs in flight (all workers) until stop is set.
+    """
+
+    while not stop.is_set():
+        try:
+            metrics = await asyncio.to_thread(service.metrics)
+            samples.append(metrics.get(("provision_jobs_inflight", ""), 0.0))
+        except (urllib.error.URLError, OSError):
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def wait_done(netbox: NetboxStub, plan: list, timeout: float) -> bool:
+    """
+    Waits until every device is active or failed in NetBox.
+    """
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        done = sum(1 for device in plan if {"active", "failed"} & set(netbox.status_times.get(device["serial"], {})))
+        if done == len(plan):
+            return True
+        await asyncio.sleep(0.5)
+
+    return False
+
+def build_report(args: argparse.Namespace, plan: list, sent: dict, netbox: NetboxStub, switches: list, samples: list, metrics: dict, statuses: dict, wall: float, finished: bool) -> dict:
+    """
+    Throughput, time-to-configured and occupancy from the run.
+    """
+
+    configured = {device["serial"]: netbox.status_times[device["serial"]]["active"] for device in plan if "active" in netbox.status_times.get(device["serial"], {})}
+    failed = [device["serial"] for device in plan if "failed" in netbox.status_times.get(device["serial"], {}) and device["serial"] not in configured]
+    ttc = [configured[serial] - sent[serial] for serial in configured]
+    span = (max(configured.values()) - min(sent.values())) if configured else None
+    capacity = args.workers * (args.job_workers if args.engine == "sync" else args.async_concurrency)
+
+    phases = {}
+    for (name, phase), value in metrics.items():
+        if name == "provision_phase_seconds_count" and value:
+            phases[phase] = {"count": int(value), "mean": round(metrics[("provision_phase_seconds_sum", phase)] / value, 3)}
+
+    return {"devices": len(plan),
+            "configured": len(configured),
+            "failed": failed,
+            "unfinished": [device["serial"] for device in plan if device["serial"] not in configured and device["serial"] not in failed],
+            "finished_before_timeout": finished,
+            "wall_seconds": round(wall, 1),
+            "devices_per_minute": round(len(configured) / span * 60, 2) if span else None,
+            "time_to_configured": {"p50": percentile(ttc, 50), "p99": percentile(ttc, 99), "max": max(ttc) if ttc else None},
+            "worker_occupancy": {"capacity": capacity,
+                                 "inflight_mean": round(sum(samples) / len(samples), 2) if samples else None,
+                                 "inflight_max": max(samples) if samples else None,
+                                 "mean_percent": round(sum(samples) / len(samples) / capacity * 100, 1) if samples else None},
+            "phases": phases,
+            "outcomes": {outcome: int(value) for (name, outcome), value in metrics.items() if name == "provision_outcomes_total" and value},
+            "webhook_statuses": statuses,
+            "netbox_calls": netbox.calls,
+            "password_changes": sum(1 for switch in switches if "password_changed" in switch.events)}
+
+def print_report(report: dict) -> None:
+    """
+    Human-readable report.
+    """
+
+    ttc = report["time_to_configured"]
+    occupancy = report["worker_occupancy"]
+
+    def seconds(value):
+        return "-" if value is None else f"{value:.1f}s"
+
+    print()
+    print(f"Devices            {report['configured']}/{report['devices']} configured, {len(report['failed'])} failed, {len(report['unfinished'])} unfinished ({report['wall_seconds']}s)")
+    print(f"Throughput         {report['devices_per_minute'] or '-'} devices/min")
+    print(f"Time-to-configured p50 {seconds(ttc['p50'])}  p99 {seconds(ttc['p99'])}  max {seconds(ttc['max'])}")
+    print(f"Worker occupancy   mean {occupancy['inflight_mean']} / max {occupancy['inflight_max']} of {occupancy['capacity']} job slots ({occupancy['mean_percent']}%)")
+    print("Phases (mean)      " + "  ".join(f"{phase} {values['mean']}s" for phase, values in report["phases"].items()))
+    print(f"Outcomes           {json.dumps(report['outcomes'])}")
+    print(f"NetBox calls       {json.dumps(report['netbox_calls'])}")
+
+async def run(args: argparse.Namespace) -> dict:
+    """
+    Sets everything up, runs the bursts and collects the report.
+    """
+
+    workdir = tempfile.mkdtemp(prefix="dhcp_provision_e2e_")
+    tftp_root = os.path.join(workdir, "tftp")
+    metrics_dir = os.path.join(workdir, "metrics")
+    os.makedirs(tftp_root)
+    os.makedirs(metrics_dir)
+
+    plan = device_plan(args.devices)
+    netbox = NetboxStub(latency=args.netbox_latency)
+    for device in plan:
+        netbox.add_device(device["serial"], device["name"], device["ip_address"], device["mac"])
+    netbox.start()
+
+    sink = None
+    if args.embedded_tftp:
+        tftp_port = free_port(socket.SOCK_DGRAM)
+    else:
+        sink = TFTPSink(tftp_root)
+        sink.start()
+        tftp_port = sink.port
+
+    env = {"NETBOX_HOST": netbox.address,
+           "NB_API_TOKEN": "benchmark",
+           "TFTP_SERVER": "127.0.0.1",
+           "TFTP_ROOT": tftp_root,
+           "TFTP_EMBEDDED": "true" if args.embedded_tftp else "false",
+           "TFTP_BIND": "127.0.0.1",
+           "TFTP_PORT": str(tftp_port),
+           "JOB_DB": os.path.join(workdir, "jobs.sqlite"),
+           "JINJA_CACHE_DIR": os.path.join(workdir, "jinja"),
+           "PROMETHEUS_MULTIPROC_DIR": metrics_dir,
+           "JOB_WORKERS": str(args.job_workers),
+           "PROVISION_ENGINE": args.engine,
+           "ASYNC_CONCURRENCY": str(args.async_concurrency),
+           "CONNECT_BACKOFF_MIN": "0.5",
+           "CONNECT_BACKOFF_MAX": "5",
+           "CONVERGE_POLL": "1",
+           "PROBE_TIMEOUT": "1",
+           "NB_INDEX_REFRESH": "5",
+           "NB_FLUSH_INTERVAL": "0.5",
+           "SFTP_SERVER": "127.0.0.1", "SFTP_USER": "benchmark", "SFTP_PASSWORD": "benchmark"}
+    env.update(dict(item.split("=", 1) for item in args.env))
+
+    host_key = asyncssh.generate_private_key("ssh-ed25519")
+    stop = asyncio.Event()
+    switches = [EmulatedSwitch(serial=device["serial"], dhcp_ip=device["lease_ip"], mac=device["mac"], host_key=host_key,
+                               tftp_port=tftp_port, access_ports=args.access_ports,
+                               boot_delay=args.boot_delay * number / max(1, len(plan) - 1),
+                               reboot_delay=args.reboot_delay, command_delay=args.command_delay,
+                               password_change=number < round(args.password_change * len(plan)),
+                               verify_polls=args.verify_polls)
+                for number, device in enumerate(plan)]
+
+    service = ServiceProcess(workdir, env, args.workers)
+    tasks = []
+    try:
+        await asyncio.to_thread(service.start)
+        logger.info("Service up on %s (%s worker(s), %s engine), NetBox stub on %s, TFTP on port %s", service.url, args.workers, args.engine, netbox.address, tftp_port)
+
+        samples = []
+        sent = {}
+        started = time.monotonic()
+        tasks = [asyncio.create_task(switch.run(stop)) for switch in switches]
+        sampler = asyncio.create_task(sample_inflight(service, stop, samples))
+
+        statuses = await fire_bursts(service, plan, args.burst_size, args.burst_interval, args.batch, sent)
+        finished = await wait_done(netbox, plan, args.timeout)
+        wall = time.monotonic() - started
+
+        stop.set()
+        await sampler
+        metrics = await asyncio.to_thread(service.metrics)
+
+        return build_report(args, plan, sent, netbox, switches, samples, metrics, statuses, wall, finished)
+    finally:
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        service.stop()
+        netbox.stop()
+        if sink is not None:
+            sink.stop()
+        if args.keep:
+            logger.info("Work directory kept: %s", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def main(argv: list = None) -> int:
+    """
+    Runs the benchmark, prints the report. Exit code 1 if any device was not configured.
+    """
+
+    args = parse_args(argv)
+    logging.getLogger("asyncssh").setLevel(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+    return 0 if report["configured"] == report["devices"] else 1
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+
+"""
+AOS-CX switch emulator - an asyncssh server per switch answering the commands
+provisioning sends, with a boot delay, the factory first-login password change,
+image verification and a reload onto the configured IP after the TFTP copy.
+"""
+
+import re
+import time
+import socket
+import struct
+import asyncio
+import logging
+import asyncssh
+from . import aoscx_outputs
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+COPY_REGEX = re.compile(r"^copy tftp://([^/]+)/(\S+) (\S+)$")
+HOSTNAME_REGEX = re.compile(r"^hostname (\S+)", re.MULTILINE)
+VLAN1_IP_REGEX = re.compile(r"^interface vlan 1\s*\n\s+ip address (\S+)", re.MULTILINE)
+
+def tftp_get(host: str, port: int, filename: str, timeout: float = 2.0, retries: int = 5) -> bytes:
+    """
+    Plain RFC 1350 read request (512 byte blocks, no options) - returns the file.
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    request = struct.pack("!H", 1) + filename.encode() + b"\0octet\0"
+    data = b""
+    expected = 1
+    peer = None
+
+    try:
+        sock.sendto(request, (host, port))
+        last = request
+        attempts = 0
+        while True:
+            try:
+                packet, address = sock.recvfrom(65536)
+            except socket.timeout:
+                attempts += 1
+                if attempts > retries:
+                    raise
+                sock.sendto(last, peer or (host, port))
+                continue
+
+            opcode = struct.unpack("!H", packet[:2])[0]
+            if opcode == 5:
+                raise FileNotFoundError(f"TFTP error for {filename}: {packet[4:-1].decode(errors='replace')}")
+            if opcode != 3:
+                continue
+
+            peer = address
+            block = struct.unpack("!H", packet[2:4])[0]
+            if block == expected & 0xffff:
+                data += packet[4:]
+                expected += 1
+            last = struct.pack("!HH", 4, block)
+            sock.sendto(last, peer)
+            attempts = 0
+
+            if block == (expected - 1) & 0xffff and len(packet) - 4 < 512:
+                return data
+    finally:
+        sock.close()
+
+class _SSHServer(asyncssh.SSHServer):
+    """
+    Password login for admin, any password (factory default is empty).
+    """
+
+    def begin_auth(self, username: str) -> bool:
+        """
+        Authentication is always required.
+        """
+
+        return True
+
+    def password_auth_supported(self) -> bool:
+        """
+        Password authentication only.
+        """
+
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        """
+        Accepts admin.
+        """
+
+        return username == "admin"
+
+class EmulatedSwitch:
+    """
+    One AOS-CX switch. Boots (listens on dhcp_ip:port) after boot_delay, asks for a
+    new admin password on first login if password_change, reports verifying images
+    for the first verify_polls 'show images', and on 'copy tftp://...' pulls the
+    config, drops the session and comes back on the config's VLAN 1 IP (with its
+    hostname) after reboot_delay.
+    """
+
+    def __init__(self, serial: str, dhcp_ip: str, mac: str, host_key, port: int = 22, tftp_port: int = 69,
+                 access_ports: int = 48, boot_delay: float = 0.0, reboot_delay: float = 2.0, command_delay: float = 0.0,
+                 password_change: bool = True, verify_polls: int = 0, sha256: str = aoscx_outputs.GOLDEN_HASH) -> None:
+        """
+        Constructor.
+        """
+
+        self.serial = serial
+        self.dhcp_ip = dhcp_ip
+        self.mac = mac
+        self.host_key = host_key
+        self.port = port
+        self.tftp_port = tftp_port
+        self.boot_delay = boot_delay
+        self.reboot_delay = reboot_delay
+        self.command_delay = command_delay
+        self.password_change = password_change
+        self.verify_polls = verify_polls
+        self.hostname = "switch"
+        self.configured_ip = None
+        self.events = {}
+        self._outputs = {
+            "show version": aoscx_outputs.show_version(),
+            "show system": None,
+            "show interface": aoscx_outputs.show_interface(access_ports=access_ports, base_mac=mac.lower()),
+        }
+        self._sha256 = sha256
+        self._image_polls = 0
+        self._configured = asyncio.Event()
+        self._server = None
+        self._sessions = set()
+
+    def _event(self, name: str) -> None:
+        """
+        Records when something first happened.
+        """
+
+        self.events.setdefault(name, time.time())
+
+    async def run(self, stop: asyncio.Event) -> None:
+        """
+        Boots, serves until configured, reloads onto the configured IP and serves
+        there until stop is set.
+        """
+
+        await asyncio.sleep(self.boot_delay)
+        self._server = await self._listen(self.dhcp_ip)
+        self._event("booted")
+
+        await self._configured.wait()
+        self._server.close()
+
+        await asyncio.sleep(self.reboot_delay)
+        self._server = await self._listen(self.configured_ip)
+        self._event("reloaded")
+
+        await stop.wait()
+        self._server.close()
+
+    async def _listen(self, address: str):
+        """
+        Starts the SSH server on address.
+        """
+
+        return await asyncssh.create_server(_SSHServer, address, self.port,
+                                            server_host_keys=[self.host_key],
+                                            process_factory=self._session,
+                                            reuse_address=True)
+
+    def _prompt(self) -> str:
+        """
+        CLI prompt.
+        """
+
+        return f"{self.hostname}# "
+
+    async def _read_secret(self, process, prompt: str) -> str:
+        """
+        Reads a line without echo.
+        """
+
+        process.channel.set_echo(False)
+        process.stdout.write(prompt)
+        try:
+            return (await process.stdin.readline()).rstrip("\r\n")
+        finally:
+            process.channel.set_echo(True)
+
+    async def _session(self, process) -> None:
+        """
+        One CLI session.
+        """
+
+        self._sessions.add(process)
+        try:
+            if self.password_change:
+                process.stdout.write("\r\nPlease configure the 'admin' user account password.\r\n")
+                await self._read_secret(process, "Enter new password: ")
+                await self._read_secret(process, "Confirm new password: ")
+                self.password_change = False
+                self._event("password_changed")
+
+            process.stdout.write("\r\n" + self._prompt())
+            while True:
+                line = await process.stdin.readline()
+                if not line:
+                    break
+                command = line.strip()
+                if command == "exit":
+                    break
+
+                output = await self._execute(command)
+                if output:
+                    process.stdout.write(output.replace("\n", "\r\n"))
+                process.stdout.write(self._prompt())
+        except (asyncssh.BreakReceived, asyncssh.TerminalSizeChanged, asyncssh.ConnectionLost, BrokenPipeError):
+            pass
+        finally:
+            self._sessions.discard(process)
+            process.exit(0)
+
+    async def _execute(self, command: str) -> str:
+        """
+        Returns output of command.
+        """
+
+        # Empty lines (prompt refresh) are answered right away, like on a real switch.
+        if not command or command == "no page":
+            return ""
+
+        if self.command_delay:
+            await asyncio.sleep(self.command_delay)
+
+        if command == "show system":
+            self._event("identified")
+            return aoscx_outputs.show_system(self.hostname, self.serial, "JL661A 6300M 48G CL4 PoE 4SFP56 Swch", self.mac.lower())
+
+        if command == "show images":
+            self._image_polls += 1
+            if self._image_polls <= self.verify_polls:
+                return aoscx_outputs.show_images(self._sha256, verifying=min(99, 100 * self._image_polls // (self.verify_polls + 1)))
+            return aoscx_outputs.show_images(self._sha256)
+
+        if command == "show hostname":
+            return f"{self.hostname}\n"
+
+        if command in self._outputs:
+            return self._outputs[command]
+
+        match = COPY_REGEX.match(command)
+        if match is not None:
+            return await self._copy(*match.groups())
+
+        return f"Invalid input: {command}\n"
+
+    async def _copy(self, server: str, filename: str, data_store: str) -> str:
+        """
+        Pulls the config over TFTP and schedules the reload onto it.
+        """
+
+        try:
+            config = (await asyncio.to_thread(tftp_get, server, self.tftp_port, filename)).decode("utf-8", "replace")
+        except (OSError, FileNotFoundError) as exc:
+            logger.error("%s - TFTP copy of %s failed: %s", self.serial, filename, exc)
+            return "Copying configuration: [Failed]\n"
+
+        hostname = HOSTNAME_REGEX.search(config)
+        address = VLAN1_IP_REGEX.search(config)
+        if hostname is None or address is None:
+            logger.error("%s - Config %s has no hostname / VLAN 1 address", self.serial, filename)
+            return "Copying configuration: [Failed]\n"
+
+        self.hostname = hostname.group(1)
+        self.configured_ip = address.group(1).split("/")[0]
+        self._event("config_copied")
+        logger.debug("%s - %s copied to %s, reloading onto %s", self.serial, filename, data_store, self.configured_ip)
+
+        asyncio.get_running_loop().call_later(0.5, self._reload)
+
+        return "Copying configuration: [Success]\n"
+
+    def _reload(self) -> None:
+        """
+        Goes down for the reload - open sessions drop.
+        """
+
+        self._configured.set()
+        for process in list(self._sessions):
+            process.channel.get_connection().close()
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+"""
+Canned AOS-CX command output for the switch emulator - shaped like a 6300M, parsed
+by the same ntc-templates the service uses.
+"""
+
+# Golden image hash of the built-in OS manifest (app/utils/manifest_functions.py).
+GOLDEN_HASH = "468450af91ffd58ccafc700e72767a6be81fcbc1ce9fb43c1c74f700272c937f"
+OLD_HASH = "0b4f2c1e7a5d9c3e8f6a1b2d4c6e8f0a1b3c5d7e9f1a3b5c7d9e1f3a5b7c9d1e"
+
+RULE = "-" * 75
+
+def show_version(version: str = "FL.10.10.1040") -> str:
+    """
+    'show version'.
+    """
+
+    return (f"{RULE}\n"
+            "ArubaOS-CX\n"
+            "(c) Copyright 2017-2022 Hewlett Packard Enterprise Development LP\n"
+            f"{RULE}\n"
+            f"Version      : {version}\n"
+            "Build Date   : 2022-09-22 11:03:43 UTC\n"
+            "Build ID     : ArubaOS-CX:FL.10.10.1040:4bba5f56cc0e:202209221103\n"
+            "Build SHA    : 4bba5f56cc0e7d3d1d8e2e5c1c4b1e0b8c8b0c1a\n"
+            "Hot Patches  :\n"
+            "Active Image : primary\n"
+            "\n"
+            "Service OS Version : FL.01.10.0002\n"
+            "BIOS Version       : FL.01.0002\n")
+
+def show_system(hostname: str, serial: str, product: str, base_mac: str, version: str = "FL.10.10.1040") -> str:
+    """
+    'show system'.
+    """
+
+    return (f"Hostname                        : {hostname}\n"
+            f"System Description              : {version}\n"
+            "System Contact                  : \n"
+            "System Location                 : \n"
+            "Vendor                          : Aruba\n"
+            f"Product Name                    : {product}\n"
+            f"Chassis Serial Nbr              : {serial}\n"
+            f"Base MAC Address                : {base_mac}\n"
+            f"ArubaOS-CX Version              : {version}\n"
+            "Time Zone                       : UTC\n"
+            "\n"
+            "Up Time                         : 4 minutes\n"
+            "CPU Util (%)                    : 7\n"
+            "CPU Util (%) 1 min              : 9\n"
+            "Memory Usage (%)                : 23\n")
+
+def show_images(sha256: str = GOLDEN_HASH, verifying: int = None, version: str = "FL.10.10.1040") -> str:
+    """
+    'show images' - with the primary image still being verified if verifying
+    (percent) is given.
+    """
+
+    primary = f"Verifying {verifying}% - please wait" if verifying is not None else sha256
+
+    return (f"{RULE}\n"
+            "ArubaOS-CX Primary Image\n"
+            f"{RULE}\n"
+            f"Version : {version}\n"
+            "Size    : 643 MB\n"
+            "Date    : 2022-09-22 11:03:43 UTC\n"
+            f"SHA-256 : {primary}\n"
+            "\n"
+            f"{RULE}\n"
+            "ArubaOS-CX Secondary Image\n"
+            f"{RULE}\n"
+            "Version : FL.10.09.1030\n"
+            "Size    : 612 MB\n"
+            "Date    : 2022-05-10 09:12:01 UTC\n"
+            f"SHA-256 : {OLD_HASH}\n"
+            "\n"
+            "Default Image : primary\n")
+
+def _interface(name: str, if_type: str, speed: str, mac: str, number: int) -> str:
+    """
+    One 'show interface' block.
+    """
+
+    rx_packets, tx_packets = 1000 + number * 37, 800 + number * 29
+    uplink = if_type != "1GbT"
+
+    return (f"Interface {name} is up\n"
+            " Admin state is up\n"
+            " Link state: up for 3 minutes (since Sat Oct 18 10:00:00 UTC 2026)\n"
+            " Link transitions: 1\n"
+            " Description: \n"
+            " Persona: \n"
+            f" Hardware: Ethernet, MAC Address: {mac}\n"
+            " MTU 1500\n"
+            f" Type {if_type}\n"
+            " Full-duplex\n"
+            " qos trust none\n"
+            f" Speed {speed}\n"
+            " Auto-negotiation is on\n"
+            " Flow-control: off\n"
+            " Error-control: off\n"
+            " MDI mode: MDIX\n"
+            + (" VLAN Mode: native-untagged\n Native VLAN: 1\n Allowed VLAN List: 1-4094\n" if uplink else
+               " VLAN Mode: access\n Access VLAN: 1\n") +
+            " Rate collection interval: 300 seconds\n"
+            "\n"
+            " Rate                               RX                   TX        Total (RX+TX)\n"
+            " ---------------- -------------------- -------------------- --------------------\n"
+            " Mbits / sec                      0.01                 0.00                 0.01\n"
+            " KPkts / sec                      0.00                 0.00                 0.00\n"
+            "   Unicast                        0.00                 0.00                 0.00\n"
+            "   Multicast                      0.00                 0.00                 0.00\n"
+            "   Broadcast                      0.00                 0.00                 0.00\n"
+            " Utilization                      0.00                 0.00                 0.00\n"
+            "\n"
+            " Statistic                          RX                   TX                Total\n"
+            " ---------------- -------------------- -------------------- --------------------\n"
+            f" Packets          {rx_packets:>20} {tx_packets:>20} {rx_packets + tx_packets:>20}\n"
+            f"   Unicast        {rx_packets - 40:>20} {tx_packets - 20:>20} {rx_packets + tx_packets - 60:>20}\n"
+            f"   Multicast      {30:>20} {15:>20} {45:>20}\n"
+            f"   Broadcast      {10:>20} {5:>20} {15:>20}\n"
+            f" Bytes            {rx_packets * 92:>20} {tx_packets * 88:>20} {rx_packets * 92 + tx_packets * 88:>20}\n"
+            f" Jumbos           {0:>20} {0:>20} {0:>20}\n"
+            f" Pause Frames     {0:>20} {0:>20} {0:>20}\n"
+            f" Dropped          {0:>20} {0:>20} {0:>20}\n"
+            f" Errors           {0:>20} {0:>20} {0:>20}\n"
+            f"   CRC/FCS        {0:>20} {0:>20} {0:>20}\n"
+            f"   Collision      {'n/a':>20} {0:>20} {0:>20}\n"
+            f" Runts            {0:>20} {0:>20} {0:>20}\n"
+            f" Giants           {0:>20} {0:>20} {0:>20}\n"
+            "\n")
+
+def show_interface(access_ports: int = 48, uplinks: int = 4, base_mac: str = "38:21:c7:5a:00:00") -> str:
+    """
+    'show interface' for a member with access_ports 1GbT ports followed by uplinks
+    SFP56 ports (1/1/1 - 1/1/<access_ports + uplinks>).
+    """
+
+    prefix = base_mac.rsplit(":", 2)[0]
+    blocks = []
+    for number in range(1, access_ports + uplinks + 1):
+        mac = f"{prefix}:{number >> 8:02x}:{number & 0xff:02x}"
+        if number <= access_ports:
+            blocks.append(_interface(f"1/1/{number}", "1GbT", "1000 Mb/s", mac, number))
+        else:
+            blocks.append(_interface(f"1/1/{number}", "SFP56DAC3", "25000 Mb/s", mac, number))
+
+    return "".join(blocks)
+
+if __name__ == "__main__":
+
+    pass
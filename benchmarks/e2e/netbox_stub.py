@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+"""
+Stub NetBox REST API - the /api/dcim endpoints provisioning uses, backed by an
+in-memory device table. Records when each device reaches a status.
+"""
+
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+def _now() -> str:
+    """
+    NetBox timestamp.
+    """
+
+    return datetime.now(timezone.utc).isoformat()
+
+class NetboxStub:
+    """
+    Devices (with one management interface each) served from memory. Every API
+    call is counted, every status change is timestamped in status_times.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0) -> None:
+        """
+        Constructor - port 0 picks a free port.
+        """
+
+        self.latency = latency
+        self.devices = {}
+        self.status_times = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self.address = f"{host}:{self._server.server_address[1]}"
+
+    def add_device(self, serial: str, name: str, primary_ip: str, mac: str, site: str = "SE-BENCH-01", role: str = "Access") -> None:
+        """
+        Adds a planned device.
+        """
+
+        device_id = len(self.devices) + 1
+        self.devices[device_id] = {"id": device_id,
+                                   "name": name,
+                                   "display": name,
+                                   "serial": serial,
+                                   "status": {"value": "planned", "label": "Planned"},
+                                   "device_role": {"id": 1, "name": role, "slug": role.lower(), "display": role},
+                                   "site": {"id": 1, "name": site, "slug": site.lower(), "display": site},
+                                   "primary_ip": {"id": device_id, "address": primary_ip, "family": 4, "display": primary_ip},
+                                   "tags": [],
+                                   "mac": mac,
+                                   "last_updated": _now()}
+
+    def start(self) -> None:
+        """
+        Serves in a background thread.
+        """
+
+        threading.Thread(target=self._server.serve_forever, name="netbox-stub", daemon=True).start()
+
+    def stop(self) -> None:
+        """
+        Stops serving.
+        """
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, call: str) -> None:
+        """
+        Counts an API call.
+        """
+
+        with self._lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+
+    def _device(self, device: dict) -> dict:
+        """
+        Device as the API returns it.
+        """
+
+        return {key: value for key, value in device.items() if key != "mac"}
+
+    def list_devices(self, query: dict) -> list:
+        """
+        GET /api/dcim/devices/ with the filters provisioning uses.
+        """
+
+        with self._lock:
+            devices = list(self.devices.values())
+
+        if "serial" in query:
+            devices = [device for device in devices if device["serial"] in query["serial"]]
+        if "name" in query:
+            devices = [device for device in devices if device["name"] in query["name"]]
+        if "status" in query:
+            devices = [device for device in devices if device["status"]["value"] in query["status"]]
+        if "last_updated__gte" in query:
+            devices = [device for device in devices if device["last_updated"] >= query["last_updated__gte"][0]]
+
+        return [self._device(device) for device in devices]
+
+    def list_interfaces(self, query: dict) -> list:
+        """
+        GET /api/dcim/interfaces/?device_id=... - one management interface per device.
+        """
+
+        wanted = {int(device_id) for device_id in query.get("device_id", [])}
+        with self._lock:
+            devices = [device for device in self.devices.values() if not wanted or device["id"] in wanted]
+
+        return [{"id": device["id"], "name": "mgmt", "mac_address": device["mac"], "device": {"id": device["id"], "name": device["name"], "display": device["name"]}}
+                for device in devices]
+
+    def update_devices(self, changes: list) -> list:
+        """
+        PATCH /api/dcim/devices/ - bulk status/tag updates.
+        """
+
+        updated = []
+        with self._lock:
+            for change in changes:
+                device = self.devices[change["id"]]
+                if "status" in change:
+                    device["status"] = {"value": change["status"], "label": change["status"].capitalize()}
+                    self.status_times.setdefault(device["serial"], {}).setdefault(change["status"], time.time())
+                if "tags" in change:
+                    device["tags"] = [{"id": number, "name": tag["slug"], "slug": tag["slug"], "display": tag["slug"]} for number, tag in enumerate(change["tags"], 1)]
+                device["last_updated"] = _now()
+                updated.append(self._device(device))
+
+        return updated
+
+    def _handler(self):
+        """
+        Request handler class bound to this stub.
+        """
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            NetBox API requests.
+            """
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                """
+                Quiet.
+                """
+
+            def _reply(self, status: int, body) -> None:
+                """
+                Sends JSON body.
+                """
+
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("API-Version", "3.6")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self): # pylint: disable=invalid-name
+                """
+                List endpoints.
+                """
+
+                if stub.latency:
+                    time.sleep(stub.latency)
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+
+                if url.path.rstrip("/") == "/api/dcim/devices":
+                    stub.count("dcim.devices.list")
+                    results = stub.list_devices(query)
+                elif url.path.rstrip("/") == "/api/dcim/interfaces":
+                    stub.count("dcim.interfaces.list")
+                    results = stub.list_interfaces(query)
+                elif url.path.rstrip("/") == "/api/dcim/device-types":
+                    stub.count("dcim.device-types.list")
+                    results = []
+                else:
+                    self._reply(404, {"detail": "Not found."})
+                    return
+
+                self._reply(200, {"count": len(results), "next": None, "previous": None, "results": results})
+
+            def do_PATCH(self): # pylint: disable=invalid-name
+                """
+                Bulk device updates.
+                """
+
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if urlparse(self.path).path.rstrip("/") != "/api/dcim/devices":
+                    self._reply(404, {"detail": "Not found."})
+                    return
+
+                stub.count("dcim.devices.patch")
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                self._reply(200, stub.update_devices(body if isinstance(body, list) else [body]))
+
+        return Handler
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+"""
+Minimal TFTP server for the benchmark - serves the configs the service writes to
+TFTP_ROOT (RFC 1350, 512 byte blocks) and records which device pulled what.
+"""
+
+import os
+import time
+import socket
+import struct
+import logging
+import threading
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 512
+
+class TFTPSink:
+    """
+    Read-only TFTP server on host:port (0 picks a free port) serving root.
+    """
+
+    def __init__(self, root: str, host: str = "127.0.0.1", port: int = 0, timeout: float = 1.0, retries: int = 5) -> None:
+        """
+        Constructor.
+        """
+
+        self.root = root
+        self.timeout = timeout
+        self.retries = retries
+        self.pulls = {}
+        self.errors = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((host, port))
+        self.port = self._sock.getsockname()[1]
+        self._lock = threading.Lock()
+        self._running = True
+
+    def start(self) -> None:
+        """
+        Serves in a background thread.
+        """
+
+        threading.Thread(target=self._run, name="tftp-sink", daemon=True).start()
+
+    def stop(self) -> None:
+        """
+        Stops serving.
+        """
+
+        self._running = False
+        self._sock.close()
+
+    def _run(self) -> None:
+        """
+        Accepts read requests, one thread per transfer.
+        """
+
+        while self._running:
+            try:
+                packet, client = self._sock.recvfrom(2048)
+            except OSError:
+                return
+
+            if struct.unpack("!H", packet[:2])[0] != 1:
+                continue
+            filename = packet[2:].split(b"\0", 1)[0].decode("utf-8", "replace")
+            threading.Thread(target=self._send, args=(filename, client), daemon=True).start()
+
+    def _send(self, filename: str, client: tuple) -> None:
+        """
+        Sends filename to client from a new transfer port.
+        """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self._sock.getsockname()[0], 0))
+        sock.settimeout(self.timeout)
+
+        try:
+            path = os.path.join(self.root, os.path.basename(filename))
+            try:
+                with open(path, "rb") as file:
+                    data = file.read()
+            except OSError:
+                with self._lock:
+                    self.errors += 1
+                sock.sendto(struct.pack("!HH", 5, 1) + b"File not found\0", client)
+                return
+
+            for block in range(len(data) // BLOCK_SIZE + 1):
+                packet = struct.pack("!HH", 3, (block + 1) & 0xffff) + data[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE]
+                if not self._send_block(sock, client, packet, (block + 1) & 0xffff):
+                    with self._lock:
+                        self.errors += 1
+                    return
+
+            with self._lock:
+                self.pulls[filename] = {"time": time.time(), "bytes": len(data), "client": client[0]}
+        finally:
+            sock.close()
+
+    def _send_block(self, sock: socket.socket, client: tuple, packet: bytes, block: int) -> bool:
+        """
+        Sends a block until it is acknowledged.
+        """
+
+        for _ in range(self.retries + 1):
+            sock.sendto(packet, client)
+            try:
+                while True:
+                    ack, _ = sock.recvfrom(512)
+                    if struct.unpack("!HH", ack[:4]) == (4, block):
+                        return True
+            except socket.timeout:
+                continue
+
+        return False
+
+if __name__ == "__main__":
+
+    pass
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+"""
+Microbenchmarks for the CPU-bound per-device hot paths - ops/s and peak bytes
+allocated per call for each case in cases.py, compared against the recorded
+baseline. Exits 1 if a case got slower or allocates more than --threshold
+percent beyond its baseline.
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --update                # record a new baseline
+    python -m benchmarks.micro --only parse. --threshold 10
+
+Baselines are machine-specific - record them on the machine that compares.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+import tracemalloc
+from .cases import CASES, BENCHMARK_ENV
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout,
+                level=logging.INFO,
+                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+                )
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+try:
+    MICRO_THRESHOLD = float(os.environ["MICRO_THRESHOLD"])
+except KeyError:
+    MICRO_THRESHOLD = 25.0
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """
+    Command line.
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.micro", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON (default benchmarks/micro/baseline.json)")
+    parser.add_argument("--update", action="store_true", help="write the results as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=MICRO_THRESHOLD, help=f"allowed regression in percent (default {MICRO_THRESHOLD:g}, MICRO_THRESHOLD)")
+    parser.add_argument("--only", action="append", default=[], metavar="PREFIX", help="run only cases starting with PREFIX")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats, the best one counts (default 5)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing repeat (default 0.2)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+
+    return parser.parse_args(argv)
+
+def calibrate(func, min_time: float) -> int:
+    """
+    Loops per repeat so one repeat takes at least min_time (like timeit's autorange).
+    """
+
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        if time.perf_counter() - started >= min_time:
+            return loops
+        loops *= 2
+
+def timed(func, loops: int) -> float:
+    """
+    Seconds for loops calls, with the garbage collector off like timeit.
+    """
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        return time.perf_counter() - started
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def peak_bytes(func, calls: int = 20) -> int:
+    """
+    Median peak of memory allocated during one call (tracemalloc), over calls.
+    """
+
+    func()
+    peaks = []
+
+    tracemalloc.start()
+    try:
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    return int(statistics.median(peaks))
+
+def run_cases(names: list, repeat: int, min_time: float) -> dict:
+    """
+    Measures each case. Timing repeats are interleaved across the cases, so a
+    burst of load on the machine hits all of them instead of one - the best
+    repeat counts.
+    """
+
+    funcs = {name: CASES[name]() for name in names}
+    loops = {name: calibrate(func, min_time) for name, func in funcs.items()}
+    best = {}
+
+    for _ in range(repeat):
+        for name, func in funcs.items():
+            elapsed = timed(func, loops[name])
+            best[name] = min(best.get(name, elapsed), elapsed)
+
+    return {name: {"ops_per_second": round(loops[name] / best[name], 1),
+                   "peak_bytes": peak_bytes(funcs[name])}
+            for name in names}
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns [(case, metric, baseline, now, change in percent)] for regressions beyond threshold.
+    """
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        base = baseline[name]
+        # Lower ops/s and higher peak allocation are regressions.
+        slower = (base["ops_per_second"] - result["ops_per_second"]) / base["ops_per_second"] * 100
+        if slower > threshold:
+            regressions.append((name, "ops_per_second", base["ops_per_second"], result["ops_per_second"], -slower))
+
+        if base["peak_bytes"]:
+            larger = (result["peak_bytes"] - base["peak_bytes"]) / base["peak_bytes"] * 100
+            if larger > threshold:
+                regressions.append((name, "peak_bytes", base["peak_bytes"], result["peak_bytes"], larger))
+
+    return regressions
+
+def print_results(results: dict, baseline: dict) -> None:
+    """
+    Table of results with the change against baseline.
+    """
+
+    def change(name, metric):
+        if name not in baseline or not baseline[name][metric]:
+            return "-"
+        return f"{(results[name][metric] - baseline[name][metric]) / baseline[name][metric] * 100:+.1f}%"
+
+    print(f"{'case':34} {'ops/s':>12} {'vs base':>9} {'peak B/op':>11} {'vs base':>9}")
+    for name, result in results.items():
+        print(f"{name:34} {result['ops_per_second']:>12,.1f} {change(name, 'ops_per_second'):>9} {result['peak_bytes']:>11,} {change(name, 'peak_bytes'):>9}")
+
+def main(argv: list = None) -> int:
+    """
+    Runs the cases, compares against (or records) the baseline.
+    """
+
+    args = parse_args(argv)
+
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    # Log records would measure stdout, not the code - logger calls still run up to the level check.
+    logging.disable(logging.CRITICAL)
+
+    names = [name for name in CASES if not args.only or any(name.startswith(prefix) for prefix in args.only)]
+    if not names:
+        print(f"No case matches {args.only}, cases: {', '.join(CASES)}")
+        return 2
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)["cases"]
+
+    results = run_cases(names, args.repeat, args.min_time)
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"python": sys.version.split()[0], "cases": results}, file, indent=2)
+
+    if args.update:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump({"python": sys.version.split()[0], "cases": {**baseline, **results}}, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        # Confirm on a second run of just those cases before failing - a busy machine is not a regression.
+        results.update(run_cases(sorted({regression[0] for regression in regressions}), args.repeat, args.min_time))
+        regressions = compare(results, baseline, args.threshold)
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold:g}%:")
+        for name, metric, base, now, percent in regressions:
+            print(f"  {name} {metric}: {base:,} -> {now:,} ({percent:+.1f}%)")
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+"""
+Microbenchmark cases - the CPU-bound per-device hot paths, fed with the recorded
+fixtures in fixtures/. Each case is a setup function returning the callable to
+measure, so fixture loading and parsing of inputs stay out of the timing.
+"""
+
+import os
+import types
+import logging
+import tempfile
+
+# pylint: disable=line-too-long,import-outside-toplevel
+
+logger = logging.getLogger(__name__)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# connection_functions reads these at import - the cases never reach NetBox, TFTP or SFTP.
+BENCHMARK_ENV = {"TFTP_SERVER": "127.0.0.1",
+                 "NB_API_TOKEN": "benchmark",
+                 "NETBOX_HOST": "127.0.0.1:8080",
+                 "SFTP_SERVER": "127.0.0.1",
+                 "SFTP_USER": "benchmark",
+                 "SFTP_PASSWORD": "benchmark",
+                 "JOB_DB": os.path.join(tempfile.gettempdir(), "dhcp_provision_micro_jobs.sqlite")}
+
+def fixture(name: str, mode: str = "r"):
+    """
+    Returns the contents of fixtures/name.
+    """
+
+    with open(os.path.join(FIXTURE_DIR, name), mode) as file: # pylint: disable=unspecified-encoding
+        return file.read()
+
+def parse_dhcp_log_ack():
+    """
+    parse_dhcp_log on a long FortiGate DHCP ACK line, as /webhook gets it (bytes).
+    """
+
+    from app.utils.webhook_functions import parse_dhcp_log
+
+    data = fixture("fortigate_dhcp_ack.log", "rb")
+    return lambda: parse_dhcp_log(data)
+
+def parse_dhcp_log_ap():
+    """
+    parse_dhcp_log on an access point lease (skipped).
+    """
+
+    from app.utils.webhook_functions import parse_dhcp_log
+
+    data = fixture("fortigate_dhcp_ack_ap.log", "rb")
+    return lambda: parse_dhcp_log(data)
+
+def detect_device_os():
+    """
+    DeviceDetection.get_device_os against 'show version' - the probe answered
+    from memory, so only signature matching is measured.
+    """
+
+    from app.utils.device_detection_functions import DeviceDetection
+
+    response = types.SimpleNamespace(result=fixture("aoscx_show_version.txt"))
+    conn = types.SimpleNamespace(send_command=lambda command: response)
+    return DeviceDetection(conn=conn).get_device_os
+
+def parse_show_system():
+    """
+    TextFSM parse of 'show system' (serial, product).
+    """
+
+    from app.utils.parser_functions import TEMPLATE_CACHE
+    from app.utils.connection_functions import SYSTEM_FIELDS
+
+    data = fixture("aoscx_show_system.txt")
+    return lambda: TEMPLATE_CACHE.parse("aruba_aoscx", "show system", data, fields=SYSTEM_FIELDS)
+
+def _parse_show_interface(name: str):
+    """
+    TextFSM parse of a 'show interface' fixture (interface, if_type).
+    """
+
+    from app.utils.parser_functions import TEMPLATE_CACHE
+    from app.utils.connection_functions import INTERFACE_FIELDS
+
+    data = fixture(name)
+    return lambda: TEMPLATE_CACHE.parse("aruba_aoscx", "show interface", data, fields=INTERFACE_FIELDS)
+
+def parse_show_interface_28():
+    """
+    'show interface' of a 24-port switch (24 access ports, 4 uplinks).
+    """
+
+    return _parse_show_interface("aoscx_show_interface_28.txt")
+
+def parse_show_interface_52():
+    """
+    'show interface' of a 48-port switch (48 access ports, 4 uplinks).
+    """
+
+    return _parse_show_interface("aoscx_show_interface_52.txt")
+
+def render_aruba_aoscx():
+    """
+    render_template('aruba_aoscx.j2') for a 48-port switch.
+    """
+
+    from app.utils.parser_functions import TEMPLATE_CACHE
+    from app.utils.connection_functions import INTERFACE_FIELDS
+    from app.utils.template_functions import render_template
+
+    interfaces = TEMPLATE_CACHE.parse("aruba_aoscx", "show interface", fixture("aoscx_show_interface_52.txt"), fields=INTERFACE_FIELDS)
+    data = {"hostname": "se-sto-sw01",
+            "ip_address": "10.39.130.21/24",
+            "default_gw": "10.39.130.1",
+            "fallback_vlan": "30",
+            "interfaces": interfaces,
+            "radius_servers": ["10.39.0.13", "10.102.200.10", "10.45.2.10", "10.241.200.10"]}
+    return lambda: render_template("aruba_aoscx.j2", data)
+
+def local_radius_server():
+    """
+    local_radius_server with the site name answered from memory.
+    """
+
+    from app.utils.connection_functions import local_radius_server as radius_servers
+
+    netbox = types.SimpleNamespace(get_site_name=lambda serial: "SE-STO-01")
+    return lambda: radius_servers(netbox, "SG30KMZ0DF")
+
+CASES = {"parse_dhcp_log.ack": parse_dhcp_log_ack,
+         "parse_dhcp_log.access_point": parse_dhcp_log_ap,
+         "device_detection.get_device_os": detect_device_os,
+         "parse.show_system": parse_show_system,
+         "parse.show_interface_28": parse_show_interface_28,
+         "parse.show_interface_52": parse_show_interface_52,
+         "render_template.aruba_aoscx": render_aruba_aoscx,
+         "local_radius_server": local_radius_server}
+
+if __name__ == "__main__":
+
+    pass
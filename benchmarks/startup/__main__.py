@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+"""
+Startup report - imports the app in a fresh interpreter under -X importtime and
+reports the import cost per module, per top-level package and for every app
+module, with the total wall time and peak RSS of the import.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --top 30 --repeat 5 --json startup.json
+"""
+
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+import tempfile
+import subprocess
+from ..micro.cases import BENCHMARK_ENV
+
+# pylint: disable=line-too-long
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout,
+                level=logging.INFO,
+                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+                )
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+IMPORTTIME_REGEX = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$", re.MULTILINE)
+
+# Runs in the child - the result line is picked out of the app's own log output.
+CHILD = """
+import json, time, resource
+started = time.perf_counter()
+import app
+print("STARTUP_RESULT " + json.dumps({"wall_ms": (time.perf_counter() - started) * 1000,
+                                      "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """
+    Command line.
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.startup", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=20, help="modules to list by self time (default 20)")
+    parser.add_argument("--repeat", type=int, default=3, help="imports to run, the fastest is reported (default 3)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra environment for the app")
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+
+    return parser.parse_args(argv)
+
+def import_app(env: dict) -> dict:
+    """
+    Imports the app once in a new interpreter, returns wall time, RSS and the
+    -X importtime records.
+    """
+
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD], cwd=REPO_ROOT, env=env,
+                             capture_output=True, text=True, check=False)
+
+    result = next((json.loads(line.split(" ", 1)[1]) for line in process.stdout.splitlines() if line.startswith("STARTUP_RESULT ")), None)
+    if process.returncode != 0 or result is None:
+        raise RuntimeError(f"Importing the app failed ({process.returncode}):\n{process.stdout[-2000:]}{process.stderr[-2000:]}")
+
+    result["modules"] = [{"module": module, "self_us": int(self_us), "cumulative_us": int(cumulative_us), "depth": len(indent) // 2}
+                         for self_us, cumulative_us, indent, module in IMPORTTIME_REGEX.findall(process.stderr)]
+
+    return result
+
+def build_report(result: dict, top: int) -> dict:
+    """
+    Groups the importtime records.
+    """
+
+    modules = result["modules"]
+
+    packages = {}
+    for record in modules:
+        package = record["module"].split(".")[0]
+        packages[package] = packages.get(package, 0) + record["self_us"]
+
+    return {"wall_ms": round(result["wall_ms"], 1),
+            "max_rss_kb": result["max_rss_kb"],
+            "modules_imported": len(modules),
+            "import_ms": round(sum(record["self_us"] for record in modules) / 1000, 1),
+            "packages_ms": {package: round(self_us / 1000, 1) for package, self_us in sorted(packages.items(), key=lambda item: -item[1])},
+            "app_modules_ms": {record["module"]: {"self": round(record["self_us"] / 1000, 1), "cumulative": round(record["cumulative_us"] / 1000, 1)}
+                               for record in modules if record["module"] == "app" or record["module"].startswith("app.")},
+            "top_modules_ms": [{"module": record["module"], "self": round(record["self_us"] / 1000, 1), "cumulative": round(record["cumulative_us"] / 1000, 1)}
+                               for record in sorted(modules, key=lambda record: -record["self_us"])[:top]]}
+
+def print_report(report: dict, top: int) -> None:
+    """
+    Human-readable report.
+    """
+
+    print(f"import app         {report['wall_ms']:.0f} ms wall, {report['import_ms']:.0f} ms in {report['modules_imported']} module imports, peak RSS {report['max_rss_kb'] / 1024:.1f} MiB")
+
+    print("\nPer package (self time)")
+    for package, elapsed in list(report["packages_ms"].items())[:top]:
+        print(f"  {package:40} {elapsed:>8.1f} ms")
+
+    print("\nApp modules (self / cumulative, preloading included)")
+    for module, elapsed in report["app_modules_ms"].items():
+        print(f"  {module:40} {elapsed['self']:>8.1f} ms {elapsed['cumulative']:>8.1f} ms")
+
+    print(f"\nTop {top} modules (self / cumulative)")
+    for record in report["top_modules_ms"]:
+        print(f"  {record['module']:40} {record['self']:>8.1f} ms {record['cumulative']:>8.1f} ms")
+
+def main(argv: list = None) -> int:
+    """
+    Runs the imports, prints the report of the fastest one.
+    """
+
+    args = parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="dhcp_provision_startup_") as workdir:
+        env = {**os.environ, **BENCHMARK_ENV,
+               "JOB_DB": os.path.join(workdir, "jobs.sqlite"),
+               "JINJA_CACHE_DIR": os.path.join(workdir, "jinja"),
+               "TEXTFSM_CACHE_DIR": os.path.join(workdir, "textfsm")}
+        env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        env.update(dict(item.split("=", 1) for item in args.env))
+
+        result = min((import_app(env) for _ in range(max(1, args.repeat))), key=lambda result: result["wall_ms"])
+
+    report = build_report(result, args.top)
+    print_report(report, args.top)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -2,10 +2,30 @@
 Setup for GUNICORN
 """
 
+import os
+import shutil
+
 # pylint: disable=invalid-name
 
+# Prometheus multiprocess mode - every worker writes its metrics to this directory,
+# /metrics aggregates them. Must be set before the app (prometheus_client) is imported.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/dhcp_provision_metrics")
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
 timeout = 1500
 bind = "0.0.0.0:5005"
 workers = 8
+# Import the app (and preload its caches) once in the master, shared by the workers.
+preload_app = True
 certfile = "cert.pem"
 keyfile = "key.pem"
+
+def child_exit(server, worker): # pylint: disable=unused-argument
+    """
+    Drops live gauges (jobs in flight) of a worker that exited.
+    """
+
+    from prometheus_client import multiprocess # pylint: disable=import-outside-toplevel
+
+    multiprocess.mark_process_dead(worker.pid)